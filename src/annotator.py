@@ -2,34 +2,90 @@ import os
 import glob
 import json
 import pandas as pd
-import numpy as np
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from booknlp.booknlp import BookNLP
 
+booknlp = None  # one BookNLP model per (worker) process
 
-def annotate_folder(input_folder, output_folder):
+
+def init_booknlp():
+    global booknlp
     model_params = {
         "pipeline": "entity,supersense",
         "model": "small",
         "spacy_model": "en_core_web_sm"
     }
     booknlp = BookNLP("en", model_params)
+
+
+def map_files(func, args_list, n_workers=1, initializer=None):
+    # run func over args_list, in a process pool if n_workers > 1
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_workers = min(n_workers, len(args_list))
+    if n_workers <= 1:
+        if initializer and args_list:
+            initializer()
+        return [func(*args) for args in args_list]
+    with ProcessPoolExecutor(n_workers, initializer=initializer) as executor:
+        return list(executor.map(func, *zip(*args_list)))
+
+
+def annotate_file(path, output_folder):
+    book_id = os.path.basename(path)[:-4]
+    print("processing", book_id)
+    booknlp.process(path, output_folder, book_id)
+
+
+def annotate_folder(input_folder, output_folder, n_workers=1):
     os.makedirs(output_folder, exist_ok=True)
+    args_list = []
     for path in glob.glob(os.path.join(input_folder, "*.txt")):
         book_id = os.path.basename(path)[:-4]
         if os.path.exists(os.path.join(output_folder, f"{book_id}.tokens")):
             print("skipped", book_id)
             continue
-        print("processing", book_id)
-        booknlp.process(path, output_folder, book_id)
+        args_list.append((path, output_folder))
+    map_files(annotate_file, args_list, n_workers, initializer=init_booknlp)
+
+
+token_columns = ["sent_id", "id", "text", "upos", "xpos", "deprel", "head_id", "lemma", "supersense"]
+
+
+def load_annotation(token_path):
+    # read the BookNLP .tokens and .supersense files of one book into a token frame
+    df = pd.read_csv(token_path, sep="\t", quotechar='非')
+    mapping = {"sentence_ID": "sent_id", "token_ID_within_sentence": "id", "word": "text", "POS_tag": "upos",
+               "fine_POS_tag": "xpos", "dependency_relation": "deprel", "syntactic_head_ID": "head_id"}
+    df.rename(mapping, axis=1, inplace=True)
+
+    supersenses = pd.read_csv(token_path[:-len(".tokens")] + ".supersense", sep="\t")
+    # one row per token of each supersense span
+    lengths = supersenses['end_token'] - supersenses['start_token'] + 1
+    spans = supersenses.loc[supersenses.index.repeat(lengths.clip(lower=0))]
+    token_senses = pd.DataFrame({
+        "id": spans['start_token'] + spans.groupby(level=0).cumcount(),
+        "supersense": spans['supersense_category']
+    }).set_index("id")
+    df = df.join(token_senses)
+    # keep a supersense only if its category agrees with the POS tag (n.* for N*, v.* for V*)
+    sense_pos = df['supersense'].str.split(".").str[0].str[0].str.upper()
+    df['supersense'] = df['supersense'].where(sense_pos == df['xpos'].str[0])
+    return df[token_columns]
+
 
+def annotation_to_csv(token_path, csv_path):
+    print("processing", os.path.basename(token_path))
+    load_annotation(token_path).to_csv(csv_path)
 
-def annotations_to_csv(input_folder, output_folder):
+
+def annotations_to_csv(input_folder, output_folder, n_workers=1):
     os.makedirs(output_folder, exist_ok=True)
+    args_list = []
     for file_name in os.listdir(input_folder):
         if not file_name.endswith(".tokens"):
             continue
-        print("processing", file_name)
         token_path = os.path.join(input_folder, file_name)
 
         file_id = os.path.basename(token_path).split(".")[0]
@@ -37,50 +93,94 @@ def annotations_to_csv(input_folder, output_folder):
         if os.path.exists(csv_path):
             print("already processed", file_id, ", skipping")
             continue
-        df = pd.read_csv(token_path, sep="\t", quotechar='非')
-        mapping = {"sentence_ID": "sent_id", "token_ID_within_sentence": "id", "word": "text", "POS_tag": "upos",
-                   "fine_POS_tag": "xpos", "dependency_relation": "deprel", "syntactic_head_ID": "head_id"}
-        df.rename(mapping, axis=1, inplace=True)
-
-        supersenses = pd.read_csv(os.path.join(input_folder, file_id + ".supersense"),
-                                  sep="\t").to_dict(orient="records")
-        rows = []
-        for sense in supersenses:
-            for i in range(sense['start_token'], sense['end_token'] + 1):
-                rows.append({"id": i, "supersense": sense['supersense_category']})
-        df['supersense'] = df.join(pd.DataFrame(rows).set_index("id")).apply(lambda x: x.supersense if pd.isnull(
-            x.supersense) or x.supersense.split(".")[0][0].upper() == x.xpos[0] else np.nan, axis=1)
-            
-        df[list(mapping.values()) + ['lemma', 'supersense']].to_csv(csv_path)
-
-
-def csv_to_json(input_folder, output_path):
-    def process_sent(df_sent, file_name):
-        dic_list = df_sent.to_dict(orient="records")
-        for d in dic_list:
-            del d['sent_id']
-        all_sents.append({"file_name": file_name, "tokens": dic_list})
-
-    all_sents = []
+        args_list.append((token_path, csv_path))
+    map_files(annotation_to_csv, args_list, n_workers)
+
+
+class CorpusWriter:
+    """Writes sentences to a corpus file one at a time.
+
+    fmt is "json" (a JSON array) or "jsonl" (one sentence per line); by default it follows the extension.
+    """
+    def __init__(self, output_path, fmt=None):
+        self.fmt = fmt or ("jsonl" if output_path.endswith(".jsonl") else "json")
+        self.file = open(output_path, "w")
+        self.n_sents = 0
+        if self.fmt == "json":
+            self.file.write("[")
+
+    def write(self, sent):
+        if self.fmt == "json":
+            if self.n_sents > 0:
+                self.file.write(", ")
+            json.dump(sent, self.file)
+        else:
+            self.file.write(json.dumps(sent) + "\n")
+        self.n_sents += 1
+
+    def close(self):
+        if self.fmt == "json":
+            self.file.write("]")
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def iter_sentences(df, file_name):
+    # split a token frame of one file into sentences without a per-sentence DataFrame
+    df = df.fillna("")
+    sent_ids = df['sent_id'].tolist()
+    records = df.drop(columns="sent_id").to_dict(orient="records")
+    start = 0
+    for i in range(1, len(records) + 1):
+        if i == len(records) or sent_ids[i] != sent_ids[start]:
+            yield {"file_name": file_name, "tokens": records[start:i]}
+            start = i
+
+
+def csv_to_json(input_folder, output_path, fmt=None):
+    # memory is bounded by the largest file, not by the corpus
     paths = glob.glob(os.path.join(input_folder, "*.csv"))
-    for path in paths:
-        print("converting", path)
-        fn = os.path.basename(path).split(".")[0]
-        df = pd.read_csv(path, index_col=0).fillna("")
-        df.groupby("sent_id").apply(lambda df_sent: process_sent(df_sent, fn))
+    with CorpusWriter(output_path, fmt) as writer:
+        for path in paths:
+            print("converting", path)
+            fn = os.path.basename(path).split(".")[0]
+            df = pd.read_csv(path, index_col=0)
+            for sent in iter_sentences(df, fn):
+                writer.write(sent)
+
 
-    json.dump(all_sents, open(output_path, "w"))
+def annotations_to_json(input_folder, output_path, fmt=None):
+    # like annotations_to_csv() followed by csv_to_json(), without the intermediate CSV files
+    paths = glob.glob(os.path.join(input_folder, "*.tokens"))
+    with CorpusWriter(output_path, fmt) as writer:
+        for path in paths:
+            print("converting", path)
+            fn = os.path.basename(path).split(".")[0]
+            for sent in iter_sentences(load_annotation(path), fn):
+                writer.write(sent)
 
 
-def process_folder(input_folder, output_path):
+def process_folder(input_folder, output_path, n_workers=None, skip_csv=False):
+    # n_workers: number of worker processes (default: one per core); each loads its own BookNLP model
+    # an output_path ending with .jsonl gets one sentence per line
     annotation_folder = os.path.join(input_folder, "annotations")
-    annotate_folder(input_folder, annotation_folder)
+    annotate_folder(input_folder, annotation_folder, n_workers)
+    if skip_csv:
+        annotations_to_json(annotation_folder, output_path)
+        return
     csv_folder = os.path.join(input_folder, "csv")
-    annotations_to_csv(annotation_folder, csv_folder)
+    annotations_to_csv(annotation_folder, csv_folder, n_workers)
     csv_to_json(csv_folder, output_path)
 
 
 if __name__ == "__main__":
     # process the data from first argument and output to second argument
-    process_folder(sys.argv[1], sys.argv[2])
-    # process_folder("data", "data/patterns.json")
\ No newline at end of file
+    # an optional third argument sets the number of worker processes
+    n_workers = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    process_folder(sys.argv[1], sys.argv[2], n_workers)
+    # process_folder("data", "data/patterns.json")
@@ -0,0 +1,282 @@
+"""Benchmarks the main entry points on synthetic corpora.
+
+    python benchmark.py [--sizes 1000 10000 50000] [--threads 1 2 4] [--baseline benchmark_baseline.json]
+                        [--save-baseline]
+
+Corpora are generated deterministically (see generate_corpus()), so timings of different versions are comparable
+on the same machine. Each case is timed at each size as the best of --repeats runs; with a saved baseline, cases
+slower than it by more than --tolerance are flagged as regressions and the exit code is 1. Build mining.so with
+-d:nimAllocStats to also compare the allocations made collecting the bigrams of the corpus. Indexing the corpus
+is also timed with each of --threads (index_threads<n>), and its speedup over the first of them is reported.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import itertools
+import tempfile
+import pandas as pd
+import mining
+import sharded
+import db_manager
+
+pos_tags = [  # (upos, xpos, deprel, supersense prefix)
+    ("NOUN", "NN", "obj", "n"), ("VERB", "VB", "root", "v"), ("ADJ", "JJ", "amod", ""), ("ADV", "RB", "advmod", ""),
+    ("PRON", "PRP", "nsubj", ""), ("ADP", "IN", "case", ""), ("DET", "DT", "det", ""), ("NOUN", "NNS", "nsubj", "n"),
+    ("VERB", "VBD", "ccomp", "v"), ("VERB", "VBG", "xcomp", "v"),
+]
+supersenses = {"n": ["n.person", "n.artifact", "n.act", "n.cognition"], "v": ["v.motion", "v.communication", "v.change"]}
+
+general_config = {
+    "association_measure": "pmi2",
+    "min_score_threshold": 6.0,
+    "min_pattern_freq_per_mill": 10,
+    "token_types": ["lemma", "upos", "xpos", "supersense"],
+    "allowed_values": {"upos": ["PRON", "NOUN"], "xpos": ["WH", "VBG", "VBN"], "deprel": ["ccomp"]},
+    "ignored_values": {"lemma": ["w6", "w7"]},
+    "n_total_rounds": 10,
+    "n_per_round": 10,
+    "n_threads": 1,
+    "use_index_cache": False,
+}
+
+
+def make_lexicon(vocab_size, seed):
+    # word i is the i-th most frequent; its tags are fixed so that lemmas and tags co-occur consistently
+    rng = random.Random(seed)
+    lexicon = []
+    for i in range(vocab_size):
+        upos, xpos, deprel, sense_prefix = pos_tags[rng.randrange(len(pos_tags))]
+        supersense = rng.choice(supersenses[sense_prefix]) if sense_prefix else ""
+        lexicon.append({"lemma": f"w{i}", "upos": upos, "xpos": xpos, "deprel": deprel, "supersense": supersense})
+    return lexicon
+
+
+def iter_synthetic_sentences(n_sents, vocab_size=5000, zipf_s=1.1, seed=0, sents_per_file=500, lengths=(4, 25)):
+    """Yields sentences in the schema of corpus.json. Words are drawn from a Zipf distribution with exponent
+    zipf_s over vocab_size lemmas; each sentence is a dependency tree whose arcs point towards its root, with
+    a length drawn uniformly from lengths (inclusive)."""
+    lexicon = make_lexicon(vocab_size, seed)
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) ** zipf_s for rank in range(vocab_size)))
+    rng = random.Random(seed + 1)
+    for sent_idx in range(n_sents):
+        length = rng.randint(*lengths)
+        entries = rng.choices(lexicon, cum_weights=cum_weights, k=length)
+        root = rng.randrange(length)
+        tokens = []
+        for i, entry in enumerate(entries):
+            if i == root:
+                head_id = i
+            elif rng.random() < 0.7:  # the neighbour on the way to the root
+                head_id = i + 1 if i < root else i - 1
+            else:
+                head_id = root
+            text = entry["lemma"] + ("s" if entry["xpos"] == "NNS" else "")
+            tokens.append({"id": i, "text": text, "upos": entry["upos"], "xpos": entry["xpos"],
+                           "deprel": "root" if i == root else entry["deprel"], "head_id": head_id,
+                           "lemma": entry["lemma"], "supersense": entry["supersense"]})
+        yield {"file_name": f"doc{sent_idx // sents_per_file}", "tokens": tokens}
+
+
+def generate_corpus(output_path, n_sents, vocab_size=5000, zipf_s=1.1, seed=0, lengths=(4, 25)):
+    # a JSON array, or JSON Lines if output_path ends with .jsonl
+    is_jsonl = output_path.endswith(".jsonl")
+    with open(output_path, "w") as f:
+        f.write("" if is_jsonl else "[")
+        for i, sent in enumerate(iter_synthetic_sentences(n_sents, vocab_size, zipf_s, seed, lengths=lengths)):
+            if is_jsonl:
+                f.write(json.dumps(sent) + "\n")
+            else:
+                f.write((", " if i > 0 else "") + json.dumps(sent))
+        f.write("" if is_jsonl else "]")
+
+
+def generate_csv_folder(output_folder, n_sents, vocab_size=5000, zipf_s=1.1, seed=0):
+    # the per-file token CSVs written by annotator.annotations_to_csv(), for csv_to_json()
+    os.makedirs(output_folder, exist_ok=True)
+    rows_by_file = {}
+    for sent_id, sent in enumerate(iter_synthetic_sentences(n_sents, vocab_size, zipf_s, seed)):
+        rows = rows_by_file.setdefault(sent["file_name"], [])
+        rows.extend({"sent_id": sent_id, **token} for token in sent["tokens"])
+    for file_name, rows in rows_by_file.items():
+        df = pd.DataFrame(rows)
+        df['supersense'] = df['supersense'].replace("", None)
+        df.to_csv(os.path.join(output_folder, file_name + ".csv"))
+
+
+def target_config(lexicon):
+    # the two most frequent verbs as targets
+    verbs = [entry["lemma"] for entry in lexicon if entry["upos"] == "VERB"][:2]
+    return {**general_config, "target_tokens": {verb: {} for verb in verbs}}
+
+
+def summed_reindex_time(telemetry_path):
+    # the reindexing of merged sentences, i.e. of every round after the first
+    with open(telemetry_path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return sum(record["reindex_time"] for record in records if record["round"] > 1)
+
+
+def timed(func, repeats, setup=None):
+    # the best of repeats runs; setup() runs untimed before each
+    best = None
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run_cases(work_folder, n_sents, args):
+    """Times every case on a corpus of n_sents sentences; returns {case: seconds}, where collect_allocations is
+    a count of heap allocations instead."""
+    folder = os.path.join(work_folder, str(n_sents))
+    os.makedirs(folder, exist_ok=True)
+    json_path = os.path.join(folder, "corpus.json")
+    db_path = os.path.join(folder, "db.sqlite3")
+    generate_corpus(json_path, n_sents, args.vocab_size, args.zipf_s, args.seed)
+    mining.write_binary_corpus(json_path, os.path.join(folder, "corpus.bin"))
+    manager = db_manager.DBManager(db_path)
+    results = {}
+
+    def new_database():
+        manager.engine.dispose()
+        for path in [db_path, db_path + "-wal", db_path + "-shm"]:
+            if os.path.exists(path):
+                os.remove(path)
+        manager.create_database()
+
+    # includes loading the binary corpus, which is small next to the inserts
+    results["store_tokens"] = timed(lambda: mining.store_corpus_tokens(json_path, db_path), args.repeats,
+                                    setup=new_database)
+    config = general_config
+    # the first round of indexing alone; allocations are only counted by a build with -d:nimAllocStats
+    profile = mining.profile_indexing(json_path, config, args.repeats)
+    results["collect_bigrams"] = profile["collect_time"]
+    results["index_sentences"] = profile["index_time"]
+    if profile["allocations"] >= 0:
+        results["collect_allocations"] = profile["allocations"]
+    for n_threads in args.threads:
+        thread_profile = mining.profile_indexing(json_path, {**config, "n_threads": n_threads}, args.repeats)
+        results[f"index_threads{n_threads}"] = thread_profile["threaded_index_time"]
+    results["mine_general"] = timed(lambda: mining.mine_patterns(json_path, folder, config), args.repeats)
+    results["mine_sharded"] = timed(lambda: sharded.mine_patterns(json_path, folder, config, args.workers),
+                                    args.repeats)
+    lexicon = make_lexicon(args.vocab_size, args.seed)
+    results["mine_target"] = timed(lambda: mining.mine_patterns(json_path, folder, target_config(lexicon)),
+                                   args.repeats)
+
+    # long sentences collect many patterns and merges, which makes reindexing them dominate
+    long_folder = os.path.join(folder, "long")
+    os.makedirs(long_folder, exist_ok=True)
+    long_json_path = os.path.join(long_folder, "corpus.json")
+    generate_corpus(long_json_path, max(n_sents // 5, 1), args.vocab_size, args.zipf_s, args.seed, lengths=(60, 120))
+    mining.write_binary_corpus(long_json_path, os.path.join(long_folder, "corpus.bin"))
+    results["mine_long_sents"] = timed(lambda: mining.mine_patterns(long_json_path, long_folder, config),
+                                       args.repeats)
+    results["reindex_long_sents"] = summed_reindex_time(os.path.join(long_folder, "telemetry.jsonl"))
+
+    # queries run against a task mined into the database, as the Explore page does
+    new_database()
+    task_id = manager.new_task("benchmark", general_config)
+    mining.mine_patterns(json_path, folder, general_config, store_in_database=True, task_id=task_id)
+    patterns = manager.get_pattern_df(task_id=task_id, limit=20)['pattern'].tolist()
+    results["query_pattern"] = timed(
+        lambda: [manager.query_pattern(pattern, limit=100, task_id=task_id) for pattern in patterns], args.repeats)
+    results["get_pattern_df"] = timed(lambda: manager.get_pattern_df(task_id=task_id), args.repeats)
+
+    if not args.skip_csv:
+        import annotator  # needs BookNLP installed
+        csv_folder = os.path.join(folder, "csv")
+        generate_csv_folder(csv_folder, n_sents, args.vocab_size, args.zipf_s, args.seed)
+        results["csv_to_json"] = timed(
+            lambda: annotator.csv_to_json(csv_folder, os.path.join(folder, "converted.json")), args.repeats)
+    manager.engine.dispose()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Returns rows of (key, seconds, baseline seconds, ratio, is_regression)."""
+    rows = []
+    for key, seconds in results.items():
+        base = baseline.get(key)
+        ratio = seconds / base if base else None
+        rows.append((key, seconds, base, ratio, ratio is not None and ratio > 1 + tolerance))
+    return rows
+
+
+def thread_speedups(results, sizes, threads):
+    """Returns rows of (n_sents, n_threads, seconds, speedup over threads[0]) of the index_threads cases."""
+    rows = []
+    for n_sents in sizes:
+        base = results[f"index_threads{threads[0]}@{n_sents}"]
+        for n_threads in threads:
+            seconds = results[f"index_threads{n_threads}@{n_sents}"]
+            rows.append((n_sents, n_threads, seconds, base / seconds if seconds else None))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000], help="corpus sizes in sentences")
+    parser.add_argument("--vocab-size", type=int, default=5000)
+    parser.add_argument("--zipf-s", type=float, default=1.1, help="Zipf exponent of word frequencies")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=2, help="worker processes of sharded mining")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4],
+                        help="thread counts indexing is timed with (n_threads; 0 is one per core)")
+    parser.add_argument("--baseline", default="benchmark_baseline.json")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="slowdown over the baseline that is flagged")
+    parser.add_argument("--skip-csv", action="store_true", help="skip csv_to_json, which needs BookNLP")
+    parser.add_argument("--work-folder", help="where corpora are generated (default: a temporary folder)")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    work_folder = args.work_folder or tempfile.mkdtemp(prefix="constraction_benchmark_")
+    results = {}
+    try:
+        for n_sents in args.sizes:
+            for case, seconds in run_cases(work_folder, n_sents, args).items():
+                results[f"{case}@{n_sents}"] = seconds
+    finally:
+        if not args.work_folder:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+    rows = compare(results, baseline, args.tolerance)
+    print(f"{'case':<28}{'seconds':>10}{'baseline':>10}{'ratio':>8}")
+    for key, seconds, base, ratio, is_regression in rows:
+        base_str = f"{base:.3f}" if base else "-"
+        ratio_str = f"{ratio:.2f}" if ratio else "-"
+        print(f"{key:<28}{seconds:>10.3f}{base_str:>10}{ratio_str:>8}{'  REGRESSION' if is_regression else ''}")
+    speedups = thread_speedups(results, args.sizes, args.threads)
+    print(f"\n{'sents':>8}{'threads':>9}{'seconds':>10}{'speedup':>9}")
+    for n_sents, n_threads, seconds, speedup in speedups:
+        speedup_str = f"{speedup:.2f}" if speedup else "-"
+        print(f"{n_sents:>8}{n_threads:>9}{seconds:>10.3f}{speedup_str:>9}")
+    record = {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "args": vars(args), "results": results,
+              "thread_speedups": [{"n_sents": n_sents, "n_threads": n_threads, "speedup": speedup}
+                                  for n_sents, n_threads, _, speedup in speedups]}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(record, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(record, f, indent=2)
+        print("baseline saved to", args.baseline)
+    return 1 if any(row[-1] for row in rows) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,262 @@
+"""Searches the project corpus by token sequences and dependency arcs.
+
+Queries are whitespace-separated terms:
+
+    give _ to              lemma give, any one token, then lemma to
+    upos=VERB&xpos=VBD     a token matching every constraint (layers: text, lemma, upos, xpos, deprel, supersense)
+    NOUN <n.person>        a bare value is a lemma, an upos or xpos tag if in capitals, a supersense if it has a
+                           dot; <...> is the form shown by the Explore page
+    give ... NOUN          a gap of 0 to max_gap tokens; {1,3} is a gap of 1 to 3 tokens
+    NOUN >obj give         an arc: a NOUN whose head is give, attached as obj ('>' for any relation)
+
+Every term is looked up in posting lists of (layer, value) -> token keys (sentence_id << 16 | token_id), built
+from the token table of the project database and kept in a sidecar file next to it (see CorpusIndex.open()).
+
+    python corpus_search.py <db_path> "<query>" [limit]
+"""
+import os
+import re
+import sys
+import numpy as np
+import pandas as pd
+import db_manager
+
+layers = ["text", "lemma", "upos", "xpos", "deprel", "supersense"]
+token_bits = 16  # token ids are stored as uint16s in positions too
+token_mask = (1 << token_bits) - 1
+max_gap = 10
+index_file_name = "search_index.npz"
+
+
+class Gap:
+    def __init__(self, min_len=0, max_len=max_gap):
+        if not 0 <= min_len <= max_len:
+            raise ValueError(f"invalid gap {{{min_len},{max_len}}}")
+        self.min_len = min_len
+        self.max_len = max_len
+
+
+class Term:
+    # a token matching every (layer, value) of constraints; label is how the query wrote it
+    def __init__(self, constraints, label):
+        self.constraints = constraints
+        self.label = label
+
+
+class CorpusIndex:
+    """Posting lists of the tokens of a corpus. keys holds the key of every token in order, heads the id of its
+    head; the tokens of value v in a layer are keys[order[offsets[v]:offsets[v + 1]]], in order too."""
+
+    def __init__(self, keys, heads, sent_lengths, postings, stamp):
+        self.keys = keys
+        self.heads = heads
+        self.sent_lengths = sent_lengths
+        self.postings = postings  # layer -> (values, order, offsets)
+        self.stamp = stamp  # of the token table the index was built from (see DBManager.get_token_stamp())
+        self.value_codes = {layer: {value: code for code, value in enumerate(values)}
+                            for layer, (values, _, _) in postings.items()}
+
+    @classmethod
+    def from_frame(cls, df, stamp):
+        # df: the token table sorted by sentence_id and id
+        keys = (df['sentence_id'].to_numpy(np.int64) << token_bits) | df['id'].to_numpy(np.int64)
+        heads = df['head_id'].to_numpy(np.int32)
+        sent_lengths = np.bincount(df['sentence_id'].to_numpy(np.int64)).astype(np.int32)
+        postings = {}
+        for layer in layers:
+            column = df[layer].fillna("")
+            if layer == "text":
+                column = column.str.lower()
+            codes, values = pd.factorize(column)
+            order = np.argsort(codes, kind="stable").astype(np.int64)
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(values)))])
+            postings[layer] = (np.asarray(values, dtype=str), order, offsets)
+        return cls(keys, heads, sent_lengths, postings, np.asarray(stamp, dtype=np.int64))
+
+    @classmethod
+    def from_database(cls, manager):
+        return cls.from_frame(manager.get_token_frame(), manager.get_token_stamp())
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            postings = {layer: (data[f"{layer}_values"], data[f"{layer}_order"], data[f"{layer}_offsets"])
+                        for layer in layers}
+            return cls(data["keys"], data["heads"], data["sent_lengths"], postings, data["stamp"])
+
+    def save(self, path):
+        arrays = {"keys": self.keys, "heads": self.heads, "sent_lengths": self.sent_lengths, "stamp": self.stamp}
+        for layer, (values, order, offsets) in self.postings.items():
+            arrays.update({f"{layer}_values": values, f"{layer}_order": order, f"{layer}_offsets": offsets})
+        temp_path = f"{path}.{os.getpid()}.npz"
+        np.savez(temp_path, **arrays)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def open(cls, manager, path=None):
+        """The index of the corpus of a project: loaded from the sidecar file at path (by default next to the
+        database) unless the tokens have changed since it was written, in which case it is rebuilt."""
+        path = path or os.path.join(os.path.dirname(manager.db_path), index_file_name)
+        stamp = list(manager.get_token_stamp())
+        if os.path.exists(path):
+            index = cls.load(path)
+            if index.stamp.tolist() == stamp:
+                return index
+        index = cls.from_database(manager)
+        index.save(path)
+        return index
+
+    def get_postings(self, layer, value):
+        if layer == "text":
+            value = value.lower()
+        code = self.value_codes[layer].get(value)
+        if code is None:
+            return np.empty(0, dtype=np.int64)
+        _, order, offsets = self.postings[layer]
+        return self.keys[order[offsets[code]:offsets[code + 1]]]
+
+    def match_term(self, term):
+        result = None
+        for layer, value in term.constraints:
+            keys = self.get_postings(layer, value)
+            result = keys if result is None else np.intersect1d(result, keys, assume_unique=True)
+        return result
+
+    def parse_term(self, text):
+        constraints = []
+        for part in text.split("&"):
+            if "=" in part:
+                layer, value = part.split("=", 1)
+                if layer not in layers:
+                    raise ValueError(f"unknown layer {layer} in {text}")
+            else:
+                value = part.strip("<>")
+                if "." in value:
+                    layer = "supersense"
+                elif len(value) > 1 and value.upper() == value and value.lower() != value:
+                    value = value.upper()
+                    layer = "upos" if value in self.value_codes["upos"] else "xpos"
+                else:
+                    layer = "lemma"
+            constraints.append((layer, value))
+        return Term(constraints, text)
+
+    def parse(self, query):
+        """Returns ("arc", dependent, head, deprel) or ("sequence", items) with items Term, None (any token)
+        or Gap."""
+        parts = query.split()
+        if len(parts) == 3 and parts[1].startswith(">"):
+            return "arc", self.parse_term(parts[0]), self.parse_term(parts[2]), parts[1][1:] or None
+        items = []
+        for part in parts:
+            gap = re.fullmatch(r"\{(\d+),(\d+)\}", part)
+            if part == "_":
+                items.append(None)
+            elif part == "...":
+                items.append(Gap())
+            elif gap:
+                items.append(Gap(int(gap.group(1)), int(gap.group(2))))
+            else:
+                items.append(self.parse_term(part))
+        return "sequence", items
+
+    def search(self, query, limit=100):
+        """Returns (number of matches, [(sentence_id, token_ids, labels)] of the first limit matches)."""
+        parsed = self.parse(query)
+        if parsed[0] == "arc":
+            return self.search_arc(*parsed[1:], limit=limit)
+        return self.search_sequence(parsed[1], limit=limit)
+
+    def search_sequence(self, items, limit=100):
+        # split at gaps into segments of fixed length, each anchored by its terms
+        segments, gaps = [[]], []
+        for item in items:
+            if isinstance(item, Gap):
+                if segments[-1]:
+                    segments.append([])
+                    gaps.append(item)
+            else:
+                segments[-1].append(item)
+        if not segments[-1]:
+            segments.pop()
+            gaps = gaps[:len(segments) - 1]
+        if not segments:
+            return 0, []
+        if any(all(item is None for item in segment) for segment in segments):
+            raise ValueError("each part of a query between gaps needs a token that is not _")
+        # a match is a row of the starts of its segments; the first match of each start is kept
+        rows = self.match_segment(segments[0])[:, None]
+        for i, gap in enumerate(gaps, start=1):
+            starts = self.match_segment(segments[i])
+            ends = rows[:, -1] + len(segments[i - 1])
+            low = np.searchsorted(starts, ends + gap.min_len, side="left")
+            high = np.searchsorted(starts, ends + gap.max_len, side="right")
+            counts = high - low
+            row_idxes = np.repeat(np.arange(len(rows)), counts)
+            first_idxes = np.repeat(np.cumsum(counts) - counts, counts)
+            next_starts = starts[low[row_idxes] + np.arange(len(row_idxes)) - first_idxes]
+            same_sent = (next_starts >> token_bits) == (rows[row_idxes, 0] >> token_bits)
+            rows = np.column_stack([rows[row_idxes], next_starts])[same_sent]
+        _, first_rows = np.unique(rows[:, 0], return_index=True)
+        matches = []
+        for row in rows[first_rows[:limit]]:
+            token_ids, labels = [], []
+            for start, segment in zip(row, segments):
+                for offset, item in enumerate(segment):
+                    token_ids.append(int(start & token_mask) + offset)
+                    labels.append(item.label if item is not None else "_")
+            matches.append((int(row[0] >> token_bits), tuple(token_ids), labels))
+        return len(first_rows), matches
+
+    def match_segment(self, segment):
+        # the keys of the first tokens of the matches of a gapless segment
+        starts = None
+        for offset, item in enumerate(segment):
+            if item is None:
+                continue
+            keys = self.match_term(item)
+            keys = keys[(keys & token_mask) >= offset] - offset
+            starts = keys if starts is None else np.intersect1d(starts, keys, assume_unique=True)
+        # the whole segment has to fit in the sentence
+        fits = (starts & token_mask) + len(segment) <= self.sent_lengths[starts >> token_bits]
+        return starts[fits]
+
+    def search_arc(self, dependent, head, deprel=None, limit=100):
+        dep_keys = self.match_term(dependent)
+        if deprel:
+            dep_keys = np.intersect1d(dep_keys, self.get_postings("deprel", deprel), assume_unique=True)
+        head_ids = self.heads[np.searchsorted(self.keys, dep_keys)].astype(np.int64)
+        head_keys = (dep_keys & ~token_mask) | head_ids
+        is_match = (head_keys != dep_keys) & np.isin(head_keys, self.match_term(head))
+        dep_keys, head_keys = dep_keys[is_match], head_keys[is_match]
+        matches = []
+        for dep_key, head_key in zip(dep_keys[:limit], head_keys[:limit]):
+            ids_n_labels = sorted([(int(dep_key & token_mask), dependent.label),
+                                   (int(head_key & token_mask), head.label)])
+            matches.append((int(dep_key >> token_bits), tuple(i for i, _ in ids_n_labels),
+                            [label for _, label in ids_n_labels]))
+        return len(dep_keys), matches
+
+
+def concordance(manager, matches, context=None):
+    """The matches of CorpusIndex.search() as concordance lines in the format of DBManager.query_pattern()."""
+    sent_idx_to_tokens = manager.get_sentence_tokens({sent_idx for sent_idx, _, _ in matches})
+    data = []
+    for sent_idx, token_ids, labels in matches:
+        id_to_label = dict(zip(token_ids, labels))
+        texts_n_labels = []
+        for token in sent_idx_to_tokens.get(sent_idx, []):
+            if context is not None and not min(token_ids) - context <= token.id <= max(token_ids) + context:
+                continue
+            texts_n_labels.append((token.text, id_to_label.get(token.id)))
+        data.append({"sent_idx": sent_idx, "token_ids": token_ids, "tokens": texts_n_labels})
+    return data
+
+
+if __name__ == "__main__":
+    manager = db_manager.DBManager(sys.argv[1])
+    index = CorpusIndex.open(manager)
+    n_matches, matches = index.search(sys.argv[2], limit=int(sys.argv[3]) if len(sys.argv) > 3 else 20)
+    for line in concordance(manager, matches):
+        print(" ".join(f"[{text}]" if label else text for text, label in line['tokens']))
+    print(n_matches, "matches")
@@ -1,10 +1,15 @@
 import std/db_sqlite
+from sqlite3 import nil # qualified only; its close() clashes with db_sqlite
+import macros
 import strformat, strutils
 import sequtils
 import tables
 import jsony
 import json
 import std/enumerate
+import os, times
+import streams
+import std/memfiles
 
 
 type TokenType* = enum
@@ -21,32 +26,33 @@ proc toTokenType*(str: string): TokenType =
     else: ttNil
 
 # almost every custom type should be a ref object to simulate Python behavior
+# a token only holds the ids of its values in the vocabulary of its corpus; strings come from there
 type Token* = ref object
     id*: int
-    text*: string
-    lemma*: string
-    upos*: string
-    xpos*: string
-    deprel*: string
     head_id*: int
-    supersense*: string
     chosen_type*: TokenType
     skipped*: bool
+    value_ids*: array[TokenType, int] # of every layer; ttNil is the lemma and ttText the lower-cased text
+    text_id*: int # of the text as written
 
-proc getText*(self: Token, token_type: TokenType): string =
-    case token_type:
-    of ttNil: self.lemma
-    of ttLemma: self.lemma
-    of ttUpos: self.upos
-    of ttXpos: self.xpos
-    of ttDeprel: self.deprel
-    of ttSupersense: self.supersense
-    of ttText: self.text.toLower()
+proc getValueId*(self: Token, token_type: TokenType): int {.inline.} =
+    self.value_ids[token_type]
 
 
+# a token as annotated in corpus.json
+type JsonToken = object
+    id: int
+    text: string
+    lemma: string
+    upos: string
+    xpos: string
+    deprel: string
+    head_id: int
+    supersense: string
+
 type JsonSent = object
     file_name: string
-    tokens: seq[Token]
+    tokens: seq[JsonToken]
 
 
 type JsonSents = seq[JsonSent]
@@ -60,37 +66,354 @@ type Sentence* = ref object
     token_id_to_merge_idx*: Table[int, int]
 
 
+# layer values are interned to dense ids so that mining works on integers only
+type Vocabulary* = ref object
+    value_to_id*: Table[string, int]
+    values*: seq[string]
+
+proc intern*(self: Vocabulary, value: string): int =
+    result = self.value_to_id.getOrDefault(value, -1)
+    if result == -1:
+        result = self.values.len
+        self.value_to_id[value] = result
+        self.values.add(value)
+
+proc lookup*(self: Vocabulary, value: string): int {.inline.} =
+    ## the id of value, or -1 if it has never been interned
+    self.value_to_id.getOrDefault(value, -1)
+
+proc `[]`*(self: Vocabulary, id: int): string {.inline.} =
+    self.values[id]
+
+proc getText*(self: Token, vocab: Vocabulary, token_type: TokenType): string {.inline.} =
+    vocab[self.value_ids[token_type]]
+
+proc getRawText*(self: Token, vocab: Vocabulary): string {.inline.} =
+    vocab[self.text_id]
+
+
 type Corpus* = ref object
     sentences*: seq[Sentence]
     total_token_count*: int
+    vocab*: Vocabulary
+
+
+proc addSentence(self: Corpus, j_sent: JsonSent) =
+    var sentence = Sentence(id: self.sentences.len, file_name: j_sent.file_name)
+    var vocab = self.vocab
+    for j_token in j_sent.tokens:
+        var token = Token(id: j_token.id, head_id: j_token.head_id)
+        var lemma_id = vocab.intern(j_token.lemma)
+        token.value_ids[ttNil] = lemma_id
+        token.value_ids[ttLemma] = lemma_id
+        token.value_ids[ttUpos] = vocab.intern(j_token.upos)
+        token.value_ids[ttXpos] = vocab.intern(j_token.xpos)
+        token.value_ids[ttDeprel] = vocab.intern(j_token.deprel)
+        token.value_ids[ttText] = vocab.intern(j_token.text.toLower())
+        token.value_ids[ttSupersense] = vocab.intern(j_token.supersense)
+        token.text_id = vocab.intern(j_token.text)
+        sentence.tokens.add(token)
+    self.sentences.add(sentence)
+    self.total_token_count += sentence.tokens.len
 
+proc appendSentences*(self: Corpus, other: Corpus) =
+    ## add the sentences of another corpus after those of this one, interning their values anew
+    for sentence in other.sentences:
+        sentence.id = self.sentences.len
+        for token in sentence.tokens:
+            for token_type in TokenType:
+                token.value_ids[token_type] = self.vocab.intern(other.vocab[token.value_ids[token_type]])
+            token.text_id = self.vocab.intern(other.vocab[token.text_id])
+        self.sentences.add(sentence)
+        self.total_token_count += sentence.tokens.len
+
+proc isJsonLines(json_path: string): bool =
+    ## a JSON array starts with "[", JSON Lines with the "{" of the first sentence
+    var file = system.open(json_path)
+    defer: file.close()
+    var c: char
+    while file.readBuffer(addr c, 1) == 1:
+        if c notin Whitespace:
+            return c == '{'
+    return false
 
 proc loadJson*(json_path: string): Corpus =
-    result = Corpus() # ref objects need to be initialized first
+    ## load a JSON array of sentences, or JSON Lines with one sentence per line
+    result = Corpus(vocab: Vocabulary()) # ref objects need to be initialized first
+    if json_path.isJsonLines():
+        for line in lines(json_path):
+            if line.strip().len > 0:
+                result.addSentence(line.fromJson(JsonSent))
+        return
     let all_sents = readFile(json_path).fromJson(JsonSents)
-    for sent_idx, j_sent in enumerate(all_sents):
-        var sentence = Sentence(id: sent_idx, tokens: j_sent.tokens, file_name: j_sent.file_name)
+    for j_sent in all_sents:
+        result.addSentence(j_sent)
+
+
+# Binary corpus: a pool of unique strings followed by int32 columns of pool ids
+#   magic | n_sents, n_tokens, n_values: int64 | value offsets: int64[n_values + 1] | value bytes
+#   | padding to 8 bytes | sentence token offsets: int64[n_sents + 1] | file name ids: int32[n_sents]
+#   | token columns: int32[n_tokens] each, in the order of binary_columns
+const binary_magic = "CXCORP01"
+const binary_columns = ["id", "head_id", "text", "lemma", "upos", "xpos", "deprel", "supersense"]
+
+proc writeColumn[T](stream: Stream, column: seq[T]) =
+    if column.len > 0:
+        stream.writeData(unsafeAddr column[0], column.len * sizeof(T))
+
+proc writeBinary*(self: Corpus, bin_path: string) =
+    var pool = Vocabulary()
+    var sent_token_offsets: seq[int64] = @[0'i64]
+    var file_name_ids: seq[int32]
+    var columns: array[binary_columns.len, seq[int32]]
+    for sentence in self.sentences:
+        file_name_ids.add(int32(pool.intern(sentence.file_name)))
+        for token in sentence.tokens:
+            columns[0].add(int32(token.id))
+            columns[1].add(int32(token.head_id))
+            columns[2].add(int32(pool.intern(self.vocab[token.text_id])))
+            for i, token_type in [ttLemma, ttUpos, ttXpos, ttDeprel, ttSupersense]:
+                columns[i + 3].add(int32(pool.intern(self.vocab[token.value_ids[token_type]])))
+        sent_token_offsets.add(int64(columns[0].len))
+
+    var stream = newFileStream(bin_path, fmWrite)
+    if stream == nil:
+        raise newException(IOError, fmt"cannot open {bin_path} for writing")
+    defer: stream.close()
+    stream.write(binary_magic)
+    stream.write(int64(self.sentences.len))
+    stream.write(int64(columns[0].len))
+    stream.write(int64(pool.values.len))
+    var offset = 0'i64
+    stream.write(offset)
+    for value in pool.values:
+        offset += value.len
+        stream.write(offset)
+    for value in pool.values:
+        stream.write(value)
+    while offset mod 8 != 0:
+        stream.write(0'u8)
+        offset += 1
+    stream.writeColumn(sent_token_offsets)
+    stream.writeColumn(file_name_ids)
+    for column in columns:
+        stream.writeColumn(column)
+
+proc binarySentenceCount*(bin_path: string): int =
+    var stream = newFileStream(bin_path, fmRead)
+    if stream == nil:
+        raise newException(IOError, fmt"cannot open {bin_path}")
+    defer: stream.close()
+    if stream.readStr(binary_magic.len) != binary_magic:
+        raise newException(ValueError, fmt"{bin_path} is not a binary corpus")
+    int(stream.readInt64())
+
+proc loadBinary*(bin_path: string, first: int = 0, last: int = -1): Corpus =
+    ## load a corpus written by writeBinary() without parsing JSON: the file is read through a memory map
+    ## and copied into tokens, whose value ids are the pool ids, so loading still takes time and memory in
+    ## proportion to the corpus; the pool becomes the vocabulary.
+    ## With last >= 0 only the sentences first ..< last are loaded, with ids from 0, and the lower-cased
+    ## texts of all pool values are interned first, so that every range of a corpus gets the same vocabulary
+    var mf = memfiles.open(bin_path)
+    defer: mf.close()
+    var data = cast[ptr UncheckedArray[byte]](mf.mem)
+    # every offset and id read from the file is checked before it is used
+    template check(condition: bool) =
+        if not condition:
+            raise newException(ValueError, fmt"{bin_path} is a truncated or corrupt binary corpus")
+    if mf.size < 32:
+        raise newException(ValueError, fmt"{bin_path} is not a binary corpus")
+    var magic = newString(binary_magic.len)
+    copyMem(addr magic[0], addr data[0], binary_magic.len)
+    if magic != binary_magic:
+        raise newException(ValueError, fmt"{bin_path} is not a binary corpus")
+    var header = cast[ptr UncheckedArray[int64]](addr data[8])
+    var n_sents = int(header[0])
+    var n_tokens = int(header[1])
+    var n_values = int(header[2])
+    check(n_sents >= 0 and n_tokens >= 0 and n_values >= 0 and n_values < mf.size div sizeof(int64))
+    var value_offsets = cast[ptr UncheckedArray[int64]](addr data[32])
+    var pool_start = 32 + (n_values + 1) * sizeof(int64)
+    check(pool_start <= mf.size and value_offsets[0] == 0)
+
+    result = Corpus(vocab: Vocabulary())
+    for i in 0 ..< n_values:
+        check(value_offsets[i + 1] >= value_offsets[i] and int(value_offsets[i + 1]) <= mf.size - pool_start)
+        var length = int(value_offsets[i + 1] - value_offsets[i])
+        var value = newString(length)
+        if length > 0:
+            copyMem(addr value[0], addr data[pool_start + int(value_offsets[i])], length)
+        discard result.vocab.intern(value) # == i, as the pool holds unique values
+    var pos = pool_start + int(value_offsets[n_values])
+    pos = (pos + 7) and not 7
+    check(n_sents < mf.size div sizeof(int64) and n_tokens < mf.size div sizeof(int32) and
+          pos + (n_sents + 1) * sizeof(int64) + n_sents * sizeof(int32) +
+          binary_columns.len * n_tokens * sizeof(int32) <= mf.size)
+    var sent_token_offsets = cast[ptr UncheckedArray[int64]](addr data[pos])
+    pos += (n_sents + 1) * sizeof(int64)
+    var file_name_ids = cast[ptr UncheckedArray[int32]](addr data[pos])
+    pos += n_sents * sizeof(int32)
+    var columns: array[binary_columns.len, ptr UncheckedArray[int32]]
+    for i in 0 ..< binary_columns.len:
+        columns[i] = cast[ptr UncheckedArray[int32]](addr data[pos + i * n_tokens * sizeof(int32)])
+
+    var vocab = result.vocab
+    var lower_text_ids = newSeq[int](n_values) # getText(ttText) is lower-cased
+    for i in 0 ..< n_values:
+        lower_text_ids[i] = if last >= 0: vocab.intern(vocab[i].toLower()) else: -1
+    var first = min(first, n_sents)
+    var last = if last >= 0: min(last, n_sents) else: n_sents
+    for sent_idx in first ..< last:
+        var sent_first = int(sent_token_offsets[sent_idx])
+        var sent_last = int(sent_token_offsets[sent_idx + 1])
+        check(sent_first >= 0 and sent_first <= sent_last and sent_last <= n_tokens)
+        check(file_name_ids[sent_idx] >= 0 and int(file_name_ids[sent_idx]) < n_values)
+        var sentence = Sentence(id: sent_idx - first, file_name: vocab[file_name_ids[sent_idx]])
+        for t in sent_first ..< sent_last:
+            for c in 0 .. 1: # token and head ids index the tokens of the sentence
+                check(columns[c][t] >= 0 and int(columns[c][t]) < sent_last - sent_first)
+            for c in 2 ..< binary_columns.len:
+                check(columns[c][t] >= 0 and int(columns[c][t]) < n_values)
+            var text_id = int(columns[2][t])
+            var token = Token(id: int(columns[0][t]), head_id: int(columns[1][t]), text_id: text_id)
+            if lower_text_ids[text_id] == -1:
+                lower_text_ids[text_id] = vocab.intern(vocab[text_id].toLower())
+            token.value_ids[ttNil] = int(columns[3][t])
+            token.value_ids[ttLemma] = int(columns[3][t])
+            token.value_ids[ttUpos] = int(columns[4][t])
+            token.value_ids[ttXpos] = int(columns[5][t])
+            token.value_ids[ttDeprel] = int(columns[6][t])
+            token.value_ids[ttText] = lower_text_ids[text_id]
+            token.value_ids[ttSupersense] = int(columns[7][t])
+            sentence.tokens.add(token)
         result.sentences.add(sentence)
         result.total_token_count += sentence.tokens.len
 
+proc loadCorpus*(json_path: string): Corpus =
+    ## load the binary copy of json_path (same name, .bin) if it is up to date, else the JSON
+    var bin_path = json_path.changeFileExt("bin")
+    if fileExists(bin_path) and getLastModificationTime(bin_path) >= getLastModificationTime(json_path):
+        return loadBinary(bin_path)
+    loadJson(json_path)
+
 
 proc getDatabase*(db_path: string): DbConn =
     # var db_path = output_folder & "db.sqlite3"
     result = open(db_path, "", "", "")
+    # WAL lets the web interface read while mining writes; NORMAL is durable enough with WAL
+    discard result.getValue(sql"PRAGMA journal_mode=WAL")
+    result.exec(sql"PRAGMA synchronous=NORMAL")
+    # concurrent mining jobs of a project wait for each other's writes instead of failing
+    discard result.getValue(sql"PRAGMA busy_timeout=600000")
+
+
+# prepared statements that are bound and stepped directly, for bulk inserts
+type BulkStatement* = object
+    db: DbConn
+    stmt: sqlite3.Pstmt
+
+proc prepareBulk*(db: DbConn, query: string): BulkStatement =
+    result.db = db
+    if sqlite3.prepare_v2(db, query.cstring, query.len.cint, result.stmt, nil) != sqlite3.SQLITE_OK:
+        dbError(db)
+
+proc finalize*(self: BulkStatement) =
+    discard sqlite3.finalize(self.stmt)
+
+proc bindArg*(self: BulkStatement, idx: int, value: int | int64 | int32) =
+    discard sqlite3.bind_int64(self.stmt, idx.int32, value.int64)
+
+proc bindArg*(self: BulkStatement, idx: int, value: float64) =
+    discard sqlite3.bind_double(self.stmt, idx.int32, value)
+
+proc bindArg*(self: BulkStatement, idx: int, value: string) =
+    discard sqlite3.bind_text(self.stmt, idx.int32, value.cstring, value.len.int32, sqlite3.SQLITE_TRANSIENT)
+
+proc bindArg*(self: BulkStatement, idx: int, value: typeof(nil)) =
+    discard sqlite3.bind_null(self.stmt, idx.int32)
 
-proc storeTokensInDatabase*(corpus: Corpus, db_path: string) =
+proc bindArg*(self: BulkStatement, idx: int, value: seq[byte]) =
+    var data: pointer = if value.len > 0: unsafeAddr value[0] else: nil
+    discard sqlite3.bind_blob(self.stmt, idx.int32, data, value.len.int32, sqlite3.SQLITE_TRANSIENT)
+
+proc lastInsertId*(self: BulkStatement): int64 =
+    sqlite3.last_insert_rowid(self.db)
+
+proc stepBulk*(self: BulkStatement) =
+    var status = sqlite3.step(self.stmt)
+    discard sqlite3.reset(self.stmt)
+    if status != sqlite3.SQLITE_DONE:
+        dbError(self.db)
+
+macro execBulk*(self: BulkStatement, args: varargs[untyped]): untyped =
+    ## bind args to the "?" parameters in order and run the statement once
+    result = newStmtList()
+    for i, arg in args:
+        result.add(newCall(ident"bindArg", self, newLit(i + 1), arg))
+    result.add(newCall(ident"stepBulk", self))
+
+proc encodeTokenIds*(token_ids: seq[int]): seq[byte] =
+    ## token ids as little-endian uint16, decoded by db_manager.decode_token_ids()
+    result = newSeq[byte](token_ids.len * 2)
+    for i, token_id in token_ids:
+        if token_id < 0 or token_id > 0xffff:
+            raise newException(ValueError, fmt"token id {token_id} does not fit in a uint16")
+        result[2 * i] = byte(token_id and 0xff)
+        result[2 * i + 1] = byte((token_id shr 8) and 0xff)
+
+proc dropIndexes*(db: DbConn, table_name: string): seq[string] =
+    ## drop the indexes of a table before a bulk insert; returns the SQL to recreate them
+    var rows = db.getAllRows(
+        sql"SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+        table_name)
+    for row in rows:
+        db.exec(sql(fmt"DROP INDEX IF EXISTS {row[0]}"))
+        result.add(row[1].replace("CREATE INDEX ", "CREATE INDEX IF NOT EXISTS "))
+
+proc restoreIndexes*(db: DbConn, index_sqls: seq[string]) =
+    for index_sql in index_sqls:
+        db.exec(sql(index_sql))
+
+proc hasRows*(db: DbConn, table_name: string): bool =
+    db.getValue(sql(fmt"SELECT EXISTS (SELECT 1 FROM {table_name})")) == "1"
+
+proc storeTokensInDatabase*(corpus: Corpus, db_path: string, id_offset: int = 0) =
+    ## store the sentences the database does not hold yet: the whole corpus is stored by the first task of a
+    ## project, and sentences appended later (see appendCorpus()) by the next task or append; id_offset is
+    ## added to the ids of the sentences of a range of the corpus (see loadBinary())
     var db = getDatabase(db_path)
+    defer: db.close()
+    # IMMEDIATE takes the write lock before the check, so concurrent tasks store the tokens once
+    db.exec(sql"BEGIN IMMEDIATE;")
+    var first_sent_idx = parseInt(db.getValue(sql"SELECT count(*) FROM sentence")) - id_offset
+    if first_sent_idx < 0:
+        db.exec(sql"ROLLBACK;")
+        raise newException(ValueError, fmt"the database holds {first_sent_idx + id_offset} sentences, " &
+                           fmt"so sentences {id_offset} on cannot follow them")
+    if first_sent_idx >= corpus.sentences.len:
+        db.exec(sql"COMMIT;")
+        return
+    # rebuilding the indexes only pays off when the table is filled from scratch
+    var index_sqls = if id_offset + first_sent_idx == 0: db.dropIndexes("token") else: newSeq[string]()
+    var vocab = corpus.vocab
+    var insert_sentence = db.prepareBulk("INSERT INTO sentence (id, file_name) VALUES (?, ?)")
+    var insert_token = db.prepareBulk("INSERT INTO token (id, sentence_id, text, lemma, upos, xpos, deprel, supersense, head_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)")
     try:
-        db.exec(sql"BEGIN TRANSACTION;")
-        for sentence in corpus.sentences:
-            db.exec(sql"INSERT INTO sentence (id, file_name) VALUES (?,?);", sentence.id, sentence.file_name)
+        for sentence in corpus.sentences[first_sent_idx .. ^1]:
+            insert_sentence.execBulk(id_offset + sentence.id, sentence.file_name)
             for token in sentence.tokens:
-                var cmd = sql"INSERT INTO token (id, sentence_id, text, lemma, upos, xpos, deprel, supersense, head_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
-                db.exec(cmd, token.id, sentence.id, token.text, token.lemma, token.upos, token.xpos, token.deprel, token.supersense, token.head_id)
+                insert_token.execBulk(token.id, id_offset + sentence.id, token.getRawText(vocab),
+                                      token.getText(vocab, ttLemma), token.getText(vocab, ttUpos),
+                                      token.getText(vocab, ttXpos), token.getText(vocab, ttDeprel),
+                                      token.getText(vocab, ttSupersense), token.head_id)
+        db.restoreIndexes(index_sqls)
         db.exec(sql"COMMIT;")
     except:
-        db.close()
+        db.exec(sql"ROLLBACK;") # also brings back the dropped indexes
         raise
+    finally:
+        insert_sentence.finalize()
+        insert_token.finalize()
 
 proc getTableCreationSQL(table_name: string, row: JsonNode): string =
     var table_info = ""
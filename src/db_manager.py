@@ -1,7 +1,9 @@
 import os
 import sys
 import json
+import struct
 import datetime
+from typing import Optional
 from collections import defaultdict, Counter
 import sqlmodel
 from sqlmodel import Field, Session, SQLModel, create_engine, select
@@ -24,8 +26,61 @@ class Pattern(SQLModel, table=True):
     right: str  # the right component of the form
     count: int
     score: float
+    # the inputs of score, for rescoring under other measures (see rescore_patterns()); None in older projects
+    left_count: Optional[int] = None
+    right_count: Optional[int] = None
+    total_token_count: Optional[int] = None
     task_id: int = Field(index=True, foreign_key=Task.id)
 
+    # the Explore grid sorts and pages patterns of one task by these columns; the component graph looks up
+    # the components of patterns by form (see storeComponentGraph() in mining.nim)
+    __table_args__ = (
+        sqlmodel.Index("ix_pattern_task_id_score", "task_id", "score"),
+        sqlmodel.Index("ix_pattern_task_id_count", "task_id", "count"),
+        sqlmodel.Index("ix_pattern_task_id_form", "task_id", "form"),
+    )
+
+
+class PatternEdge(SQLModel, table=True):
+    # an edge of the component graph of a task, from the left or right component of a merged pattern to the
+    # pattern; written by the miner when mining ends, with source_id set if the component is a merged pattern too
+    id: int = Field(primary_key=True)
+    task_id: int = Field(foreign_key=Task.id)
+    source: str
+    source_id: Optional[int] = None
+    target: str
+    target_id: int = Field(foreign_key=Pattern.id)
+    side: int  # 0 for left, 1 for right
+    count: int  # of the target pattern
+    score: float
+
+    # get_component_graph() follows the best edges out of a node and all edges into it
+    __table_args__ = (
+        sqlmodel.Index("ix_patternedge_task_id_source_score", "task_id", "source", "score"),
+        sqlmodel.Index("ix_patternedge_task_id_target", "task_id", "target"),
+    )
+
+
+class TaskRound(SQLModel, table=True):
+    # telemetry of a mining round, written by the miner; times are in seconds
+    id: int = Field(primary_key=True)
+    task_id: int = Field(index=True, foreign_key=Task.id)
+    round: int
+    total_time: float
+    reindex_time: float
+    scoring_time: float
+    sorting_time: float
+    merging_time: float
+    db_time: float
+    n_affected_sents: int
+    n_candidates: int
+    n_discarded: int
+    n_merged: int
+    remaining_tokens: int
+    peak_rss_mb: float
+
+    __table_args__ = (sqlmodel.UniqueConstraint("task_id", "round"),)
+
 
 class Sentence(SQLModel, table=True):
     id: int = Field(primary_key=True, index=True)
@@ -36,9 +91,40 @@ class Position(SQLModel, table=True):
     id: int = Field(primary_key=True)
     pattern_id: int = Field(index=True, foreign_key=Pattern.id)
     sentence_id: int = Field(index=True)
+    # a blob of little-endian uint16s (comma-separated text in older projects); declared as str so that
+    # SQLAlchemy hands both over unconverted to decode_token_ids()
     token_ids: str
 
 
+class SlotFiller(SQLModel, table=True):
+    # the most frequent texts filling a slot (label) of a pattern, stored at mining time
+    id: int = Field(primary_key=True)
+    pattern_id: int = Field(index=True, foreign_key=Pattern.id)
+    label: str
+    text: str
+    count: int
+    slot_total: int  # number of fillers of the slot, for percentages
+
+
+class Job(SQLModel, table=True):
+    # a mining task run in the background by jobs.JobQueue; round, n_merged and remaining_tokens are
+    # updated by the miner after each round
+    id: int = Field(primary_key=True, index=True)
+    name: str
+    config: str
+    status: str = "queued"  # queued, running, cancelling, cancelled, done or failed
+    task_id: Optional[int] = Field(default=None, foreign_key=Task.id)
+    n_rounds: int
+    round: int = 0
+    n_merged: int = 0
+    remaining_tokens: int = 0
+    pid: Optional[int] = None
+    error: Optional[str] = None
+    time_added: datetime.datetime = Field(sa_column=sqlmodel.Column(sqlmodel.DateTime(timezone=True), nullable=True))
+    time_started: datetime.datetime = Field(sa_column=sqlmodel.Column(sqlmodel.DateTime(timezone=True), nullable=True))
+    time_finished: datetime.datetime = Field(sa_column=sqlmodel.Column(sqlmodel.DateTime(timezone=True), nullable=True))
+
+
 class Token(SQLModel, table=True):
     id: int = Field(primary_key=True)
     sentence_id: int = Field(primary_key=True, index=True)
@@ -51,6 +137,18 @@ class Token(SQLModel, table=True):
     supersense: str
 
 
+def decode_token_ids(token_ids):
+    if isinstance(token_ids, str):
+        return tuple(int(i) for i in token_ids.split(","))
+    return struct.unpack(f"<{len(token_ids) // 2}H", token_ids)
+
+
+# the most concordance lines a page of query_pattern() holds
+max_concordance_lines = 1000
+# below the default SQLITE_MAX_VARIABLE_NUMBER of older sqlite versions (999)
+max_sql_variables = 900
+
+
 class DBManager:
     def __init__(self, db_path) -> None:
         self.db_path = db_path
@@ -60,11 +158,18 @@ class DBManager:
     def set_engine(self):
         if self.engine:
             self.engine.dispose()
-        self.engine = create_engine(f"sqlite:///{self.db_path}")
+        # the server shares one manager between sessions, which run in different threads; writes wait for
+        # those of running mining jobs
+        self.engine = create_engine(f"sqlite:///{self.db_path}",
+                                    connect_args={"check_same_thread": False, "timeout": 60})
 
     def create_database(self, on_exist="fail"):
         if os.path.exists(self.db_path):
             if on_exist == "ignore":
+                SQLModel.metadata.create_all(self.engine)  # only adds tables missing from older projects
+                self.add_missing_columns()
+                for index in Pattern.__table__.indexes:
+                    index.create(self.engine, checkfirst=True)
                 return
             elif on_exist == "fail":
                 print("Database already exists.")
@@ -73,6 +178,18 @@ class DBManager:
                 os.remove(self.db_path)
         SQLModel.metadata.create_all(self.engine)
 
+    def add_missing_columns(self):
+        # nullable columns added to the models since a project was created
+        inspector = sqlmodel.inspect(self.engine)
+        with self.engine.begin() as connection:
+            for table in SQLModel.metadata.sorted_tables:
+                existing = {column["name"] for column in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name not in existing and column.nullable:
+                        column_type = column.type.compile(dialect=self.engine.dialect)
+                        connection.exec_driver_sql(
+                            f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}')
+
     def new_task(self, name, config):
         with Session(self.engine) as session:
             task = Task(name=name, config=json.dumps(config), 
@@ -81,43 +198,90 @@ class DBManager:
             session.commit()
             return task.id
 
+    def new_job(self, name, config):
+        with Session(self.engine) as session:
+            job = Job(name=name, config=json.dumps(config), n_rounds=config.get("n_total_rounds", 100),
+                      time_added=datetime.datetime.now())
+            session.add(job)
+            session.commit()
+            return job.id
+
+    def get_job(self, job_id):
+        with Session(self.engine) as session:
+            job = session.get(Job, job_id)
+            return job.dict() if job else None
+
+    def get_jobs(self, statuses=None):
+        with Session(self.engine) as session:
+            query = select(Job).order_by(Job.id.desc())
+            if statuses:
+                query = query.where(Job.status.in_(statuses))
+            return [job.dict() for job in session.exec(query)]
+
+    def update_job(self, job_id, statuses=None, **values):
+        # if statuses are given, only a job in one of them is updated; returns whether the job was updated
+        statement = sqlmodel.update(Job).where(Job.id == job_id).values(**values)
+        if statuses:
+            statement = statement.where(Job.status.in_(statuses))
+        with Session(self.engine) as session:
+            n_updated = session.execute(statement).rowcount
+            session.commit()
+        return n_updated > 0
+
+    def get_task(self, task_id):
+        with Session(self.engine) as session:
+            task = session.get(Task, task_id)
+            return task.dict() if task else None
+
     def get_all_tasks(self):
         with Session(self.engine) as session:
             query = session.query(Task)
             return [dict(task) for task in query.all()]
 
-    def query_pattern(self, pattern, limit=None):
-        # using sqlmodel, select all rows from table "position" where pattern_id = (the id from the table pattern where form = pattern)
+    def get_task_rounds(self, task_id):
+        with Session(self.engine) as session:
+            query = select(TaskRound).where(TaskRound.task_id == task_id).order_by(TaskRound.round)
+            values = [task_round.dict() for task_round in session.exec(query)]
+        return pd.DataFrame(values, columns=list(TaskRound.__fields__)).drop(["id", "task_id"], axis=1)
+
+    def get_pattern_ids(self, session, pattern, task_id=None):
+        statement = select(Pattern.id).where(Pattern.form == pattern)
+        if task_id is not None:
+            statement = statement.where(Pattern.task_id == task_id)
+        return list(session.exec(statement))
+
+    def query_pattern(self, pattern, limit=100, task_id=None, offset=0, after=None, context=None):
+        """Returns a page of concordance lines of a pattern.
+
+        Positions are ordered by id; a page starts after the position id `after` (keyset) or at
+        `offset` and holds at most `limit` lines (up to max_concordance_lines). `context` limits each
+        line to that many tokens around the match.
+        """
+        limit = max_concordance_lines if limit is None else min(limit, max_concordance_lines)
         parts = pattern.split("~")
         with Session(self.engine) as session:
-            statement = (select(Token, Position)
-                         .where(Position.pattern_id == Pattern.id)
-                         .where(Pattern.form == pattern)
-                         .where(Token.sentence_id == Position.sentence_id))
-            sent_idx_to_tokens = defaultdict(list)
-            # print(session.exec(statement).all())
-            for token, pos in session.exec(statement):
-                # if token.sentence_id not in sent_idx_to_token_ids:  # avoid repeated effort
-                token_ids = tuple(int(i) for i in pos.token_ids.split(","))
-                pos_ids = (token.sentence_id,) + token_ids
-                sent_idx_to_tokens[pos_ids].append(token)
+            pattern_ids = self.get_pattern_ids(session, pattern, task_id)
+            statement = select(Position).where(Position.pattern_id.in_(pattern_ids)).order_by(Position.id)
+            if after is not None:
+                statement = statement.where(Position.id > after)
+            elif offset:
+                statement = statement.offset(offset)
+            statement = statement.limit(limit)
+            positions = [(pos.id, pos.sentence_id, decode_token_ids(pos.token_ids))
+                         for pos in session.exec(statement)]
+        # only the sentences on this page; the context window is cut below
+        sent_idx_to_tokens = self.get_sentence_tokens({sent_idx for _, sent_idx, _ in positions})
         results = {}
         results['data'] = []
-        label_to_text = defaultdict(Counter)
-        for pos_ids, tokens in sent_idx_to_tokens.items():
-            sent_idx, token_ids = pos_ids[0], pos_ids[1:]
-            # token_ids = sent_idx_to_token_ids[sent_idx]
+        for pos_id, sent_idx, token_ids in positions:
             texts_n_labels = []
             match_idx = 0
-            for token in tokens:
-                if token.id in token_ids:
-                    try:
-                        label = parts[match_idx]
-                        text_n_label = (token.text, label)
-                        label_to_text[label][token.text.lower()] += 1
-                        match_idx += 1
-                    except:
-                        break
+            for token in sent_idx_to_tokens[sent_idx]:
+                if context is not None and not min(token_ids) - context <= token.id <= max(token_ids) + context:
+                    continue  # the window of another match in the same sentence
+                if token.id in token_ids and match_idx < len(parts):
+                    text_n_label = (token.text, parts[match_idx])
+                    match_idx += 1
                 else:
                     text_n_label = (token.text, None)
                 texts_n_labels.append(text_n_label)
@@ -127,23 +291,79 @@ class DBManager:
                 "tokens": texts_n_labels,
             }
             results['data'].append(rs)
+        # keyset for the next page
+        results['next_after'] = positions[-1][0] if positions else None
+        return results
+
+    def count_positions(self, pattern, task_id=None):
+        with Session(self.engine) as session:
+            pattern_ids = self.get_pattern_ids(session, pattern, task_id)
+            statement = select(sqlmodel.func.count(Position.id)).where(Position.pattern_id.in_(pattern_ids))
+            return session.exec(statement).one()
+
+    def get_token_frame(self):
+        # the whole token table in corpus order, for corpus_search.CorpusIndex
+        columns = ["sentence_id", "id", "text", "lemma", "upos", "xpos", "head_id", "deprel", "supersense"]
+        with self.engine.connect() as connection:
+            rows = connection.exec_driver_sql(f"SELECT {', '.join(columns)} FROM token ORDER BY sentence_id, id")
+            return pd.DataFrame(rows.fetchall(), columns=columns)
+
+    def get_token_stamp(self):
+        # changes whenever tokens are stored or appended
+        with Session(self.engine) as session:
+            statement = select(sqlmodel.func.count(), sqlmodel.func.max(Token.sentence_id))
+            count, max_sentence_id = session.exec(statement).one()
+            return count, -1 if max_sentence_id is None else max_sentence_id
+
+    def get_sentence_tokens(self, sentence_ids):
+        sent_idx_to_tokens = defaultdict(list)
+        if not sentence_ids:
+            return sent_idx_to_tokens
+        sentence_ids = sorted(sentence_ids)
+        with Session(self.engine) as session:
+            # in chunks, as sqlite limits the number of variables of a statement
+            for i in range(0, len(sentence_ids), max_sql_variables):
+                statement = select(Token).where(Token.sentence_id.in_(sentence_ids[i:i + max_sql_variables]))
+                for token in session.exec(statement.order_by(Token.sentence_id, Token.id)):
+                    sent_idx_to_tokens[token.sentence_id].append(token)
+        return sent_idx_to_tokens
+
+    def query_token_stats(self, pattern, task_id=None):
+        # the 10 most frequent texts filling each slot of the pattern, over all of its positions
+        parts = pattern.split("~")
+        label_to_text = defaultdict(Counter)
+        label_to_total = Counter()
+        with Session(self.engine) as session:
+            pattern_ids = self.get_pattern_ids(session, pattern, task_id)
+            statement = select(SlotFiller).where(SlotFiller.pattern_id.in_(pattern_ids))
+            slot_totals = {}
+            for filler in session.exec(statement):
+                label_to_text[filler.label][filler.text] += filler.count
+                slot_totals[(filler.pattern_id, filler.label)] = filler.slot_total
+            for (_, label), slot_total in slot_totals.items():
+                label_to_total[label] += slot_total
+            # tasks mined before slot fillers were stored: count them from the positions
+            statement = (select(Token, Position)
+                         .where(Position.pattern_id.in_(pattern_ids))
+                         .where(Token.sentence_id == Position.sentence_id)
+                         .order_by(Position.id, Token.id))
+            for token, pos in ([] if label_to_text else session.exec(statement)):
+                token_ids = decode_token_ids(pos.token_ids)
+                if token.id in token_ids:
+                    match_idx = token_ids.index(token.id)
+                    if match_idx < len(parts):
+                        label_to_text[parts[match_idx]][token.text.lower()] += 1
+                        label_to_total[parts[match_idx]] += 1
         token_stats = {}
         # calculate the percenage of each text in each label
         for label, text_counter in label_to_text.items():
             token_stats[label] = {}
-            sum_count = sum(text_counter.values())
+            sum_count = label_to_total[label]
             for text, count in text_counter.most_common(10):
                 token_stats[label][text] = {"count": count, "percent": round(count / sum_count * 100, 2)}
-        results["token_stats"] = token_stats
-        return results
+        return token_stats
 
     def get_pattern_df(self, task_id=None, limit=None):
-        def transform_pattern_form(form):
-            parts = form.split("~")
-            for i, part in enumerate(parts):
-                if "." in part or (len(part) > 1 and all(c.isupper() for c in part)):
-                    parts[i] = "<" + part.lower() + ">"
-            return " ".join(parts)
         values = []
         with Session(self.engine) as session:
             query = session.query(Pattern)
@@ -153,11 +373,204 @@ class DBManager:
                 query = query.limit(limit)
             for pattern in query.all():
                 values.append(dict(pattern))
-        df = pd.DataFrame(values).drop(["_sa_instance_state", "id"], axis=1).reset_index()
-        df['form'] = df['form'].apply(transform_pattern_form)
-        df['index'] += 1
-        cols = ['index', 'form', 'left', 'right', 'count', 'score']
-        return df.reindex(columns=cols)
+        return patterns_to_df(values)
+
+    def get_pattern_page(self, task_id, page=0, page_size=100, sort_by="score", descending=True, **filters):
+        """Returns one page of the patterns of a task as a DataFrame.
+        Sorting, filtering and paging happen in SQL so only the visible rows are loaded."""
+        column = getattr(Pattern, sort_by)
+        order = [column.desc() if descending else column.asc(), Pattern.id]
+        query = select(Pattern).where(*pattern_conditions(task_id, **filters))
+        query = query.order_by(*order).offset(page * page_size).limit(page_size)
+        with Session(self.engine) as session:
+            values = [dict(pattern) for pattern in session.exec(query)]
+        return patterns_to_df(values, start=page * page_size)
+
+    def rescore_patterns(self, task_id, measure, min_score=None, max_score=None, **filters):
+        """Returns the patterns of a task as a DataFrame, scored under another association measure and ranked by it.
+        Scores are recomputed by the miner from the counts stored with each pattern, so patterns of tasks mined
+        before these were stored are left out. Score filters apply to the new scores."""
+        import mining
+        query = select(Pattern.form, Pattern.left, Pattern.right, Pattern.count, Pattern.left_count,
+                       Pattern.right_count, Pattern.total_token_count)
+        query = query.where(*pattern_conditions(task_id, **filters), Pattern.left_count != None)
+        with Session(self.engine) as session:
+            df = pd.DataFrame(session.exec(query).all(), columns=["form", "left", "right", "count", "left_count",
+                                                                  "right_count", "total_token_count"])
+        df['score'] = mining.score_patterns(measure, df['count'].tolist(), df['left_count'].tolist(),
+                                            df['right_count'].tolist(), df['total_token_count'].tolist())
+        if min_score is not None:
+            df = df[df['score'] >= min_score]
+        if max_score is not None:
+            df = df[df['score'] <= max_score]
+        # ties are ranked by form, as the miner ranks them
+        df = df.sort_values(['score', 'form'], ascending=[False, True], ignore_index=True)
+        return patterns_to_df(df.drop(["left_count", "right_count", "total_token_count"], axis=1).to_dict("records"))
+
+    def has_component_graph(self, task_id):
+        statement = select(PatternEdge.id).where(PatternEdge.task_id == task_id).limit(1)
+        with Session(self.engine) as session:
+            return session.exec(statement).first() is not None
+
+    def get_component_graph(self, task_id, node=None, depth=2, k=10, max_nodes=300):
+        """Returns a bounded subgraph of the component graph of a task as a DataFrame of edges (edge_columns).
+
+        Around node (a lemma, tag or pattern form, as stored or as displayed): the nodes within depth hops,
+        following in each hop the k best scored patterns built from each node and the components of each.
+        Without node: the k best scored patterns and their components. At most max_nodes nodes are reached, so
+        the cost depends on k, depth and max_nodes rather than on the size of the task."""
+        with self.engine.connect() as connection:
+            if node is None:
+                rows = connection.exec_driver_sql(
+                    f"SELECT {', '.join(edge_columns)} FROM patternedge WHERE task_id = ? AND target IN "
+                    "(SELECT form FROM pattern WHERE task_id = ? ORDER BY score DESC, id LIMIT ?) "
+                    "ORDER BY score DESC, target_id, side", (task_id, task_id, k)).fetchall()
+                return pd.DataFrame(rows, columns=edge_columns)
+            node = parse_pattern_form(node)
+            nodes, frontier, edges = {node}, [node], {}
+            for _ in range(depth):
+                next_frontier = []
+                for row in self.iter_edges_around(connection, task_id, frontier, k):
+                    edges.setdefault((row[0], row[1], row[2]), row)
+                    for form in row[:2]:
+                        if form not in nodes and len(nodes) < max_nodes:
+                            nodes.add(form)
+                            next_frontier.append(form)
+                if not next_frontier:
+                    break
+                frontier = next_frontier
+        rows = [row for row in edges.values() if row[0] in nodes and row[1] in nodes]
+        return pd.DataFrame(rows, columns=edge_columns).sort_values("score", ascending=False, ignore_index=True)
+
+    @staticmethod
+    def iter_edges_around(connection, task_id, nodes, k, batch_size=500):
+        # the k best scored edges out of each node and the edges into it (those of its components)
+        columns = ", ".join(edge_columns)
+        for start in range(0, len(nodes), batch_size):
+            batch = nodes[start:start + batch_size]
+            marks = ", ".join("?" * len(batch))
+            yield from connection.exec_driver_sql(
+                f"SELECT {columns} FROM (SELECT {columns}, ROW_NUMBER() OVER "
+                f"(PARTITION BY source ORDER BY score DESC, id) AS rank FROM patternedge "
+                f"WHERE task_id = ? AND source IN ({marks})) WHERE rank <= ? "
+                f"UNION ALL SELECT {columns} FROM patternedge WHERE task_id = ? AND target IN ({marks})",
+                (task_id, *batch, k, task_id, *batch)).fetchall()
+
+    def count_patterns(self, task_id, **filters):
+        query = select(sqlmodel.func.count(Pattern.id)).where(*pattern_conditions(task_id, **filters))
+        with Session(self.engine) as session:
+            return session.exec(query).one()
+
+    def iter_pattern_chunks(self, task_id, chunk_size=10000, **filters):
+        """Yields the patterns of a task in the order they were merged, as DataFrames of at most chunk_size rows
+        with the columns of pattern_export_columns. Chunks are read by keyset, so each costs the same."""
+        columns = [getattr(Pattern, column) for column in pattern_export_columns]
+        after = -1
+        while True:
+            query = select(*columns).where(*pattern_conditions(task_id, **filters), Pattern.id > after)
+            with Session(self.engine) as session:
+                rows = session.exec(query.order_by(Pattern.id).limit(chunk_size)).all()
+            if not rows:
+                return
+            df = pd.DataFrame(rows, columns=pattern_export_columns)
+            # None in projects mined before these were stored; nullable so that every chunk has the same types
+            count_columns = ["left_count", "right_count", "total_token_count"]
+            df[count_columns] = df[count_columns].astype("Int64")
+            yield df
+            after = rows[-1][0]
+
+    def iter_position_chunks(self, task_id, chunk_size=10000, context=None, lines=True, **filters):
+        """Yields the positions of the patterns of a task, as DataFrames of at most chunk_size rows with the
+        columns of position_export_columns. With lines, each position also gets its concordance line: the
+        tokens of its sentence (within context tokens of the match) with the matched ones in brackets."""
+        after = -1
+        while True:
+            query = (select(Position.id, Position.pattern_id, Pattern.form, Position.sentence_id, Sentence.file_name,
+                            Position.token_ids)
+                     .join(Pattern, Pattern.id == Position.pattern_id)
+                     .join(Sentence, Sentence.id == Position.sentence_id)
+                     .where(*pattern_conditions(task_id, **filters), Position.id > after)
+                     .order_by(Position.id).limit(chunk_size))
+            with Session(self.engine) as session:
+                rows = [(*row[:5], decode_token_ids(row[5])) for row in session.exec(query)]
+                sent_idx_to_tokens = defaultdict(list)
+                if lines and rows:
+                    statement = (select(Token.sentence_id, Token.id, Token.text)
+                                 .where(Token.sentence_id.in_({row[3] for row in rows}))
+                                 .order_by(Token.sentence_id, Token.id))
+                    for sent_idx, token_id, text in session.exec(statement):
+                        sent_idx_to_tokens[sent_idx].append((token_id, text))
+            if not rows:
+                return
+            df = pd.DataFrame(rows, columns=position_export_columns[:-1])
+            df['token_ids'] = df['token_ids'].apply(list)
+            if lines:
+                df['line'] = [concordance_line(sent_idx_to_tokens[row[3]], row[5], context) for row in rows]
+            yield df
+            after = rows[-1][0]
+
+
+edge_columns = ["source", "target", "side", "count", "score"]
+
+
+def pattern_conditions(task_id, form_filter=None, min_score=None, max_score=None, min_count=None, max_count=None):
+    conditions = [Pattern.task_id == task_id]
+    if form_filter:
+        # "<noun> have" as displayed matches "NOUN~have" as stored (LIKE is case-insensitive)
+        text = form_filter.strip().replace("<", "").replace(">", "").replace(" ", "~")
+        text = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        conditions.append(Pattern.form.like(f"%{text}%", escape="\\"))
+    if min_score is not None:
+        conditions.append(Pattern.score >= min_score)
+    if max_score is not None:
+        conditions.append(Pattern.score <= max_score)
+    if min_count is not None:
+        conditions.append(Pattern.count >= min_count)
+    if max_count is not None:
+        conditions.append(Pattern.count <= max_count)
+    return conditions
+
+
+pattern_export_columns = ["id", "form", "left", "right", "count", "score", "left_count", "right_count",
+                          "total_token_count"]
+position_export_columns = ["id", "pattern_id", "form", "sentence_id", "file_name", "token_ids", "line"]
+
+
+def concordance_line(tokens, token_ids, context=None):
+    # tokens: (id, text) of a sentence in order
+    if context is not None:
+        tokens = [(i, text) for i, text in tokens if min(token_ids) - context <= i <= max(token_ids) + context]
+    return " ".join(f"[{text}]" if i in token_ids else text for i, text in tokens)
+
+
+def transform_pattern_form(form):
+    parts = form.split("~")
+    for i, part in enumerate(parts):
+        if "." in part or (len(part) > 1 and all(c.isupper() for c in part)):
+            parts[i] = "<" + part.lower() + ">"
+    return " ".join(parts)
+
+
+def parse_pattern_form(text):
+    # the stored form of a pattern as displayed by transform_pattern_form(); stored forms are left as they are
+    parts = text.strip().split("~") if "~" in text else text.split()
+    for i, part in enumerate(parts):
+        if part.startswith("<") and part.endswith(">"):
+            part = part[1:-1]
+            parts[i] = part if "." in part else part.upper()
+    return "~".join(parts)
+
+
+def patterns_to_df(values, start=0):
+    cols = ['index', 'form', 'left', 'right', 'count', 'score', 'pattern']
+    if not values:
+        return pd.DataFrame(columns=cols)
+    df = pd.DataFrame(values).drop(["_sa_instance_state", "id"], axis=1, errors="ignore").reset_index()
+    df['pattern'] = df['form']  # as stored, for query_pattern()
+    df['form'] = df['form'].apply(transform_pattern_form)
+    df['index'] += start + 1
+    return df.reindex(columns=cols)
+
 
 if __name__ == "__main__":
     output_folder = "~/code/corpus/cxgnet/nim/patterns/"
@@ -167,4 +580,4 @@ if __name__ == "__main__":
     manager.create_database()
 
     pattern = "NOUN~NOUN~have~VBN"
-    print(manager.query_pattern(pattern))
+    print(manager.query_pattern(pattern, limit=10))
@@ -2,6 +2,7 @@ import mining
 import myutils
 import times
 import strutils
+import os
 
 
 var config_str = """
@@ -28,7 +29,9 @@ var config_str = """
 }
 """
 
+# a corpus.json; generate a synthetic one with: python benchmark.py --sizes 1000 --work-folder ../bench
+let json_path = if paramCount() > 0: paramStr(1) else: "../bench/1000/corpus.json"
 benchmark "minePatterns":
-    processCorpus("/Users/yan/Downloads/patterns/json_transformed/merge-dep-supersenses1000.json", config_str=config_str)
+    processCorpus(json_path, config_str=config_str)
 # benchmark "extractByRules":
     # extractPatternsByRules("/Users/yan/Downloads/patterns/json_transformed/merge-dep-supersenses1000.json", "/Users/yan/Downloads/patterns/json_transformed/output.txt", config_str=config_str)
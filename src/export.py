@@ -0,0 +1,146 @@
+"""Exports the patterns of a task, or their positions with concordance lines, to CSV, JSON Lines or Parquet.
+
+    python export.py <db_path> <task_id> <output_path> [--positions] [--context 10] [--min-score 6] ...
+
+The format follows the extension of output_path (.csv, .jsonl or .parquet). Rows are read from the database and
+written in chunks (see DBManager.iter_pattern_chunks() and iter_position_chunks()), so the size of an export is
+not bounded by memory. Parquet needs pyarrow.
+"""
+import os
+import sys
+import argparse
+import pandas as pd
+import db_manager
+
+formats = {".csv": "csv", ".jsonl": "jsonl", ".parquet": "parquet"}
+
+
+class CsvWriter:
+    def __init__(self, path, columns):
+        self.file = open(path, "w", newline="")
+        self.columns = columns
+        self.n_rows = 0
+
+    def write(self, df):
+        df = df.copy()
+        if "token_ids" in df:
+            df['token_ids'] = df['token_ids'].apply(lambda token_ids: ",".join(map(str, token_ids)))
+        df.to_csv(self.file, header=self.n_rows == 0, index=False)
+        self.n_rows += len(df)
+
+    def close(self):
+        if self.n_rows == 0:
+            pd.DataFrame(columns=self.columns).to_csv(self.file, index=False)
+        self.file.close()
+
+
+class JsonLinesWriter:
+    def __init__(self, path, columns):
+        self.file = open(path, "w")
+        self.n_rows = 0
+
+    def write(self, df):
+        text = df.to_json(orient="records", lines=True, force_ascii=False)
+        self.file.write(text if text.endswith("\n") else text + "\n")
+        self.n_rows += len(df)
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    # one row group per chunk; the schema is that of the first chunk
+    def __init__(self, path, columns):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("exporting to Parquet needs pyarrow (pip install pyarrow)")
+        self.pa = pyarrow
+        self.path = path
+        self.columns = columns
+        self.writer = None
+        self.n_rows = 0
+
+    def write(self, df):
+        table = self.pa.Table.from_pandas(df, preserve_index=False)
+        if self.writer is None:
+            self.writer = self.pa.parquet.ParquetWriter(self.path, table.schema)
+        else:
+            table = table.cast(self.writer.schema)
+        self.writer.write_table(table)
+        self.n_rows += len(df)
+
+    def close(self):
+        if self.writer is None:
+            self.pa.parquet.write_table(self.pa.table({column: [] for column in self.columns}), self.path)
+        else:
+            self.writer.close()
+
+
+writer_classes = {"csv": CsvWriter, "jsonl": JsonLinesWriter, "parquet": ParquetWriter}
+
+
+def get_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in formats:
+        raise ValueError(f"unknown export format {extension}; use one of {', '.join(formats)}")
+    return formats[extension]
+
+
+def export_task(manager, task_id, path, positions=False, context=None, lines=True, chunk_size=10000,
+                progress=None, **filters):
+    """Writes the patterns of a task (or with positions, their positions) that match filters (see
+    db_manager.pattern_conditions()) to path; returns the number of rows. progress(n_rows) is called after each
+    chunk. The file is written under a temporary name and only replaces path once complete."""
+    if positions:
+        columns = db_manager.position_export_columns if lines else db_manager.position_export_columns[:-1]
+        chunks = manager.iter_position_chunks(task_id, chunk_size=chunk_size, context=context, lines=lines,
+                                              **filters)
+    else:
+        columns = db_manager.pattern_export_columns
+        chunks = manager.iter_pattern_chunks(task_id, chunk_size=chunk_size, **filters)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    writer = writer_classes[get_format(path)](temp_path, columns)
+    is_complete = False
+    try:
+        for df in chunks:
+            writer.write(df)
+            if progress is not None:
+                progress(writer.n_rows)
+        is_complete = True
+    finally:
+        writer.close()
+        if not is_complete:
+            os.remove(temp_path)
+    os.replace(temp_path, path)
+    return writer.n_rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("db_path")
+    parser.add_argument("task_id", type=int)
+    parser.add_argument("output_path", help="a .csv, .jsonl or .parquet file")
+    parser.add_argument("--positions", action="store_true", help="export the positions of the patterns")
+    parser.add_argument("--context", type=int, help="tokens around a match in its concordance line")
+    parser.add_argument("--no-lines", action="store_true", help="export positions without concordance lines")
+    parser.add_argument("--form", dest="form_filter", help="only forms containing this, e.g. '<noun> have'")
+    parser.add_argument("--min-score", type=float)
+    parser.add_argument("--max-score", type=float)
+    parser.add_argument("--min-count", type=int)
+    parser.add_argument("--max-count", type=int)
+    parser.add_argument("--chunk-size", type=int, default=10000, help="rows read and written at a time")
+    args = parser.parse_args(argv)
+
+    manager = db_manager.DBManager(args.db_path)
+    n_rows = export_task(manager, args.task_id, args.output_path, positions=args.positions, context=args.context,
+                         lines=not args.no_lines, chunk_size=args.chunk_size,
+                         progress=lambda n: print(f"{n} rows", end="\r", file=sys.stderr),
+                         form_filter=args.form_filter, min_score=args.min_score, max_score=args.max_score,
+                         min_count=args.min_count, max_count=args.max_count)
+    print(f"{n_rows} rows written to {args.output_path}")
+
+
+if __name__ == "__main__":
+    main()
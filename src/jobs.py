@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import datetime
+import threading
+import traceback
+import multiprocessing
+from collections import deque
+import db_manager
+
+# statuses of jobs that have not ended
+active_statuses = ["queued", "running", "cancelling"]
+# what a job resuming a task may change; the other settings are those the task was started with
+resume_keys = ["n_total_rounds", "checkpoint_interval", "n_threads"]
+
+
+def checkpoint_path(folder, task_id):
+    return os.path.join(folder, f"checkpoint_{task_id}.bin")
+
+
+def is_json_lines(path):
+    # a JSON array starts with "[", JSON Lines with the "{" of the first sentence
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                return line.lstrip().startswith("{")
+    return False
+
+
+def iter_json_lines(path):
+    if is_json_lines(path):
+        with open(path) as f:
+            yield from (line.rstrip("\n") for line in f if line.strip())
+    else:
+        with open(path) as f:
+            yield from (json.dumps(sent) for sent in json.load(f))
+
+
+def append_corpus(db_path, new_path):
+    """Appends the annotated sentences of new_path (JSON or JSON Lines) to the corpus of the project of db_path;
+    returns their number. Only they are stored in the database, and corpus.json becomes JSON Lines so that later
+    appends only add lines. Tasks continued from their checkpoints then catch up with just these sentences."""
+    import mining
+    folder = os.path.dirname(db_path)
+    json_path = os.path.join(folder, "corpus.json")
+    bin_path = os.path.join(folder, "corpus.bin")
+    db_manager.DBManager(db_path).create_database(on_exist="ignore")
+    temp_bin_path = f"{bin_path}.{os.getpid()}"
+    n_sents = mining.append_corpus(json_path, new_path, temp_bin_path)
+    if not is_json_lines(json_path):
+        temp_json_path = f"{json_path}.{os.getpid()}"
+        with open(temp_json_path, "w") as f:
+            f.writelines(line + "\n" for line in iter_json_lines(json_path))
+        os.replace(temp_json_path, json_path)
+    with open(json_path, "a") as f:
+        f.writelines(line + "\n" for line in iter_json_lines(new_path))
+    os.replace(temp_bin_path, bin_path)
+    # os.replace() keeps the time the binary was written, before corpus.json was; it must be newer to be loaded
+    os.utime(bin_path)
+    # the rows are only committed once the corpus files hold the sentences; sentences a failed append left
+    # out of the database are stored by the next one (or the next task)
+    mining.store_corpus_tokens(json_path, db_path)
+    return n_sents
+
+
+def run_job(db_path, job_id):
+    # the body of a worker process: mines the patterns of a job as a new task of its project, or continues one
+    import mining
+    manager = db_manager.DBManager(db_path)
+    if not manager.update_job(job_id, statuses=["queued"], status="running", pid=os.getpid(),
+                              time_started=datetime.datetime.now()):
+        return  # cancelled before it started
+    job = manager.get_job(job_id)
+    try:
+        config = json.loads(job['config'])
+        folder = os.path.dirname(db_path)
+        json_path = os.path.join(folder, "corpus.json")
+        bin_path = os.path.join(folder, "corpus.bin")
+        if not os.path.exists(bin_path):  # projects created before the binary format
+            temp_path = f"{bin_path}.{os.getpid()}"
+            mining.write_binary_corpus(json_path, temp_path)
+            os.replace(temp_path, bin_path)
+        # a job with resume_task_id continues that task from its checkpoint instead of starting a new one
+        task_id = config.get("resume_task_id")
+        if task_id is None:
+            task_id = manager.new_task(job['name'], config)
+        else:
+            task_config = json.loads(manager.get_task(task_id)['config'])
+            config = {**task_config, **{key: config[key] for key in resume_keys if key in config},
+                      "resume_from": checkpoint_path(folder, task_id)}
+        config["checkpoint_path"] = checkpoint_path(folder, task_id)
+        manager.update_job(job_id, task_id=task_id)
+        # the miner reports its progress after each round and stops once the job is cancelling
+        mining.mine_patterns(json_path, folder, config, store_in_database=True, task_id=task_id, job_id=job_id)
+    except Exception:
+        manager.update_job(job_id, status="failed", error=traceback.format_exc(),
+                           time_finished=datetime.datetime.now())
+        return
+    finished = datetime.datetime.now()
+    if not manager.update_job(job_id, statuses=["running"], status="done", time_finished=finished):
+        manager.update_job(job_id, status="cancelled", time_finished=finished)
+
+
+class JobQueue:
+    """Runs mining jobs in worker processes, at most max_workers at a time.
+    Jobs are rows of the job table of their project database, where the UI polls their progress."""
+
+    def __init__(self, max_workers=2, poll_interval=1.0):
+        self.max_workers = max_workers
+        self.poll_interval = poll_interval
+        # workers are spawned rather than forked from the multithreaded server
+        self.context = multiprocessing.get_context("spawn")
+        self.pending = deque()  # (manager, job_id)
+        self.running = {}  # (db_path, job_id) -> (manager, process)
+        self.attached = set()  # paths of the databases seen by attach()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.dispatch_loop, daemon=True)
+        self.thread.start()
+
+    def attach(self, manager):
+        """Prepares a project database for jobs, and picks up the jobs left unfinished by an earlier server:
+        queued ones are queued again and running ones are marked as failed."""
+        with self.lock:
+            if manager.db_path in self.attached:
+                return
+            self.attached.add(manager.db_path)
+            manager.create_database(on_exist="ignore")
+            tracked = {job_id for (db_path, job_id) in self.running if db_path == manager.db_path}
+            tracked.update(job_id for (m, job_id) in self.pending if m.db_path == manager.db_path)
+            for job in reversed(manager.get_jobs(statuses=active_statuses)):
+                if job['id'] in tracked:
+                    continue
+                if job['status'] == "queued":
+                    self.pending.append((manager, job['id']))
+                else:
+                    manager.update_job(job['id'], statuses=active_statuses, status="failed",
+                                       error="Interrupted by a server restart", time_finished=datetime.datetime.now())
+
+    def submit(self, manager, name, config):
+        self.attach(manager)
+        job_id = manager.new_job(name, config)
+        with self.lock:
+            self.pending.append((manager, job_id))
+        return job_id
+
+    def cancel(self, manager, job_id, terminate=False):
+        """Cancels a job. A running job stops after its current round, or at once if terminate is set."""
+        now = datetime.datetime.now()
+        with self.lock:
+            self.pending = deque((m, i) for (m, i) in self.pending
+                                 if (m.db_path, i) != (manager.db_path, job_id))
+            _, process = self.running.get((manager.db_path, job_id), (None, None))
+        if manager.update_job(job_id, statuses=["queued"], status="cancelled", time_finished=now):
+            return
+        if terminate and process is not None:
+            process.terminate()
+            manager.update_job(job_id, statuses=["running", "cancelling"], status="cancelled", time_finished=now)
+        else:
+            manager.update_job(job_id, statuses=["running"], status="cancelling")
+
+    def dispatch_loop(self):
+        while True:
+            with self.lock:
+                self.reap()
+                while self.pending and len(self.running) < self.max_workers:
+                    manager, job_id = self.pending.popleft()
+                    process = self.context.Process(target=run_job, args=(manager.db_path, job_id), daemon=True)
+                    process.start()
+                    self.running[(manager.db_path, job_id)] = (manager, process)
+            time.sleep(self.poll_interval)
+
+    def reap(self):
+        for key, (manager, process) in list(self.running.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            del self.running[key]
+            # a worker that exited without recording how the job ended, e.g. after a crash in the miner
+            manager.update_job(key[1], statuses=active_statuses, status="failed",
+                               error=f"Worker exited with code {process.exitcode}",
+                               time_finished=datetime.datetime.now())
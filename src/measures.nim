@@ -92,12 +92,29 @@ proc log_dice*(word_count1: int, word_count2: int, ngram_count: int, summed_all_
     var diced = dice(word_count1, word_count2, ngram_count, summed_all_ngram_counts)
     return 14 + log2(diced)
 
+proc associationScore*(measure: MeasureType, pattern_count, token1_count, token2_count: int,
+        total_token_count: int): float64 =
+    ## the score of a bigram under measure, from the counts of the bigram, its components and all tokens
+    if token1_count == 0 or token2_count == 0:
+        return 0.0
+    case measure:
+    of mtLoglikelihood:
+        logLikelihood(token1_count, token2_count, pattern_count, total_token_count)
+    of mtDeltaP:
+        max(deltaP(token1_count, token2_count, pattern_count, total_token_count))
+    of mtPMI, mtPMI2, mtPMI3:
+        pmi(@[token1_count, token2_count], pattern_count, total_token_count, ord(measure) + 1)
+    of mtLogDice:
+        logDice(token1_count, token2_count, pattern_count, total_token_count)
+
 when isMainModule:
     assert pmi(@[10, 30], 5, 3000, 3) == 10.288
     assert getBigramContingency(10, 30, 5, 3000) == [5, 5, 25, 2965]
     assert logLikelihood(10, 30, 5, 3000) == 33.148
     assert dice(10, 30, 5, 3000) == 0.25
     assert log_dice(10, 30, 5, 3000) == 12.0
+    assert associationScore(mtPMI3, 5, 10, 30, 3000) == 10.288
+    assert associationScore(mtLogDice, 5, 0, 30, 3000) == 0.0
     # import benchy
     # timeIt "pmi":
     #     var v = pmi(@[10, 30], 5, 3000, 3)
@@ -4,7 +4,13 @@ import myutils
 import tables, sets, hashes
 import measures
 import algorithm
+import std/heapqueue
 import std/enumerate, sugar
+import std/cpuinfo
+from unicode import nil
+import times
+import streams
+import std/sha1
 import data_manager
 import std/db_sqlite
 import json
@@ -27,20 +33,6 @@ proc addMerge(self: Sentence, token_ids: seq[int], token_types: seq[TokenType] =
             # i(ndividual) + m(erged); only i's type (==ttNil) needs setting
             token.chosen_type = token_types[0]
 
-proc getFormsByTokenId(self: Sentence, token_id: int,
-        token_type: TokenType = ttLemma): OrderedTable[int, string] =
-    var token: Token
-    if token_id notin self.token_id_to_merge_idx:
-        token = self.tokens[token_id]
-        result[token_id] = token.getText(token_type)
-        # result[token_id] = fmt"{token.getText(token_type)}{ord(token_type)}"
-    else:
-        var merge = self.merges[self.token_id_to_merge_idx[token_id]]
-        for tid in merge:
-            token = self.tokens[tid]
-            result[tid] = token.getText(token.chosen_type)
-            # result[tid] = fmt"{token.getText(token.chosen_type)}{ord(token.chosen_type)}"
-
 
 type Position = ref object
     sent_idx: int
@@ -56,261 +48,677 @@ proc `==`(self: Position, other: Position): bool =
     self.sent_idx == other.sent_idx and self.token_ids == other.token_ids
 
 
-type PatternIndexer = ref object
-    # copy semantics: p = indexer.pattern_positions; depends on the evaluated value of the right hand side
-    pattern_positions: Table[string, HashSet[Position]]
-    sent_idx_to_positions: Table[int, seq[Position]]
-    pattern_counts: Table[string, int]
-    pattern_to_bigrams: Table[string, (string, string)]
-    sent_idx_to_pattern_counts: Table[int, Table[string, int]]
-    # remember the type of non-lemma tokens; might clash with lemma (e.g.=="DET")
-    token_to_type: Table[string, TokenType]
+# a pattern is a sequence of value ids interned to a dense id; single tokens are patterns of length 1
+type PatternId = int
+
+const NoPattern = PatternId(-1)
+
+
+# read-only settings of the indexer; plain object so that indexing threads can share it
+type IndexSettings = object
     token_types: seq[TokenType] # token type for enumeration
-    allowed_values: TableRef[TokenType, HashSet[string]]
-    ignored_values: TableRef[TokenType, HashSet[string]]
-    target_tokens: TableRef[string, Table[TokenType, string]]
+    allowed_values: Table[TokenType, HashSet[int]]
+    ignored_values: Table[TokenType, HashSet[int]]
+    empty_value_id: int
+    punct_id: int # of the upos PUNCT
+    target_tokens: Table[string, Table[TokenType, string]]
+    # target_tokens by value ids: the required value id of each token type, by lemma id
+    target_requirements: Table[int, seq[(TokenType, int)]]
     is_target_mode: bool
     max_hops: int # dep distance between two words in a sentence
     merge_adjacent: bool
+
+
+# the form of a token under a token type, or of the merge it belongs to: its token ids and their value ids
+type SentenceForm = object
+    value_ids: seq[int]
+    token_ids: seq[int]
+
+# what indexing one token-head bigram of a sentence adds to the indexer
+type IndexedForm = object
+    form: int # in CollectedSentence.forms
+    token_type: TokenType
+    add_position: bool
+
+type IndexedBigram = object
+    token: IndexedForm
+    head: IndexedForm
+    has_head: bool
+    has_pattern: bool
+    merged_value_ids: seq[int]
+    merged_ids: seq[int]
+
+# the bigrams of a sentence in indexing order; a form shared by several bigrams is stored once
+type CollectedSentence = object
+    forms: seq[SentenceForm]
+    bigrams: seq[IndexedBigram]
+
+# per sentence: the index in CollectedSentence.forms of the form of each unmerged token under each token type
+# and of each merge (-1 until first needed), and the token types whose form got a position, by first token
+type FormCache = object
+    token_forms: seq[array[TokenType, int]]
+    merge_forms: seq[int]
+    indexed_types: seq[set[TokenType]]
+
+
+type PatternIndexer = ref object
+    # copy semantics: p = indexer.pattern_positions; depends on the evaluated value of the right hand side
+    # the per-pattern seqs below are indexed by PatternId
+    pattern_to_id: Table[seq[int], PatternId]
+    patterns: seq[seq[int]]
+    pattern_positions: seq[HashSet[Position]]
+    sent_idx_to_positions: Table[int, seq[(PatternId, Position)]] # each position with the pattern it was added to
+    pattern_counts: seq[int]
+    pattern_to_bigrams: seq[(PatternId, PatternId)]
+    component_to_patterns: seq[seq[PatternId]] # reverse of pattern_to_bigrams
+    sent_idx_to_pattern_counts: Table[int, Table[PatternId, int]]
+    # remember the type of non-lemma tokens; might clash with lemma (e.g.=="DET")
+    token_to_type: seq[TokenType]
+    settings: IndexSettings
+    n_threads: int # threads collecting bigrams in indexSentences()
     corpus: Corpus
+    # target mode: the sentences of each target lemma, and whether a sentence has a valid target token;
+    # only those get positions, the others only add to the counts of single tokens
+    lemma_to_sent_idxes: Table[string, seq[int]]
+    has_target: seq[bool]
+
+proc isValidTarget(self: IndexSettings, token: Token): bool =
+    var lemma_id = token.getValueId(ttLemma)
+    if lemma_id in self.target_requirements:
+        for (token_type, value_id) in self.target_requirements[lemma_id]:
+            if token.getValueId(token_type) != value_id:
+                return false
+        return true
+    else:
+        return false
+
+proc indexTargetLemmas(self: PatternIndexer) =
+    ## the inverted index of target lemmas, from a single pass over the value ids of lemmas
+    var lemma_ids: Table[int, string]
+    for lemma in self.settings.target_tokens.keys():
+        var value_id = self.corpus.vocab.value_to_id.getOrDefault(lemma, -1)
+        if value_id != -1:
+            lemma_ids[value_id] = lemma
+            self.lemma_to_sent_idxes[lemma] = @[]
+    self.has_target = newSeq[bool](self.corpus.sentences.len)
+    for sent_idx, sentence in self.corpus.sentences:
+        for token in sentence.tokens:
+            var value_id = token.getValueId(ttLemma)
+            if value_id notin lemma_ids:
+                continue
+            var lemma = lemma_ids[value_id]
+            if self.lemma_to_sent_idxes[lemma].len == 0 or self.lemma_to_sent_idxes[lemma][^1] != sent_idx:
+                self.lemma_to_sent_idxes[lemma].add(sent_idx)
+            if self.settings.isValidTarget(token):
+                self.has_target[sent_idx] = true
 
 proc init(self: PatternIndexer, corpus: Corpus,
         config: JsonNode = parseJson("{}")) =
     self.corpus = corpus
+    var vocab = corpus.vocab
+    var settings = IndexSettings()
     for elem in config{"token_types"}.getElems():
-        self.token_types.add(elem.getStr().toTokenType())
-    if self.token_types.len == 0:
-        self.token_types = @[ttLemma]
+        settings.token_types.add(elem.getStr().toTokenType())
+    if settings.token_types.len == 0:
+        settings.token_types = @[ttLemma]
 
-    self.allowed_values = newTable[TokenType, HashSet[string]]()
     for (key, values) in config{"allowed_values"}.getFields().pairs():
         var token_type = key.toTokenType()
-        self.allowed_values[token_type] = initHashSet[string]()
+        settings.allowed_values[token_type] = initHashSet[int]()
         for value in values.getElems():
-            self.allowed_values[token_type].incl(value.getStr())
-    for key in self.allowed_values.keys.toSeq():
-        if key notin self.token_types:
-            self.allowed_values.del(key)
+            settings.allowed_values[token_type].incl(vocab.intern(value.getStr()))
+    for key in settings.allowed_values.keys.toSeq():
+        if key notin settings.token_types:
+            settings.allowed_values.del(key)
 
-    self.ignored_values = newTable[TokenType, HashSet[string]]()
     for (key, values) in config{"ignored_values"}.getFields().pairs():
         var token_type = key.toTokenType()
-        self.ignored_values[token_type] = initHashSet[string]()
+        settings.ignored_values[token_type] = initHashSet[int]()
         for value in values.getElems():
-            self.ignored_values[token_type].incl(value.getStr())
+            settings.ignored_values[token_type].incl(vocab.intern(value.getStr()))
+    settings.empty_value_id = vocab.intern("")
+    settings.punct_id = vocab.intern("PUNCT")
 
-    self.target_tokens = newTable[string, Table[TokenType, string]]()
     for (key, values) in config{"target_tokens"}.getFields().pairs():
-        self.target_tokens[key] = initTable[TokenType, string]()
+        settings.target_tokens[key] = initTable[TokenType, string]()
         for (token_type_str, value) in values.getFields().pairs():
             var token_type = token_type_str.toTokenType()
-            self.target_tokens[key][token_type] = value.getStr()
-    self.is_target_mode = self.target_tokens.len > 0
+            settings.target_tokens[key][token_type] = value.getStr()
+    for lemma, requirements in settings.target_tokens.pairs():
+        var lemma_requirements: seq[(TokenType, int)]
+        for token_type, value in requirements.pairs():
+            lemma_requirements.add((token_type, vocab.intern(value)))
+        settings.target_requirements[vocab.intern(lemma)] = lemma_requirements
+    settings.is_target_mode = settings.target_tokens.len > 0
+
+    settings.max_hops = 2
+    settings.merge_adjacent = true
+    self.settings = settings
+    # 0 means one thread per core
+    self.n_threads = config{"n_threads"}.getInt(1)
+    if self.n_threads <= 0:
+        self.n_threads = countProcessors()
+    if settings.is_target_mode:
+        self.indexTargetLemmas()
+
+proc internPattern(self: PatternIndexer, value_ids: seq[int]): PatternId =
+    result = self.pattern_to_id.getOrDefault(value_ids, NoPattern)
+    if result == NoPattern:
+        result = self.patterns.len
+        self.pattern_to_id[value_ids] = result
+        self.patterns.add(value_ids)
+        self.pattern_positions.add(HashSet[Position]())
+        self.pattern_counts.add(0)
+        self.pattern_to_bigrams.add((NoPattern, NoPattern))
+        self.component_to_patterns.add(@[])
+        self.token_to_type.add(ttNil)
+
+proc lookupPattern(self: PatternIndexer, form: string): PatternId =
+    ## the id of a "~"-joined form, or NoPattern if it has never been indexed
+    var value_ids: seq[int]
+    for value in form.split("~"):
+        var value_id = self.corpus.vocab.lookup(value)
+        if value_id == -1:
+            return NoPattern
+        value_ids.add(value_id)
+    self.pattern_to_id.getOrDefault(value_ids, NoPattern)
+
+proc getForm(self: PatternIndexer, pattern: PatternId): string =
+    ## strings only come back here, for output and the database
+    for i, value_id in self.patterns[pattern]:
+        if i > 0:
+            result.add("~")
+        result.add(self.corpus.vocab[value_id])
+
+proc isSingleToken(self: PatternIndexer, pattern: PatternId): bool {.inline.} =
+    self.patterns[pattern].len == 1
 
-    self.max_hops = 2
-    self.merge_adjacent = true
+proc hasBigrams(self: PatternIndexer, pattern: PatternId): bool {.inline.} =
+    self.pattern_to_bigrams[pattern][0] != NoPattern
 
-proc addPosition(self: PatternIndexer, pattern: string, position: Position) =
-    if pattern notin self.pattern_positions:
-        self.pattern_positions[pattern] = HashSet[Position]()
+proc addPosition(self: PatternIndexer, pattern: PatternId, position: Position) =
     self.pattern_positions[pattern].incl(position)
     if position.sent_idx notin self.sent_idx_to_positions:
         self.sent_idx_to_positions[position.sent_idx] = @[]
-    self.sent_idx_to_positions[position.sent_idx].add(position)
-    if pattern notin self.pattern_counts:
-        self.pattern_counts[pattern] = 1
-    else:
-        self.pattern_counts[pattern] += 1
+    self.sent_idx_to_positions[position.sent_idx].add((pattern, position))
+    self.pattern_counts[pattern] += 1
     if position.sent_idx notin self.sent_idx_to_pattern_counts:
-        self.sent_idx_to_pattern_counts[position.sent_idx] = initTable[string, int]()
+        self.sent_idx_to_pattern_counts[position.sent_idx] = initTable[PatternId, int]()
     if pattern notin self.sent_idx_to_pattern_counts[position.sent_idx]:
         self.sent_idx_to_pattern_counts[position.sent_idx][pattern] = 1
     else:
         self.sent_idx_to_pattern_counts[position.sent_idx][pattern] += 1
 
-iterator getPositions(self: PatternIndexer, pattern: string): Position =
+iterator getPositions(self: PatternIndexer, pattern: PatternId): Position =
     for pos in self.pattern_positions[pattern]:
         yield pos
 
-proc removePositions(self: PatternIndexer, pattern: string) {.inline.} =
-    self.pattern_positions.del(pattern)
+proc cmpPositions(a, b: Position): int =
+    result = cmp(a.sent_idx, b.sent_idx)
+    var i = 0
+    while result == 0 and i < min(a.token_ids.len, b.token_ids.len):
+        result = cmp(a.token_ids[i], b.token_ids[i])
+        i += 1
+    if result == 0:
+        result = cmp(a.token_ids.len, b.token_ids.len)
+
+proc sortedPositions(self: PatternIndexer, pattern: PatternId): seq[Position] =
+    ## the positions of a pattern in corpus order, independent of the history of its hash set
+    result = self.pattern_positions[pattern].toSeq()
+    result.sort(cmpPositions)
 
-proc count(self: PatternIndexer, pattern: string): int {.inline.} =
+proc removePositions(self: PatternIndexer, pattern: PatternId) {.inline.} =
+    self.pattern_positions[pattern].clear()
+
+proc count(self: PatternIndexer, pattern: PatternId): int {.inline.} =
     # with plain objects, copies of used value in PatternIndexer will be made, which is expensive!
-    if pattern notin self.pattern_counts:
-        echo fmt"counts not found for '{pattern}'"
-        return 0
     self.pattern_counts[pattern]
 
-proc isValidTarget(self: PatternIndexer, token: Token): bool =
-    if token.lemma in self.target_tokens:
-        var requirements = self.target_tokens[token.lemma]
-        for token_type, value in requirements.pairs():
-            if token.getText(token_type) != value:
-                return false
-        return true
-    else:
-        return false
+proc initFormCache(sentence: Sentence): FormCache =
+    var unset: array[TokenType, int]
+    for token_type in TokenType:
+        unset[token_type] = -1
+    result.token_forms = newSeqWith(sentence.tokens.len, unset)
+    result.merge_forms = newSeqWith(sentence.merges.len, -1)
+    result.indexed_types = newSeq[set[TokenType]](sentence.tokens.len)
+
+proc collectForm(collected: var CollectedSentence, cache: var FormCache, sentence: Sentence, token_id: int,
+        token_type: TokenType): int =
+    ## the form of a token: the token under token_type or, once merged, its merge with the types chosen for
+    ## the tokens of the merge (in merge order); each is computed once per sentence
+    var merge_idx = sentence.token_id_to_merge_idx.getOrDefault(token_id, -1)
+    if merge_idx == -1:
+        result = cache.token_forms[token_id][token_type]
+        if result == -1:
+            result = collected.forms.len
+            cache.token_forms[token_id][token_type] = result
+            collected.forms.add(SentenceForm(value_ids: @[sentence.tokens[token_id].getValueId(token_type)],
+                                             token_ids: @[token_id]))
+        return
+    result = cache.merge_forms[merge_idx]
+    if result == -1:
+        result = collected.forms.len
+        cache.merge_forms[merge_idx] = result
+        var form = SentenceForm(token_ids: sentence.merges[merge_idx])
+        form.value_ids = newSeq[int](form.token_ids.len)
+        for i, tid in form.token_ids:
+            var token = sentence.tokens[tid]
+            form.value_ids[i] = token.getValueId(token.chosen_type)
+        collected.forms.add(move(form))
+
+proc overlaps(a, b: seq[int]): bool {.inline.} =
+    # forms have a handful of tokens, so this is cheaper than intersecting sets
+    for token_id in a:
+        if token_id in b:
+            return true
 
-proc indexBigram(self: PatternIndexer, sentence: Sentence, token: Token,
-        token_type: TokenType = ttNil, head: Token, head_type: TokenType = ttNil,
-        sentence_cache: var HashSet[(int, TokenType)]): string {.inline.} =
-    var token_id_to_forms = sentence.getFormsByTokenId(token.id, token_type = token_type)
-    var token_ids = token_id_to_forms.keys().toSeq()
-    var token_form = token_id_to_forms.values().toSeq().join("~")
-    var token_pos = Position(sent_idx: sentence.id, token_ids: token_ids)
-    if token_type != ttNil:
-        self.token_to_type[token_form] = token_type
+proc setMergedIds(bigram: var IndexedBigram, token_form, head_form: SentenceForm) =
+    ## the token ids of two disjoint forms in order, with their value ids; by insertion, as the token ids of
+    ## a form are already in order
+    var n_ids = token_form.token_ids.len + head_form.token_ids.len
+    bigram.merged_ids = newSeqOfCap[int](n_ids)
+    bigram.merged_value_ids = newSeqOfCap[int](n_ids)
+    template insert(form: SentenceForm) =
+        for i, token_id in form.token_ids:
+            var j = bigram.merged_ids.len
+            bigram.merged_ids.add(token_id)
+            bigram.merged_value_ids.add(form.value_ids[i])
+            while j > 0 and bigram.merged_ids[j - 1] > token_id:
+                bigram.merged_ids[j] = bigram.merged_ids[j - 1]
+                bigram.merged_value_ids[j] = bigram.merged_value_ids[j - 1]
+                j -= 1
+            bigram.merged_ids[j] = token_id
+            bigram.merged_value_ids[j] = form.value_ids[i]
+    insert(token_form)
+    insert(head_form)
+
+proc collectBigram(self: IndexSettings, sentence: Sentence, collected: var CollectedSentence,
+        cache: var FormCache, token: Token, token_type: TokenType = ttNil, head: Token,
+        head_type: TokenType = ttNil): IndexedBigram {.inline.} =
+    ## the forms and positions of a bigram; it only reads the sentence so it can run in any thread
+    var token_form = collected.collectForm(cache, sentence, token.id, token_type)
+    result.token = IndexedForm(form: token_form, token_type: token_type)
     # if it has not been indexed before; only the first token of a pattern gets indexed
-    if (token.id, token_type) notin sentence_cache and token.id == min(token_ids):
-        self.addPosition(token_form, token_pos)
-        sentence_cache.incl((token.id, token_type))
+    if token_type notin cache.indexed_types[token.id] and token.id == min(collected.forms[token_form].token_ids):
+        result.token.add_position = true
+        cache.indexed_types[token.id].incl(token_type)
 
     if token.id == head.id:
         return
-    if token.upos == "PUNCT" or head.upos == "PUNCT":
+    if token.getValueId(ttUpos) == self.punct_id or head.getValueId(ttUpos) == self.punct_id:
         return
-    var head_id_to_forms = sentence.getFormsByTokenId(head.id, token_type = head_type)
-    var head_ids = head_id_to_forms.keys().toSeq()
-    var head_form = head_id_to_forms.values().toSeq().join("~")
-    if (head_ids.toHashSet() * token_ids.toHashSet()).len > 0: # intersection
+    var head_form = collected.collectForm(cache, sentence, head.id, head_type)
+    if overlaps(collected.forms[head_form].token_ids, collected.forms[token_form].token_ids):
         return
-    if head_type != ttNil:
-        self.token_to_type[head_form] = head_type
-    if (head.id, head_type) notin sentence_cache and head.id == min(head_ids):
-        var head_pos = Position(sent_idx: sentence.id, token_ids: head_ids)
-        self.addPosition(head_form, head_pos)
-        sentence_cache.incl((head.id, head_type))
+    result.has_head = true
+    result.head = IndexedForm(form: head_form, token_type: head_type)
+    if head_type notin cache.indexed_types[head.id] and head.id == min(collected.forms[head_form].token_ids):
+        result.head.add_position = true
+        cache.indexed_types[head.id].incl(head_type)
 
     if self.is_target_mode:
         var has_merged_before = token_type == ttNil or head_type == ttNil
         if not ((self.isValidTarget(token) or self.isValidTarget(head)) or has_merged_before):
             return
-    var merged_ids = (token_ids & head_ids).sorted()
-    token_id_to_forms.merge(head_id_to_forms)
-    var forms: seq[string]
-    for id in merged_ids:
-        forms.add(token_id_to_forms[id])
-    var merged_form = forms.join("~")
-    if merged_form notin self.pattern_to_bigrams: # A~B + C == A + B~C
-        self.pattern_to_bigrams[merged_form] = if token_ids[0] < head_ids[0]:
-                (token_form, head_form) else: (head_form, token_form)
-    var pattern_pos = Position(sent_idx: sentence.id, token_ids: merged_ids)
-    self.addPosition(merged_form, pattern_pos)
+    result.has_pattern = true
+    result.setMergedIds(collected.forms[token_form], collected.forms[head_form])
+
+proc applyForm(self: PatternIndexer, sent_idx: int, collected: CollectedSentence, form: IndexedForm): PatternId =
+    result = self.internPattern(collected.forms[form.form].value_ids)
+    if form.token_type != ttNil:
+        self.token_to_type[result] = form.token_type
+    if form.add_position:
+        self.addPosition(result, Position(sent_idx: sent_idx, token_ids: collected.forms[form.form].token_ids))
+
+proc applyBigram(self: PatternIndexer, sent_idx: int, collected: CollectedSentence,
+        bigram: IndexedBigram): PatternId =
+    result = NoPattern
+    var token_form = self.applyForm(sent_idx, collected, bigram.token)
+    if not bigram.has_head:
+        return
+    var head_form = self.applyForm(sent_idx, collected, bigram.head)
+    if not bigram.has_pattern:
+        return
+    var merged_form = self.internPattern(bigram.merged_value_ids)
+    if not self.hasBigrams(merged_form): # A~B + C == A + B~C
+        var is_token_first = collected.forms[bigram.token.form].token_ids[0] <
+            collected.forms[bigram.head.form].token_ids[0]
+        self.pattern_to_bigrams[merged_form] = if is_token_first: (token_form, head_form) else: (head_form, token_form)
+        self.component_to_patterns[token_form].add(merged_form)
+        if head_form != token_form:
+            self.component_to_patterns[head_form].add(merged_form)
+    self.addPosition(merged_form, Position(sent_idx: sent_idx, token_ids: bigram.merged_ids))
     return merged_form
 
-proc isInvalidToken(self: PatternIndexer, token: Token, token_type: TokenType): bool =
-    var text = token.getText(token_type)
+proc isInvalidToken(self: IndexSettings, token: Token, token_type: TokenType): bool =
+    var value_id = token.getValueId(token_type)
     (
-        token.skipped or text == "" or
-        (token_type in self.allowed_values and text notin self.allowed_values[token_type]) or
-        (token_type in self.ignored_values and text in self.ignored_values[token_type])
+        token.skipped or value_id == self.empty_value_id or
+        (token_type in self.allowed_values and value_id notin self.allowed_values[token_type]) or
+        (token_type in self.ignored_values and value_id in self.ignored_values[token_type])
     )
 
-proc getTokenHeadBigram(self: PatternIndexer, token: Token,
-        head: Token): seq[(Token, TokenType, Token, TokenType)] {.inline.} =
-    var token_types: seq[TokenType]
-    var head_types: seq[TokenType]
-    # when token.chosen_type != ttNil, use the single merged form (indicated using @[ttNil]）
-    token_types = if token.chosen_type == ttNil: self.token_types else: @[ttNil]
-    head_types = if head.chosen_type == ttNil: self.token_types else: @[ttNil]
-    for token_type in token_types:
+iterator formTypes(self: IndexSettings, token: Token): TokenType =
+    # when token.chosen_type != ttNil, use the single merged form (indicated using ttNil)
+    if token.chosen_type == ttNil:
+        for token_type in self.token_types:
+            yield token_type
+    else:
+        yield ttNil
+
+iterator tokenHeadTypes(self: IndexSettings, token: Token, head: Token): (TokenType, TokenType) =
+    for token_type in self.formTypes(token):
         if self.isInvalidToken(token, token_type):
             continue
-        for head_type in head_types:
+        for head_type in self.formTypes(head):
             if self.isInvalidToken(head, head_type):
                 continue
-            result.add((token, token_type, head, head_type))
+            yield (token_type, head_type)
 
-proc indexSentence(self: PatternIndexer, sentence: Sentence): HashSet[string] {.discardable.} =
-    # to remember whether a token/pattern has been indexed or not
-    var sentence_cache = HashSet[(int, TokenType)]() # [token_idx, token_type]
-    var bigrams: seq[(Token, TokenType, Token, TokenType)]
-    var bigram_ids: HashSet[(int, int)] # to prevent duplicated indexing
+proc collectSentence(self: IndexSettings, sentence: Sentence): CollectedSentence =
+    ## the bigrams of each token and its head, then of adjacent tokens that are not a token and its head
+    # to remember whether a token/pattern has been indexed or not, and the forms computed so far
+    var cache = initFormCache(sentence)
     for token in sentence.tokens:
         var head = sentence.tokens[token.head_id]
-        bigrams &= self.getTokenHeadBigram(token, head)
-        bigram_ids.incl((token.id, head.id)) # back get (head)
-        bigram_ids.incl((head.id, token.id)) # "get back" should not be indexed again later
+        for (token_type, head_type) in self.tokenHeadTypes(token, head):
+            var bigram = self.collectBigram(sentence, result, cache, token, token_type, head, head_type)
+            result.bigrams.add(move(bigram))
 
-    # add adjacent bigrams in the sentence to bigrams if their ids are not in bigram_ids
     if self.merge_adjacent:
-        for i, token in enumerate(sentence.tokens):
-            if i + 1 < sentence.tokens.len:
-                var next_token = sentence.tokens[i + 1]
-                if (token.id, next_token.id) notin bigram_ids:
-                    bigrams &= self.getTokenHeadBigram(token, next_token)
-
-    for (token, token_type, head, head_type) in bigrams:
-        var pattern = self.indexBigram(sentence, token, token_type, head, head_type, sentence_cache)
-        if pattern != "":
+        for i in 0 ..< sentence.tokens.len - 1:
+            var token = sentence.tokens[i]
+            var next_token = sentence.tokens[i + 1]
+            # "back get" and "get back" were indexed above and should not be indexed again
+            if token.head_id == next_token.id or next_token.head_id == token.id:
+                continue
+            for (token_type, head_type) in self.tokenHeadTypes(token, next_token):
+                var bigram = self.collectBigram(sentence, result, cache, token, token_type, next_token, head_type)
+                result.bigrams.add(move(bigram))
+
+proc countForm(self: PatternIndexer, collected: CollectedSentence, form: IndexedForm) =
+    var pattern = self.internPattern(collected.forms[form.form].value_ids)
+    if form.token_type != ttNil:
+        self.token_to_type[pattern] = form.token_type
+    if form.add_position:
+        self.pattern_counts[pattern] += 1
+
+proc applySentence(self: PatternIndexer, sent_idx: int, collected: CollectedSentence): HashSet[PatternId] =
+    if self.settings.is_target_mode and not self.has_target[sent_idx]:
+        # without a target token a sentence has no patterns, so it is never merged nor reindexed:
+        # its single tokens count as components but need no positions
+        for bigram in collected.bigrams:
+            self.countForm(collected, bigram.token)
+            if bigram.has_head:
+                self.countForm(collected, bigram.head)
+        return
+    for bigram in collected.bigrams:
+        var pattern = self.applyBigram(sent_idx, collected, bigram)
+        if pattern != NoPattern:
             result.incl(pattern)
 
+proc isCountOnly(self: IndexSettings, has_target: seq[bool], sentence: Sentence): bool {.inline.} =
+    # target mode: an unmerged sentence without a target token only adds to the counts of its single tokens
+    self.is_target_mode and not has_target[sentence.id] and sentence.merges.len == 0
+
+proc countSentence(self: PatternIndexer, sentence: Sentence) =
+    ## what applySentence() keeps of a sentence without a target token, without collecting its bigrams: the
+    ## forms of its single tokens, interned and counted in the order collectSentence() would give them
+    var counted_types = newSeq[set[TokenType]](sentence.tokens.len)
+    var value_ids = @[0]
+    template countToken(token: Token, token_type: TokenType) =
+        value_ids[0] = token.getValueId(token_type)
+        var pattern = self.internPattern(value_ids)
+        self.token_to_type[pattern] = token_type
+        if token_type notin counted_types[token.id]:
+            counted_types[token.id].incl(token_type)
+            self.pattern_counts[pattern] += 1
+    template countBigram(token: Token, head: Token) =
+        for (token_type, head_type) in self.settings.tokenHeadTypes(token, head):
+            countToken(token, token_type)
+            if token.id != head.id and token.getValueId(ttUpos) != self.settings.punct_id and
+                    head.getValueId(ttUpos) != self.settings.punct_id:
+                countToken(head, head_type)
+    for token in sentence.tokens:
+        countBigram(token, sentence.tokens[token.head_id])
+    if self.settings.merge_adjacent:
+        for i in 0 ..< sentence.tokens.len - 1:
+            var token = sentence.tokens[i]
+            var next_token = sentence.tokens[i + 1]
+            if token.head_id != next_token.id and next_token.head_id != token.id:
+                countBigram(token, next_token)
+
+proc indexSentence(self: PatternIndexer, sentence: Sentence): HashSet[PatternId] {.discardable.} =
+    if self.settings.isCountOnly(self.has_target, sentence):
+        self.countSentence(sentence)
+        return
+    self.applySentence(sentence.id, self.settings.collectSentence(sentence))
+
+
+type ShardArgs = object
+    settings: ptr IndexSettings
+    sentences: ptr seq[Sentence]
+    has_target: ptr seq[bool]
+    sent_idxes: ptr seq[int]
+    first: int
+    last: int
+    collected: ptr seq[CollectedSentence]
+
+proc collectShard(args: ShardArgs) {.thread.} =
+    # each thread only touches the sentences of its own shard
+    for i in args.first ..< args.last:
+        var sentence {.cursor.} = args.sentences[][args.sent_idxes[][i]]
+        if not args.settings[].isCountOnly(args.has_target[], sentence):
+            args.collected[][i] = args.settings[].collectSentence(sentence)
+
+const sentences_per_thread_batch = 2048
+
+proc indexSentences(self: PatternIndexer, sent_idxes: seq[int]): HashSet[PatternId] =
+    ## index the sentences as indexSentence() would in the given order; with several threads,
+    ## shards of a batch are collected in parallel and applied in order so that ids stay deterministic
+    if self.n_threads <= 1 or sent_idxes.len < 2 * self.n_threads:
+        for sent_idx in sent_idxes:
+            result.incl(self.indexSentence(self.corpus.sentences[sent_idx]))
+        return
+    var batch_size = self.n_threads * sentences_per_thread_batch
+    var threads = newSeq[Thread[ShardArgs]](self.n_threads)
+    var start = 0
+    while start < sent_idxes.len:
+        var batch = sent_idxes[start ..< min(start + batch_size, sent_idxes.len)]
+        var collected = newSeq[CollectedSentence](batch.len)
+        var shard_size = (batch.len + self.n_threads - 1) div self.n_threads
+        for t in 0 ..< self.n_threads:
+            var args = ShardArgs(settings: addr self.settings, sentences: addr self.corpus.sentences,
+                                 has_target: addr self.has_target, sent_idxes: addr batch,
+                                 first: min(t * shard_size, batch.len), last: min((t + 1) * shard_size, batch.len),
+                                 collected: addr collected)
+            createThread(threads[t], collectShard, args)
+        joinThreads(threads)
+        for i, sent_idx in batch:
+            if self.settings.isCountOnly(self.has_target, self.corpus.sentences[sent_idx]):
+                self.countSentence(self.corpus.sentences[sent_idx])
+            else:
+                result.incl(self.applySentence(sent_idx, collected[i]))
+        start += batch_size
+
 proc unindexSentence(self: PatternIndexer, sent_idx: int) =
     if sent_idx notin self.sent_idx_to_pattern_counts:
         # TODO: only necessary after markSentencesWithTargetTokens()?
         return
     for pattern, count in self.sent_idx_to_pattern_counts[sent_idx].pairs():
-        self.pattern_counts[pattern] -= count # self.sent_idx_to_positions[sent_idx].len
-        for pos in self.sent_idx_to_positions[sent_idx]:
-            # pos.disabled = true
-            self.pattern_positions[pattern].excl(pos)
-        # self.pattern_positions[pattern].excl(self.sent_idx_to_positions[sent_idx].toHashSet())
+        self.pattern_counts[pattern] -= count
+    # each position is removed from the pattern it was added to, once
+    for (pattern, pos) in self.sent_idx_to_positions[sent_idx]:
+        self.pattern_positions[pattern].excl(pos)
     self.sent_idx_to_positions.del(sent_idx)
     self.sent_idx_to_pattern_counts.del(sent_idx)
 
 proc markSkippedTokens(self: PatternIndexer, token_lemma: string, sentence: Sentence) =
-    ## mark tokens as skipped if they are not related to token_lemma
-    var head_id_to_dep_ids: Table[int, HashSet[int]]
-    var relations: Table[int, HashSet[int]] # relations between a token and all connected tokens
-    var to_mark: seq[(int, int)] # token_id, level
-    var marked_ids: HashSet[int]
+    ## mark tokens as skipped if they are not related to token_lemma: tokens are reached level by level
+    ## from its tokens (level 1) and their heads and next tokens (level 2), and a token reached at a level
+    ## up to max_hops keeps itself and its relations (head and dependents)
+    var max_hops = self.settings.max_hops
+    var relations = newSeq[seq[int]](sentence.tokens.len)
+    var levels = newSeq[seq[int]](max_hops + 2) # token ids to visit at each level
+    var lemma_id = self.corpus.vocab.lookup(token_lemma)
     for token in sentence.tokens:
-        var head_id = token.head_id
-        if head_id notin head_id_to_dep_ids:
-            head_id_to_dep_ids[head_id] = HashSet[int]()
-        head_id_to_dep_ids[head_id].incl(token.id)
-        for id in [token.id, head_id]:
-            if id notin relations:
-                relations[id] = HashSet[int]()
-        relations[head_id].incl(token.id)
-        relations[token.id].incl(head_id)
-        if token.lemma == token_lemma:
-            to_mark.add((token.id, 1))
-            to_mark.add((token.head_id, 2)) # ignore its relations (to some degree)
-            if self.merge_adjacent and token.id + 1 < sentence.tokens.len:
-                var next_token = sentence.tokens[token.id + 1]
-                to_mark.add((next_token.id, 2)) # ignore its relations
+        relations[token.head_id].add(token.id)
+        relations[token.id].add(token.head_id)
+        if token.getValueId(ttLemma) == lemma_id:
+            levels[1].add(token.id)
+            levels[2].add(token.head_id) # ignore its relations (to some degree)
+            if self.settings.merge_adjacent and token.id + 1 < sentence.tokens.len:
+                levels[2].add(token.id + 1) # ignore its relations
         token.skipped = true
-
-    while to_mark.len > 0:
-        var (token_id, level) = to_mark.pop()
-        if token_id in marked_ids:
-            continue
-        marked_ids.incl(token_id)
-        if level > self.max_hops: # unproductive
-            continue
-        sentence.tokens[token_id].skipped = false
-        var rel_ids = relations[token_id]
-        for rel_id in rel_ids:
-            sentence.tokens[rel_id].skipped = false
-            if level < self.max_hops:
-                to_mark.add((rel_id, level + 1))
-                to_mark.add((sentence.tokens[rel_id].head_id, level + 1))
+    var visited = newSeq[bool](sentence.tokens.len)
+    for level in 1 .. max_hops:
+        for i in 0 ..< levels[level].len:
+            var token_id = levels[level][i]
+            if visited[token_id]:
+                continue
+            visited[token_id] = true
+            sentence.tokens[token_id].skipped = false
+            for rel_id in relations[token_id]:
+                sentence.tokens[rel_id].skipped = false
+                if level < max_hops:
+                    levels[level + 1].add(rel_id)
+                    levels[level + 1].add(sentence.tokens[rel_id].head_id)
 
 proc markSentencesWithTargetTokens(self: PatternIndexer) =
-    if self.is_target_mode and self.max_hops > 0:
-        for lemma in self.target_tokens.keys():
-            for pos in self.getPositions(lemma):
-                self.markSkippedTokens(lemma, self.corpus.sentences[pos.sent_idx])
+    if self.settings.is_target_mode and self.settings.max_hops > 0:
+        for lemma, sent_idxes in self.lemma_to_sent_idxes.pairs():
+            for sent_idx in sent_idxes:
+                if self.has_target[sent_idx]: # the others are never reindexed
+                    self.markSkippedTokens(lemma, self.corpus.sentences[sent_idx])
+
+
+# binary files of mining state: the index cache below and checkpoints (see writeCheckpoint())
+proc writeInts(stream: Stream, values: openArray[int]) =
+    stream.write(int64(values.len))
+    for value in values:
+        stream.write(int64(value))
+
+proc readInts(stream: Stream): seq[int] =
+    result = newSeq[int](int(stream.readInt64()))
+    for i in 0 ..< result.len:
+        result[i] = int(stream.readInt64())
+
+proc writeString(stream: Stream, value: string) =
+    stream.write(int64(value.len))
+    stream.write(value)
+
+proc readString(stream: Stream): string =
+    stream.readStr(int(stream.readInt64()))
+
+
+const index_cache_magic = "CXINDX02"
+
+proc indexKey(self: PatternIndexer, config: JsonNode): string =
+    ## identifies the first index of the corpus: it only depends on the corpus and the settings below
+    var ctx = newSha1State()
+    ctx.update(index_cache_magic)
+    for key in ["token_types", "allowed_values", "ignored_values", "target_tokens"]:
+        ctx.update(key & "=" & (if config.hasKey(key): $config[key] else: "") & "\n")
+    ctx.update(fmt"max_hops={self.settings.max_hops}; merge_adjacent={self.settings.merge_adjacent}\n")
+    for value in self.corpus.vocab.values:
+        ctx.update($value.len & ":" & value)
+    for sentence in self.corpus.sentences:
+        ctx.update(fmt"{sentence.tokens.len};")
+        for token in sentence.tokens:
+            ctx.update(fmt"{token.head_id},")
+            ctx.update(cast[ptr UncheckedArray[char]](unsafeAddr token.value_ids).toOpenArray(
+                0, sizeof(token.value_ids) - 1))
+    $SecureHash(ctx.finalize())
+
+proc writeIndexCache(self: PatternIndexer, path: string, candidates: HashSet[PatternId]) =
+    var temp_path = fmt"{path}.{getCurrentProcessId()}.tmp" # jobs of a project may share the cache
+    var stream = newFileStream(temp_path, fmWrite)
+    if stream == nil:
+        raise newException(IOError, fmt"cannot open {temp_path} for writing")
+    stream.write(index_cache_magic)
+    stream.write(int64(self.patterns.len))
+    for pattern, value_ids in self.patterns:
+        stream.writeInts(value_ids)
+        stream.write(int64(self.pattern_to_bigrams[pattern][0]))
+        stream.write(int64(self.pattern_to_bigrams[pattern][1]))
+        stream.write(int64(ord(self.token_to_type[pattern])))
+        stream.write(int64(self.pattern_counts[pattern])) # includes the sentences without positions in target mode
+        stream.write(int64(self.pattern_positions[pattern].len))
+        for pos in self.sortedPositions(pattern):
+            stream.write(int64(pos.sent_idx))
+            stream.writeInts(pos.token_ids)
+    stream.writeInts(candidates.toSeq())
+    var marked_sent_idxes: seq[int]
+    for sent_idx, sentence in self.corpus.sentences:
+        if sentence.tokens.anyIt(it.skipped):
+            marked_sent_idxes.add(sent_idx)
+    stream.write(int64(marked_sent_idxes.len))
+    for sent_idx in marked_sent_idxes:
+        stream.write(int64(sent_idx))
+        stream.writeInts(self.corpus.sentences[sent_idx].tokens.filterIt(it.skipped).mapIt(it.id))
+    stream.close()
+    moveFile(temp_path, path)
+
+proc loadIndexCache(self: PatternIndexer, path: string): HashSet[PatternId] =
+    var stream = newFileStream(path, fmRead)
+    if stream == nil:
+        raise newException(IOError, fmt"cannot open {path}")
+    defer: stream.close()
+    if stream.readStr(index_cache_magic.len) != index_cache_magic:
+        raise newException(ValueError, fmt"{path} is not an index cache")
+    for _ in 0 ..< int(stream.readInt64()):
+        var pattern = self.internPattern(stream.readInts())
+        var token1 = int(stream.readInt64())
+        var token2 = int(stream.readInt64())
+        self.pattern_to_bigrams[pattern] = (token1, token2)
+        self.token_to_type[pattern] = TokenType(stream.readInt64())
+        var count = int(stream.readInt64())
+        for _ in 0 ..< int(stream.readInt64()):
+            var pos = Position(sent_idx: int(stream.readInt64()))
+            pos.token_ids = stream.readInts()
+            self.addPosition(pattern, pos)
+        self.pattern_counts[pattern] = count
+    for pattern in 0 ..< self.patterns.len:
+        var (token1, token2) = self.pattern_to_bigrams[pattern]
+        if token1 != NoPattern:
+            self.component_to_patterns[token1].add(pattern)
+            if token2 != token1:
+                self.component_to_patterns[token2].add(pattern)
+    result = stream.readInts().toHashSet()
+    for _ in 0 ..< int(stream.readInt64()):
+        var sentence = self.corpus.sentences[int(stream.readInt64())]
+        for token_id in stream.readInts():
+            sentence.tokens[token_id].skipped = true
+
+proc indexCorpus(self: PatternIndexer, cache_path: string = ""): HashSet[PatternId] =
+    ## the first index of the whole corpus, with the sentences of target tokens marked; it is
+    ## loaded from cache_path if that exists, and saved there otherwise
+    var start_time = epochTime()
+    if cache_path != "" and fileExists(cache_path):
+        result = self.loadIndexCache(cache_path)
+        echo fmt"Loaded the index of {self.corpus.sentences.len} sents from {cache_path} in {epochTime() - start_time:.3f}s"
+        return
+    result = self.indexSentences(toSeq(0 ..< self.corpus.sentences.len))
+    echo fmt"Indexed {self.corpus.sentences.len} sents in {epochTime() - start_time:.3f}s with {self.n_threads} thread(s)"
+    if self.settings.is_target_mode:
+        echo fmt"{self.has_target.countIt(it)} sents with target tokens"
+    self.markSentencesWithTargetTokens()
+    if cache_path != "":
+        createDir(parentDir(cache_path))
+        self.writeIndexCache(cache_path, result)
 
 
 type ScoredPattern = ref object
+    id: PatternId
     pattern: string
     left: string
     right: string
     score: float64
     count: int
+    # the inputs of score, so that it can be recomputed under other measures (see scorePatterns())
+    left_count: int
+    right_count: int
+    total_token_count: int
     task_id: int
 
 proc hash(self: ScoredPattern): Hash =
@@ -322,11 +730,49 @@ proc `==`(self: ScoredPattern, other: ScoredPattern): bool =
     self.pattern == other.pattern
 
 
+# the ranking under these measures is unaffected by the shrinking total_token_count
+# and their scores can only go down as it shrinks, so unchanged patterns need no rescoring
+const total_monotone_measures = {mtPMI, mtPMI2, mtPMI3, mtLogDice}
+
+type QueuedPattern = object
+    score: float64
+    pattern: PatternId
+    version: int
+
+proc `<`(self: QueuedPattern, other: QueuedPattern): bool =
+    # HeapQueue is a min-heap: the highest score comes first; ties are broken by form in popTopPattern(),
+    # so that forms are only built for them
+    if self.score != other.score:
+        return self.score > other.score
+    self.pattern < other.pattern
+
+type ScoreState = object
+    # inputs of the last score of a queued pattern
+    version: int
+    score: float64
+    count: int
+    left_count: int
+    right_count: int
+    total_token_count: int
+
+
+type RoundStats = object
+    # where the time (in seconds) of a round of mergeTopPatterns() goes, and the sizes it works on
+    reindex_time: float
+    scoring_time: float
+    sorting_time: float # taking the best candidates off score_queue
+    merging_time: float
+    db_time: float # in on_merge
+    n_affected_sents: int
+    n_candidates: int
+    n_discarded: int
+
+
 type PatternAnalyzer = ref object
     corpus: Corpus
     indexer: PatternIndexer
-    candidate_patterns: HashSet[string]
-    discarded_patterns: HashSet[string]
+    candidate_patterns: HashSet[PatternId]
+    discarded_patterns: HashSet[PatternId]
     merged_patterns: OrderedSet[ScoredPattern]
     total_token_count: int
     min_score_threshold: float64
@@ -334,10 +780,31 @@ type PatternAnalyzer = ref object
     affected_sent_idxes: HashSet[int]
     association_measure: MeasureType
     task_id: int
+    score_queue: HeapQueue[QueuedPattern]
+    score_states: Table[PatternId, ScoreState]
+    # the version of the last push onto score_queue; it only increases, so that an entry pushed before its
+    # state was deleted (discarded or merged) cannot match a later state of the same pattern
+    last_version: int
+    last_round_token_count: int # total_token_count used for scoring in the previous round
+    is_indexed: bool # whether the corpus has been indexed by a first round
+    rescore_all: bool # set after loadCheckpoint(), which does not restore score_queue
+    index_cache_path: string # where the first index is cached; "" for no cache
+    round_stats: RoundStats # of the last round
+    settings: string # the settings of the patterns mined, see checkpointSettings()
+
+const checkpoint_setting_keys = ["token_types", "allowed_values", "ignored_values", "target_tokens",
+                                 "association_measure", "min_score_threshold", "min_pattern_freq_per_mill",
+                                 "n_per_round"]
+
+proc checkpointSettings(config: JsonNode): string =
+    ## the settings that decide which patterns are merged; a run can only be resumed with those of its checkpoint
+    for key in checkpoint_setting_keys:
+        result.add(key & "=" & (if config.hasKey(key): $config[key] else: "") & "\n")
 
 proc init(self: PatternAnalyzer, config: JsonNode = parseJson("{}")) =
     self.indexer = PatternIndexer()
     self.indexer.init(self.corpus, config = config)
+    self.settings = checkpointSettings(config)
     self.total_token_count = self.corpus.total_token_count
     var min_pattern_freq_per_mill = config{"min_pattern_freq_per_mill"}.getInt()
     min_pattern_freq_per_mill = max(min_pattern_freq_per_mill, 1)
@@ -352,136 +819,632 @@ proc init(self: PatternAnalyzer, config: JsonNode = parseJson("{}")) =
         self.min_score_threshold = measure_thresholds[self.association_measure]
     debugEcho fmt"{self.association_measure}, {self.min_pattern_freq} {min_pattern_freq_per_mill}, {self.min_score_threshold}"
 
-proc scorePattern(self: PatternAnalyzer, pattern: string): float64 =
+proc computeScore(self: PatternAnalyzer, pattern_count, token1_count, token2_count: int,
+        total_token_count: int): float64 {.inline.} =
+    associationScore(self.association_measure, pattern_count, token1_count, token2_count, total_token_count)
+
+proc scorePattern(self: PatternAnalyzer, pattern: PatternId, total_token_count: int): float64 =
     var (token1, token2) = self.indexer.pattern_to_bigrams[pattern]
-    var pattern_count = self.indexer.count(pattern)
-    var token1_count = self.indexer.count(token1)
-    var token2_count = self.indexer.count(token2)
-    if token1_count == 0 or token2_count == 0:
-        return 0.0
-    case self.association_measure:
-    of mtLoglikelihood:
-        measures.logLikelihood(token1_count, token2_count, pattern_count, self.total_token_count)
-    of mtDeltaP:
-        max(measures.deltaP(token1_count, token2_count, pattern_count, self.total_token_count))
-    of mtPMI, mtPMI2, mtPMI3:
-        measures.pmi(@[token1_count, token2_count], pattern_count,
-                        self.total_token_count, ord(self.association_measure) + 1)
-    of mtLogDice:
-        measures.logDice(token1_count, token2_count, pattern_count, self.total_token_count)
-
-proc mergePattern(self: PatternAnalyzer, pattern: string) =
-    self.total_token_count -= self.indexer.count(pattern)
-    var token_types: seq[TokenType]
+    self.computeScore(self.indexer.count(pattern), self.indexer.count(token1),
+                      self.indexer.count(token2), total_token_count)
+
+proc scorePattern(self: PatternAnalyzer, pattern: PatternId): float64 =
+    self.scorePattern(pattern, self.total_token_count)
+
+proc queuePattern(self: PatternAnalyzer, pattern: PatternId, total_token_count: int): bool {.discardable.} =
+    ## score a candidate and push it onto score_queue; discard it if it does not qualify
+    var count = self.indexer.count(pattern)
+    if count < self.min_pattern_freq:
+        self.discarded_patterns.incl(pattern)
+        self.score_states.del(pattern)
+        return false
+    var (token1, token2) = self.indexer.pattern_to_bigrams[pattern]
+    var state = ScoreState(count: count, left_count: self.indexer.count(token1),
+                           right_count: self.indexer.count(token2),
+                           total_token_count: total_token_count)
+    state.score = self.computeScore(state.count, state.left_count, state.right_count, total_token_count)
+    if state.score < self.min_score_threshold:
+        self.discarded_patterns.incl(pattern)
+        self.score_states.del(pattern)
+        return false
+    self.last_version += 1
+    state.version = self.last_version
+    self.score_states[pattern] = state
+    self.score_queue.push(QueuedPattern(score: state.score, pattern: pattern, version: state.version))
+    return true
+
+proc rescoreCandidates(self: PatternAnalyzer, dirty_patterns: HashSet[PatternId], total_token_count: int) =
+    ## rescore only the candidates whose count or component counts have changed
+    var to_rescore: HashSet[PatternId]
+    if self.association_measure notin total_monotone_measures:
+        # every score may move in either direction with total_token_count
+        self.score_queue.clear()
+        to_rescore = self.candidate_patterns
+    else:
+        for pattern in dirty_patterns:
+            if pattern in self.candidate_patterns:
+                to_rescore.incl(pattern)
+            for parent in self.indexer.component_to_patterns[pattern]:
+                if parent in self.candidate_patterns:
+                    to_rescore.incl(parent)
+    for pattern in to_rescore:
+        if self.last_round_token_count > 0 and pattern in self.score_states and
+                self.association_measure in total_monotone_measures:
+            # a full rescan would have scored the old counts in every round up to now;
+            # the lowest of those scores is the one of the previous round
+            var state = self.score_states[pattern]
+            var last_score = self.computeScore(state.count, state.left_count, state.right_count,
+                                               self.last_round_token_count)
+            if last_score < self.min_score_threshold:
+                self.discarded_patterns.incl(pattern)
+                self.score_states.del(pattern)
+                continue
+        self.queuePattern(pattern, total_token_count)
+
+proc popValidPattern(self: PatternAnalyzer, total_token_count: int): (bool, QueuedPattern) =
+    ## pop the best candidate whose queued score is up to date with total_token_count
+    while self.score_queue.len > 0:
+        var top = self.score_queue.pop()
+        if top.pattern notin self.candidate_patterns or top.pattern notin self.score_states:
+            continue
+        var state = self.score_states[top.pattern]
+        if state.version != top.version: # superseded by a later push
+            continue
+        if state.total_token_count != total_token_count:
+            # queued scores are upper bounds; refresh the stale one and let the queue reorder
+            self.queuePattern(top.pattern, total_token_count)
+            continue
+        return (true, top)
+    return (false, QueuedPattern())
+
+proc popTopPattern(self: PatternAnalyzer, total_token_count: int): (bool, QueuedPattern) =
+    ## popValidPattern(), with ties of score broken by form; the others tied are pushed back
+    result = self.popValidPattern(total_token_count)
+    if not result[0]:
+        return
+    var ties: seq[QueuedPattern]
+    while self.score_queue.len > 0 and self.score_queue[0].score == result[1].score:
+        var (found, tie) = self.popValidPattern(total_token_count)
+        if not found:
+            break
+        if tie.score != result[1].score: # a stale one refreshed to a lower score
+            self.score_queue.push(tie)
+            break
+        ties.add(tie)
+    if ties.len == 0:
+        return
+    var top_form = self.indexer.getForm(result[1].pattern)
+    for i in 0 ..< ties.len:
+        var form = self.indexer.getForm(ties[i].pattern)
+        if form < top_form:
+            swap(ties[i], result[1])
+            top_form = form
+    for tie in ties:
+        self.score_queue.push(tie)
+
+proc mergeTokenTypes(self: PatternAnalyzer, pattern: PatternId): seq[TokenType] =
+    ## the chosen_type given to the tokens of a merge of the pattern
     var (token1, token2) = self.indexer.pattern_to_bigrams[pattern]
     # three possible scenarios for (i)ndividual or (m)erged tokens
     # 1. i + i (2-gram)  2. i + m OR m + i (1-gram)  3. m + m (nothing)
-    if "~" notin token1 and "~" notin token2: #  i + i
+    var single1 = self.indexer.isSingleToken(token1)
+    var single2 = self.indexer.isSingleToken(token2)
+    if single1 and single2: #  i + i
         # generate the chosen_type of each token to be passed
-        if token1 in self.indexer.token_to_type and token2 in self.indexer.token_to_type:
-            token_types = @[self.indexer.token_to_type[token1],
-                            self.indexer.token_to_type[token2]]
-    elif "~" notin token1: # i + m
-        token_types = @[self.indexer.token_to_type[token1]]
-    elif "~" notin token2: # m + i
-        token_types = @[self.indexer.token_to_type[token2]]
+        if self.indexer.token_to_type[token1] != ttNil and self.indexer.token_to_type[token2] != ttNil:
+            result = @[self.indexer.token_to_type[token1],
+                       self.indexer.token_to_type[token2]]
+    elif single1: # i + m
+        result = @[self.indexer.token_to_type[token1]]
+    elif single2: # m + i
+        result = @[self.indexer.token_to_type[token2]]
+
+proc mergePositions(self: PatternAnalyzer, positions: seq[Position], token_types: seq[TokenType]) =
     # For the sentence "A accused B, C of something",
     # "accuse~of" is counted once, but "accuse~NOUN~of" is counted twice
     # To simplify, we count one pattern per sentence
-    for pos in self.indexer.getPositions(pattern):
+    for pos in positions:
         var sent = self.corpus.sentences[pos.sent_idx]
         sent.addMerge(pos.token_ids, token_types = token_types)
+
+proc mergePattern(self: PatternAnalyzer, pattern: PatternId) =
+    self.total_token_count -= self.indexer.count(pattern)
+    var positions = self.indexer.sortedPositions(pattern)
+    self.mergePositions(positions, self.mergeTokenTypes(pattern))
+    for pos in positions:
         self.affected_sent_idxes.incl(pos.sent_idx)
 
-proc mergeTopPatterns(self: PatternAnalyzer, n: int = 100,
-        on_merge: proc (pa: PatternAnalyzer, scored_pattern: ScoredPattern) = nil
-    ): OrderedSet[ScoredPattern] =
+proc overlapsTokens(self: PatternIndexer, pattern: PatternId, token_keys: HashSet[(int, int)]): bool =
+    ## whether a position of the pattern has a token among token_keys (sent_idx, token_id)
+    for pos in self.getPositions(pattern):
+        for token_id in pos.token_ids:
+            if (pos.sent_idx, token_id) in token_keys:
+                return true
+    return false
+
+proc reindexAffected(self: PatternAnalyzer): (HashSet[PatternId], HashSet[PatternId]) =
+    ## index the corpus in the first round and the sentences affected by the merges of the last one after it;
+    ## returns the candidates found and the patterns whose counts may have changed
     var affected_sent_idxes = self.affected_sent_idxes
     self.affected_sent_idxes.clear()
-    var candidates: HashSet[string]
-    if affected_sent_idxes.len == 0: # first time
-        for sentence in self.corpus.sentences:
-            candidates.incl(self.indexer.indexSentence(sentence))
-        self.indexer.markSentencesWithTargetTokens()
+    self.round_stats = RoundStats(n_affected_sents: if self.is_indexed: affected_sent_idxes.len
+                                                    else: self.corpus.sentences.len)
+    var start_time = epochTime()
+    var candidates: HashSet[PatternId]
+    # patterns whose counts may have changed since the last round
+    var dirty_patterns: HashSet[PatternId]
+    if not self.is_indexed: # first time
+        candidates = self.indexer.indexCorpus(self.index_cache_path)
+        self.is_indexed = true
+        dirty_patterns = candidates
     else:
-        for sent_idx in affected_sent_idxes:
+        # in corpus order, so that new patterns get the same ids in a run resumed from a checkpoint
+        var sent_idxes = affected_sent_idxes.toSeq().sorted()
+        for sent_idx in sent_idxes:
+            for pattern in self.indexer.sent_idx_to_pattern_counts.getOrDefault(sent_idx).keys():
+                dirty_patterns.incl(pattern)
             self.indexer.unindexSentence(sent_idx)
-            candidates.incl(self.indexer.indexSentence(self.corpus.sentences[sent_idx]))
+        candidates = self.indexer.indexSentences(sent_idxes)
+        for sent_idx in sent_idxes:
+            for pattern in self.indexer.sent_idx_to_pattern_counts.getOrDefault(sent_idx).keys():
+                dirty_patterns.incl(pattern)
+    self.round_stats.reindex_time = epochTime() - start_time
+    result = (candidates, dirty_patterns)
+
+proc chooseAndMerge(self: PatternAnalyzer, n: int, candidates: HashSet[PatternId],
+        dirty_patterns: HashSet[PatternId],
+        on_merge: proc (pa: PatternAnalyzer, scored_pattern: ScoredPattern) = nil
+    ): OrderedSet[ScoredPattern] =
+    ## score the candidates and merge the best n of them that do not conflict
     self.candidate_patterns.incl(candidates)
-    var scored_patterns: seq[ScoredPattern]
-    var score: float64
     self.candidate_patterns.excl(self.discarded_patterns)
-    for pattern in self.candidate_patterns:
-        if self.indexer.count(pattern) >= self.min_pattern_freq:
-            score = self.scorePattern(pattern)
-            if score < self.min_score_threshold:
-                self.discarded_patterns.incl(pattern)
-                continue
-            scored_patterns.add(ScoredPattern(pattern: pattern, score: score, count: self.indexer.count(pattern)))
-        else:
-            self.discarded_patterns.incl(pattern)
-    scored_patterns.sort((x, y) => -cmp(x.score, y.score))
-    var merged_tokens: seq[string]
-    # echo "top 5 patterns: ", scored_patterns.first(5)
-    for i, sp in enumerate(scored_patterns):
-        var pattern = sp.pattern
-        var (token1, token2) = self.indexer.pattern_to_bigrams[pattern] # Why can't I put .fields here?
+    var dirty_patterns = dirty_patterns
+    if self.rescore_all:
+        dirty_patterns = self.candidate_patterns
+        self.rescore_all = false
+    # scores of this round are all relative to the token count before any of its merges
+    var round_token_count = self.total_token_count
+    var start_time = epochTime()
+    self.rescoreCandidates(dirty_patterns, round_token_count)
+    self.round_stats.scoring_time = epochTime() - start_time
+    self.last_round_token_count = round_token_count
+    var merged_tokens: HashSet[PatternId]
+    # in target mode most candidates share the tokens of targets, so patterns whose positions overlap
+    # those merged before in the round are also conflicts
+    var is_target_mode = self.indexer.settings.is_target_mode
+    var merged_token_keys: HashSet[(int, int)] # (sent_idx, token_id)
+    var skipped: seq[QueuedPattern] # conflicting patterns stay candidates for the next round
+    var i = 0
+    while true:
+        start_time = epochTime()
+        var (found, top) = self.popTopPattern(round_token_count)
+        self.round_stats.sorting_time += epochTime() - start_time
+        if not found:
+            break
+        var pattern = top.pattern
+        var (token1, token2) = self.indexer.pattern_to_bigrams[pattern]
         # avoid conflicts of components in bigrams in the same round
-        if token1 in merged_tokens or token2 in merged_tokens:
+        if token1 in merged_tokens or token2 in merged_tokens or
+                (is_target_mode and self.indexer.overlapsTokens(pattern, merged_token_keys)):
+            skipped.add(top)
+            i += 1
             continue
-        merged_tokens.add(token1)
-        merged_tokens.add(token2)
-        sp.left = token1
-        sp.right = token2
+        merged_tokens.incl(token1)
+        merged_tokens.incl(token2)
+        if is_target_mode:
+            for pos in self.indexer.getPositions(pattern):
+                for token_id in pos.token_ids:
+                    merged_token_keys.incl((pos.sent_idx, token_id))
+        var state = self.score_states[pattern] # up to date with round_token_count after popTopPattern()
+        var sp = ScoredPattern(id: pattern, pattern: self.indexer.getForm(pattern), score: top.score,
+                               count: self.indexer.count(pattern),
+                               left: self.indexer.getForm(token1), right: self.indexer.getForm(token2),
+                               left_count: state.left_count, right_count: state.right_count,
+                               total_token_count: state.total_token_count)
+        start_time = epochTime()
         self.mergePattern(pattern)
+        self.round_stats.merging_time += epochTime() - start_time
         if on_merge != nil:
+            start_time = epochTime()
             on_merge(self, sp)
+            self.round_stats.db_time += epochTime() - start_time
         self.candidate_patterns.excl(pattern)
+        self.score_states.del(pattern)
         if sp in self.merged_patterns: # sometimes the same pattern is merged twice (A~B+C==A+B~C)
+            i += 1
             continue # so that the number of merged_patterns always changes
         self.merged_patterns.incl(sp)
         result.incl(sp)
         if i >= n - 1:
             break
+        i += 1
+    for top in skipped:
+        self.score_queue.push(top)
+    self.round_stats.n_candidates = self.candidate_patterns.len
+    self.round_stats.n_discarded = self.discarded_patterns.len
+
+proc mergeTopPatterns(self: PatternAnalyzer, n: int = 100,
+        on_merge: proc (pa: PatternAnalyzer, scored_pattern: ScoredPattern) = nil
+    ): OrderedSet[ScoredPattern] =
+    var (candidates, dirty_patterns) = self.reindexAffected()
+    self.chooseAndMerge(n, candidates, dirty_patterns, on_merge)
+
+proc roundRecord(self: PatternAnalyzer, round: int, total_time: float): JsonNode =
+    ## the telemetry of a round, as written to the telemetry JSONL file and the taskround table
+    var stats = self.round_stats
+    %*{"round": round, "total_time": total_time, "reindex_time": stats.reindex_time,
+       "scoring_time": stats.scoring_time, "sorting_time": stats.sorting_time,
+       "merging_time": stats.merging_time, "db_time": stats.db_time,
+       "n_affected_sents": stats.n_affected_sents, "n_candidates": stats.n_candidates,
+       "n_discarded": stats.n_discarded, "n_merged": self.merged_patterns.len,
+       "remaining_tokens": self.total_token_count, "peak_rss_mb": peakRssMb()}
+
+proc writeResult(file: var File, sp: ScoredPattern, count2, count3: int) =
+    # count2 and count3: the current positions of the pattern and the sentences they are in
+    file.writeLine(fmt"{sp.pattern}, {sp.left}, {sp.right}, {sp.score}, {sp.count}#{count2}#{count3}")
 
 proc writeResults(file: var File, analyzer: PatternAnalyzer, scored_patterns: OrderedSet[ScoredPattern]) =
     for sp in scored_patterns:
-        var pattern = sp.pattern
         var unique_sent_idxes: HashSet[int]
         var count2 = 0
-        for pos in analyzer.indexer.getPositions(pattern):
+        for pos in analyzer.indexer.getPositions(sp.id):
             count2 += 1
             unique_sent_idxes.incl(pos.sent_idx)
-        var count3 = unique_sent_idxes.len
-        file.writeLine(fmt"{pattern}, {sp.left}, {sp.right}, {sp.score}, {sp.count}#{count2}#{count3}")
+        file.writeResult(sp, count2, unique_sent_idxes.len)
     file.flushFile()
 
-proc storePositions(db: DbConn, analyzer: PatternAnalyzer, sp: ScoredPattern) =
+const max_slot_fillers = 10 # most frequent fillers stored per slot
+
+const checkpoint_magic = "CXCKPT04"
+
+proc writeCheckpoint(self: PatternAnalyzer, path: string, round: int) =
+    ## save what later rounds depend on: the merges of the sentences and the interned patterns, with
+    ## the candidate, discarded and merged ones; positions are rebuilt from these by loadCheckpoint()
+    var temp_path = path & ".tmp"
+    var stream = newFileStream(temp_path, fmWrite)
+    if stream == nil:
+        raise newException(IOError, fmt"cannot open {temp_path} for writing")
+    stream.write(checkpoint_magic)
+    stream.writeString(self.settings)
+    stream.write(int64(round))
+    stream.write(int64(self.corpus.sentences.len))
+    stream.write(int64(self.total_token_count))
+    stream.write(int64(self.last_round_token_count))
+    stream.write(int64(self.corpus.vocab.values.len))
+    for value in self.corpus.vocab.values:
+        stream.writeString(value)
+    var changed_sent_idxes: seq[int]
+    for sent_idx, sentence in self.corpus.sentences:
+        if sentence.merges.len > 0 or sentence.tokens.anyIt(it.skipped):
+            changed_sent_idxes.add(sent_idx)
+    stream.write(int64(changed_sent_idxes.len))
+    for sent_idx in changed_sent_idxes:
+        var sentence = self.corpus.sentences[sent_idx]
+        stream.write(int64(sent_idx))
+        stream.write(int64(sentence.merges.len))
+        for merge in sentence.merges:
+            stream.writeInts(merge)
+        stream.writeInts(sentence.tokens.mapIt(ord(it.chosen_type)))
+        stream.writeInts(sentence.tokens.filterIt(it.skipped).mapIt(it.id))
+    var indexer = self.indexer
+    stream.write(int64(indexer.patterns.len))
+    for pattern, value_ids in indexer.patterns:
+        stream.writeInts(value_ids)
+        stream.write(int64(indexer.pattern_to_bigrams[pattern][0]))
+        stream.write(int64(indexer.pattern_to_bigrams[pattern][1]))
+        stream.write(int64(ord(indexer.token_to_type[pattern])))
+    stream.writeInts(self.affected_sent_idxes.toSeq())
+    stream.writeInts(self.candidate_patterns.toSeq())
+    stream.writeInts(self.discarded_patterns.toSeq())
+    stream.write(int64(self.score_states.len))
+    for pattern, state in self.score_states.pairs():
+        stream.write(int64(pattern))
+        stream.write(int64(state.version))
+        stream.write(state.score)
+        stream.write(int64(state.count))
+        stream.write(int64(state.left_count))
+        stream.write(int64(state.right_count))
+        stream.write(int64(state.total_token_count))
+    stream.write(int64(self.merged_patterns.len))
+    for sp in self.merged_patterns:
+        stream.write(int64(sp.id))
+        stream.writeString(sp.pattern)
+        stream.writeString(sp.left)
+        stream.writeString(sp.right)
+        stream.write(sp.score)
+        stream.write(int64(sp.count))
+        stream.write(int64(sp.left_count))
+        stream.write(int64(sp.right_count))
+        stream.write(int64(sp.total_token_count))
+        stream.write(int64(sp.task_id))
+    stream.close()
+    moveFile(temp_path, path) # a crash while writing leaves the previous checkpoint intact
+
+proc loadCheckpoint(self: PatternAnalyzer, path: string): (int, int) =
+    ## restore the state saved by writeCheckpoint() into an initialised analyzer; returns the round
+    ## after which it was written and the number of sentences of the corpus then: sentences appended
+    ## since are left to indexAppendedSentences()
+    var stream = newFileStream(path, fmRead)
+    if stream == nil:
+        raise newException(IOError, fmt"cannot open {path}")
+    defer: stream.close()
+    if stream.readStr(checkpoint_magic.len) != checkpoint_magic:
+        raise newException(ValueError, fmt"{path} is not a checkpoint")
+    var settings = stream.readString()
+    if settings != self.settings:
+        raise newException(ValueError, fmt"{path} was written with other mining settings: " &
+                           settings.strip().replace("\n", "; "))
+    var round = int(stream.readInt64())
+    var n_sents = int(stream.readInt64())
+    if n_sents > self.corpus.sentences.len:
+        raise newException(ValueError, fmt"{path} was written for another corpus")
+    result = (round, n_sents)
+    self.total_token_count = int(stream.readInt64())
+    self.last_round_token_count = int(stream.readInt64())
+    # value ids of the checkpoint mapped to those of this corpus, whose vocabulary may have been
+    # loaded in another order (JSON or binary) or have grown with appended sentences
+    var value_ids = newSeq[int](int(stream.readInt64()))
+    for i in 0 ..< value_ids.len:
+        value_ids[i] = self.corpus.vocab.intern(stream.readString())
+    var skipped_token_ids: seq[(int, seq[int])]
+    for _ in 0 ..< int(stream.readInt64()):
+        var sentence = self.corpus.sentences[int(stream.readInt64())]
+        for merge_idx in 0 ..< int(stream.readInt64()):
+            var token_ids = stream.readInts()
+            sentence.merges.add(token_ids)
+            for token_id in token_ids:
+                sentence.token_id_to_merge_idx[token_id] = merge_idx
+        var chosen_types = stream.readInts()
+        if chosen_types.len != sentence.tokens.len:
+            raise newException(ValueError, fmt"{path} was written for another corpus")
+        for token_id, chosen_type in chosen_types:
+            sentence.tokens[token_id].chosen_type = TokenType(chosen_type)
+        skipped_token_ids.add((sentence.id, stream.readInts()))
+    # patterns are interned in the order of their ids, and keep their first components
+    var indexer = self.indexer
+    var token_to_type: seq[TokenType]
+    for _ in 0 ..< int(stream.readInt64()):
+        var pattern = indexer.internPattern(stream.readInts().mapIt(value_ids[it]))
+        var token1 = int(stream.readInt64())
+        var token2 = int(stream.readInt64())
+        indexer.pattern_to_bigrams[pattern] = (token1, token2)
+        token_to_type.add(TokenType(stream.readInt64()))
+    for pattern in 0 ..< indexer.patterns.len:
+        var (token1, token2) = indexer.pattern_to_bigrams[pattern]
+        if token1 != NoPattern:
+            indexer.component_to_patterns[token1].add(pattern)
+            if token2 != token1:
+                indexer.component_to_patterns[token2].add(pattern)
+    self.affected_sent_idxes = stream.readInts().toHashSet()
+    self.candidate_patterns = stream.readInts().toHashSet()
+    self.discarded_patterns = stream.readInts().toHashSet()
+    for _ in 0 ..< int(stream.readInt64()):
+        var pattern = int(stream.readInt64())
+        var state = ScoreState(version: int(stream.readInt64()))
+        state.score = stream.readFloat64()
+        state.count = int(stream.readInt64())
+        state.left_count = int(stream.readInt64())
+        state.right_count = int(stream.readInt64())
+        state.total_token_count = int(stream.readInt64())
+        self.score_states[pattern] = state
+        self.last_version = max(self.last_version, state.version)
+    for _ in 0 ..< int(stream.readInt64()):
+        var sp = ScoredPattern(id: int(stream.readInt64()))
+        sp.pattern = stream.readString()
+        sp.left = stream.readString()
+        sp.right = stream.readString()
+        sp.score = stream.readFloat64()
+        sp.count = int(stream.readInt64())
+        sp.left_count = int(stream.readInt64())
+        sp.right_count = int(stream.readInt64())
+        sp.total_token_count = int(stream.readInt64())
+        sp.task_id = int(stream.readInt64())
+        self.merged_patterns.incl(sp)
+    # rebuild the positions as the rounds so far have left them: the sentences merged in the last round
+    # are indexed by the next one, and only merged sentences were indexed after the target tokens
+    # had been marked (which sets skipped)
+    var unmerged_sent_idxes, merged_sent_idxes: seq[int]
+    for sent_idx in 0 ..< n_sents:
+        var sentence = self.corpus.sentences[sent_idx]
+        if sent_idx notin self.affected_sent_idxes:
+            if sentence.merges.len == 0:
+                unmerged_sent_idxes.add(sent_idx)
+            else:
+                merged_sent_idxes.add(sent_idx)
+    discard indexer.indexSentences(unmerged_sent_idxes)
+    for (sent_idx, token_ids) in skipped_token_ids:
+        for token_id in token_ids:
+            self.corpus.sentences[sent_idx].tokens[token_id].skipped = true
+    discard indexer.indexSentences(merged_sent_idxes)
+    indexer.token_to_type = token_to_type # indexing overwrites it in corpus order
+    self.is_indexed = true
+    self.rescore_all = true
+
+
+proc indexAppendedSentences(self: PatternAnalyzer, sent_idxes: seq[int],
+        on_replay: proc (pa: PatternAnalyzer, sp: ScoredPattern, positions: seq[Position]) = nil) =
+    ## bring sentences appended to the corpus after a checkpoint up to the state of the others: they are
+    ## indexed as by a first round, then the merged patterns are replayed on them in the order they were
+    ## merged, reindexing the sentences of each; only the new sentences are touched
+    var indexer = self.indexer
+    for sent_idx in sent_idxes:
+        self.total_token_count += self.corpus.sentences[sent_idx].tokens.len
+    var first_sent_idx = sent_idxes[0]
+    var candidates = indexer.indexSentences(sent_idxes)
+    if indexer.settings.is_target_mode and indexer.settings.max_hops > 0:
+        for lemma, lemma_sent_idxes in indexer.lemma_to_sent_idxes.pairs():
+            for sent_idx in lemma_sent_idxes:
+                if sent_idx >= first_sent_idx and indexer.has_target[sent_idx]:
+                    indexer.markSkippedTokens(lemma, self.corpus.sentences[sent_idx])
+    for sp in self.merged_patterns:
+        var positions = indexer.sortedPositions(sp.id).filterIt(it.sent_idx >= first_sent_idx)
+        if positions.len == 0:
+            continue
+        self.total_token_count -= positions.len
+        self.mergePositions(positions, self.mergeTokenTypes(sp.id))
+        sp.count += positions.len
+        var merged_sent_idxes = positions.mapIt(it.sent_idx).deduplicate(isSorted = true)
+        for sent_idx in merged_sent_idxes:
+            indexer.unindexSentence(sent_idx)
+        candidates.incl(indexer.indexSentences(merged_sent_idxes))
+        if on_replay != nil:
+            on_replay(self, sp, positions)
+    # patterns discarded for their counts may qualify with those of the new sentences
+    for sent_idx in sent_idxes:
+        for pattern in indexer.sent_idx_to_pattern_counts.getOrDefault(sent_idx).keys():
+            self.discarded_patterns.excl(pattern)
+    self.candidate_patterns.incl(candidates)
+    self.rescore_all = true
+    echo fmt"Indexed {sent_idxes.len} appended sents"
+
+
+type PatternStore = ref object
+    # writes merged patterns and their positions into the project database
+    db: DbConn
+    pattern_ids: Table[string, int64]
+    insert_pattern: BulkStatement
+    insert_position: BulkStatement
+    insert_slot_filler: BulkStatement
+
+proc openPatternStore(db_path: string, task_id: int): PatternStore =
+    result = PatternStore(db: getDatabase(db_path))
+    # a task resumed from a checkpoint already has rows for the patterns merged before it
+    for row in result.db.fastRows(sql"SELECT form, id FROM pattern WHERE task_id = ?", task_id):
+        result.pattern_ids[row[0]] = parseBiggestInt(row[1])
+    # the indexes of positions stay in place while mining, as other tasks and the Explore page read them;
+    # those lost by projects whose mining once dropped them are recreated here
+    result.db.exec(sql"CREATE INDEX IF NOT EXISTS ix_position_pattern_id ON position (pattern_id)")
+    result.db.exec(sql"CREATE INDEX IF NOT EXISTS ix_position_sentence_id ON position (sentence_id)")
+    result.insert_pattern = result.db.prepareBulk(
+        "INSERT INTO pattern (form, left, right, score, count, left_count, right_count, total_token_count, " &
+        "task_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)")
+    result.insert_position = result.db.prepareBulk(
+        "INSERT INTO position (pattern_id, sentence_id, token_ids) VALUES (?, ?, ?)")
+    result.insert_slot_filler = result.db.prepareBulk(
+        "INSERT INTO slotfiller (pattern_id, label, text, count, slot_total) VALUES (?, ?, ?, ?, ?)")
+
+proc close(self: PatternStore) =
+    self.insert_pattern.finalize()
+    self.insert_position.finalize()
+    self.insert_slot_filler.finalize()
+    self.db.close()
+
+proc storePattern(self: PatternStore, sp: ScoredPattern, task_id: int): (int64, bool) =
+    ## the row of the pattern and whether it is new: a pattern can be merged more than once (A~B+C==A+B~C);
+    ## it keeps its first row
+    var pattern_id = self.pattern_ids.getOrDefault(sp.pattern, -1)
+    if pattern_id != -1:
+        return (pattern_id, false)
+    self.insert_pattern.execBulk(sp.pattern, sp.left, sp.right, sp.score, sp.count, sp.left_count,
+                                 sp.right_count, sp.total_token_count, task_id)
+    pattern_id = self.insert_pattern.lastInsertId()
+    self.pattern_ids[sp.pattern] = pattern_id
+    (pattern_id, true)
+
+proc countSlotFillers(label_to_texts: var OrderedTable[string, CountTable[string]], labels: seq[string],
+        vocab: Vocabulary, sentence: Sentence, pos: Position) =
+    for i, token_id in pos.token_ids:
+        if i < labels.len:
+            label_to_texts.mgetOrPut(labels[i], initCountTable[string]()).inc(
+                unicode.toLower(sentence.tokens[token_id].getRawText(vocab)))
+
+proc storeSlotFillers(self: PatternStore, pattern_id: int64,
+        label_to_texts: var OrderedTable[string, CountTable[string]],
+        unstored_counts: Table[string, int] = initTable[string, int]()) =
+    # unstored_counts: fillers of each slot counted before but not among those stored
+    for label, texts in label_to_texts.mpairs():
+        var slot_total = unstored_counts.getOrDefault(label)
+        for count in texts.values():
+            slot_total += count
+        texts.sort()
+        var n = 0
+        for text, count in texts.pairs():
+            if n == max_slot_fillers:
+                break
+            self.insert_slot_filler.execBulk(pattern_id, label, text, count, slot_total)
+            n += 1
+
+proc storePositions(self: PatternStore, analyzer: PatternAnalyzer, sp: ScoredPattern) =
     # store the positions of the pattern in a sqlite database
-    # TODO: refactor using insertRowsToDB
-    var pattern = sp.pattern
-    var pattern_id: int64
-    var id = db.getValue(sql"SELECT id FROM pattern WHERE form = ? AND task_id = ?", pattern, analyzer.task_id)
-    if id != "":
-        pattern_id = parseInt(id)
-    else:
-        pattern_id = db.insertID(
-            sql"INSERT INTO pattern (form, left, right, score, count, task_id) VALUES (?, ?, ?, ?, ?, ?)",
-            pattern, sp.left, sp.right, sp.score, sp.count, analyzer.task_id
-        )
+    self.db.exec(sql"BEGIN TRANSACTION;")
+    var (pattern_id, is_new) = self.storePattern(sp, analyzer.task_id)
+    # the texts filling each slot (label) of the pattern, for "Show stats" in the Explore page;
+    # counted the first time the pattern is stored
+    var labels = sp.pattern.split("~")
+    var label_to_texts: OrderedTable[string, CountTable[string]]
+    for pos in analyzer.indexer.sortedPositions(sp.id):
+        self.insert_position.execBulk(pattern_id, pos.sent_idx, pos.token_ids.encodeTokenIds())
+        if is_new:
+            label_to_texts.countSlotFillers(labels, analyzer.corpus.vocab,
+                                            analyzer.corpus.sentences[pos.sent_idx], pos)
+    self.storeSlotFillers(pattern_id, label_to_texts)
+    self.db.exec(sql"COMMIT;")
+
+proc storeAppendedPositions(self: PatternStore, analyzer: PatternAnalyzer, sp: ScoredPattern,
+        positions: seq[Position]) =
+    # positions of a stored pattern in sentences appended to the corpus (see indexAppendedSentences());
+    # their fillers are added to the stored ones, which only hold the most frequent of each slot, so a
+    # filler can only enter them with the count it has in the new sentences
+    var pattern_id = self.pattern_ids.getOrDefault(sp.pattern, -1)
+    if pattern_id == -1:
+        return
+    self.db.exec(sql"BEGIN TRANSACTION;")
+    for pos in positions:
+        self.insert_position.execBulk(pattern_id, pos.sent_idx, pos.token_ids.encodeTokenIds())
+    self.db.exec(sql"UPDATE pattern SET count = count + ? WHERE id = ?", positions.len, pattern_id)
+    var label_to_texts: OrderedTable[string, CountTable[string]]
+    var unstored_counts: Table[string, int]
+    for row in self.db.rows(sql"SELECT label, text, count, slot_total FROM slotfiller WHERE pattern_id = ?",
+                            pattern_id):
+        var count = parseInt(row[2])
+        label_to_texts.mgetOrPut(row[0], initCountTable[string]()).inc(row[1], count)
+        if row[0] notin unstored_counts:
+            unstored_counts[row[0]] = parseInt(row[3])
+        unstored_counts[row[0]] -= count
+    # a pattern stored before slot fillers were: query_token_stats() counts them from the positions
+    if label_to_texts.len > 0:
+        var labels = sp.pattern.split("~")
+        for pos in positions:
+            label_to_texts.countSlotFillers(labels, analyzer.corpus.vocab,
+                                            analyzer.corpus.sentences[pos.sent_idx], pos)
+        self.db.exec(sql"DELETE FROM slotfiller WHERE pattern_id = ?", pattern_id)
+        self.storeSlotFillers(pattern_id, label_to_texts, unstored_counts)
+    self.db.exec(sql"COMMIT;")
+
+proc storeComponentGraph(db: DbConn, task_id: int) =
+    ## the edges from the left and right components of the merged patterns of a task to the patterns, for the
+    ## graph queries of DBManager.get_component_graph(); source_id is set when a component is itself a merged
+    ## pattern of the task. Written anew when mining ends, so counts updated by appended sentences are included
+    # components are looked up by form; without the index each lookup scans the patterns of the task
+    db.exec(sql"CREATE INDEX IF NOT EXISTS ix_pattern_task_id_form ON pattern (task_id, form)")
     db.exec(sql"BEGIN TRANSACTION;")
-    for pos in analyzer.indexer.getPositions(pattern):
-        db.exec(sql"INSERT INTO position (pattern_id, sentence_id, token_ids) VALUES (?, ?, ?)",
-            pattern_id, pos.sent_idx, pos.token_ids.join(","))
+    db.exec(sql"DELETE FROM patternedge WHERE task_id = ?", task_id)
+    for side, column in ["left", "right"]:
+        db.exec(sql(fmt"""INSERT INTO patternedge (task_id, source, source_id, target, target_id, side, count, score)
+            SELECT p.task_id, p."{column}", c.id, p.form, p.id, {side}, p.count, p.score FROM pattern p
+            LEFT JOIN pattern c ON c.task_id = p.task_id AND c.form = p."{column}" WHERE p.task_id = ?"""), task_id)
     db.exec(sql"COMMIT;")
 
+proc storeRound(self: PatternStore, task_id: int, record: JsonNode) =
+    # a resumed task may repeat the rounds after its checkpoint
+    var columns = record.keys().toSeq()
+    var query = "INSERT OR REPLACE INTO taskround (task_id, " & columns.join(", ") & ") VALUES (?" &
+        ", ?".repeat(columns.len) & ")"
+    self.db.exec(sql(query), @[$task_id] & columns.mapIt($record[it]))
+
+proc reportProgress(self: PatternStore, job_id, round, n_merged, remaining_tokens: int): bool =
+    # records the progress of a background job (see jobs.py); false once the job is being cancelled
+    self.db.exec(sql"UPDATE job SET round = ?, n_merged = ?, remaining_tokens = ? WHERE id = ?",
+                 round, n_merged, remaining_tokens, job_id)
+    result = self.db.getValue(sql"SELECT status FROM job WHERE id = ?", job_id) != "cancelling"
+
 
 proc minePatterns(json_path: string, output_folder: string,
         config: JsonNode, store_in_database: bool = false,
-        task_id: int = -1) {.exportpy.} =
-    var corpus = loadJson(json_path)
+        task_id: int = -1, job_id: int = -1) {.exportpy.} =
+    var corpus = loadCorpus(json_path)
     var db_path = joinPath(output_folder, "db.sqlite3")
-    var db: DbConn
+    var store: PatternStore
     var on_merge: proc (pa: PatternAnalyzer, scored_pattern: ScoredPattern)
     if store_in_database:
         try:
@@ -490,30 +1453,397 @@ proc minePatterns(json_path: string, output_folder: string,
             let e = getCurrentException()
             let msg = getCurrentExceptionMsg()
             echo "Got exception ", repr(e), " with message ", msg
-        db = getDatabase(db_path)
+        store = openPatternStore(db_path, task_id)
         on_merge = (pa: PatternAnalyzer, scored_pattern: ScoredPattern) =>
-            db.storePositions(pa, scored_pattern)
+            store.storePositions(pa, scored_pattern)
     var analyzer = PatternAnalyzer(corpus: corpus, task_id: task_id)
     analyzer.init(config = config)
     var n_per_round = config{"n_per_round"}.getInt(10)
-    if analyzer.indexer.is_target_mode:
-        n_per_round = 1
     var n_total_rounds = config{"n_total_rounds"}.getInt(100)
+    # with checkpoint_interval > 0, the state is saved every that many rounds and when mining ends;
+    # resume_from continues (or extends to n_total_rounds) the run that saved a checkpoint
+    var checkpoint_interval = config{"checkpoint_interval"}.getInt(0)
+    var checkpoint_path = config{"checkpoint_path"}.getStr(joinPath(output_folder, "checkpoint.bin"))
+    var resume_from = config{"resume_from"}.getStr()
+    # the first index is shared by the tasks of a corpus that only differ in scoring settings
+    if resume_from == "" and config{"use_index_cache"}.getBool(true):
+        var key = analyzer.indexer.indexKey(config)
+        analyzer.index_cache_path = joinPath(output_folder, "index_cache", key & ".bin")
+    var last_round = 0
+    if resume_from != "":
+        var n_sents: int
+        (last_round, n_sents) = analyzer.loadCheckpoint(resume_from)
+        echo fmt"Resumed from {resume_from} after round {last_round}"
+        if n_sents < corpus.sentences.len: # sentences appended since (see appendCorpus())
+            var on_replay: proc (pa: PatternAnalyzer, sp: ScoredPattern, positions: seq[Position])
+            if store_in_database:
+                on_replay = (pa: PatternAnalyzer, sp: ScoredPattern, positions: seq[Position]) =>
+                    store.storeAppendedPositions(pa, sp, positions)
+            analyzer.indexAppendedSentences(toSeq(n_sents ..< corpus.sentences.len), on_replay)
     echo fmt"Total sents: {corpus.sentences.len}; min_score_threshold: {analyzer.min_score_threshold}; min_pattern_freq: {analyzer.min_pattern_freq}; n_per_round: {n_per_round}; n_total_rounds: {n_total_rounds}"
-    var file = open(joinPath(output_folder, "temp_output.txt"), fmWrite)
-    for i in 1..n_total_rounds:
+    var file = open(joinPath(output_folder, "temp_output.txt"), if last_round > 0: fmAppend else: fmWrite)
+    var telemetry_name = if task_id >= 0: fmt"telemetry_{task_id}.jsonl" else: "telemetry.jsonl"
+    var telemetry = open(config{"telemetry_path"}.getStr(joinPath(output_folder, telemetry_name)),
+                         if last_round > 0: fmAppend else: fmWrite)
+    for i in last_round + 1 .. n_total_rounds:
         var last_pattern_count = analyzer.merged_patterns.len
         var n_sents = if analyzer.affected_sent_idxes.len > 0:
             analyzer.affected_sent_idxes.len else: analyzer.corpus.sentences.len
         echo fmt"Merge round {i}: {last_pattern_count} merged; {n_sents} sents; remaining tokens: {analyzer.total_token_count}"
+        var round_start = epochTime()
         var scored_patterns = analyzer.mergeTopPatterns(n = n_per_round, on_merge = on_merge)
         file.writeResults(analyzer, scored_patterns)
+        var record = analyzer.roundRecord(i, epochTime() - round_start)
+        telemetry.writeLine($record)
+        telemetry.flushFile()
+        if store_in_database:
+            store.storeRound(task_id, record)
         if last_pattern_count == analyzer.merged_patterns.len:
             break
+        last_round = i
+        if checkpoint_interval > 0 and i mod checkpoint_interval == 0 and i < n_total_rounds:
+            analyzer.writeCheckpoint(checkpoint_path, i)
+        if store_in_database and job_id >= 0 and not store.reportProgress(
+                job_id, i, analyzer.merged_patterns.len, analyzer.total_token_count):
+            echo fmt"Job {job_id} cancelled after round {i}"
+            break
+    if checkpoint_interval > 0:
+        analyzer.writeCheckpoint(checkpoint_path, last_round)
+    telemetry.close()
     file = open(joinPath(output_folder, "output.txt"), fmWrite)
     file.writeResults(analyzer, analyzer.merged_patterns)
     if store_in_database:
-        db.close()
+        store.db.storeComponentGraph(task_id)
+        store.close()
+
+
+# Sharded mining (see sharded.py): worker processes each hold a range of the sentences of the corpus, index it
+# and apply merges to it, while a coordinator holding only the vocabulary and the counts summed over the ranges
+# chooses the merges of each round, as mergeTopPatterns() would on the whole corpus. They exchange files:
+#   report (worker -> coordinator): n_affected_sents, reindex_time, then for each pattern whose count, type or
+#       bigrams changed in the round: value ids, count delta, token type, flags (1: candidate, 2: dirty),
+#       and the value ids of its bigrams the first time the worker has them (empty otherwise)
+#   merges (coordinator -> workers): for each merge of the round in order: value ids, form, token types,
+#       whether the fillers of its slots are counted
+#   merge results (worker -> coordinator): for each merge: its positions (sent_idx in the corpus, token ids)
+#       and the counted fillers of its slots (label, then text and count of each)
+const shard_candidate_flag = 1
+const shard_dirty_flag = 2
+
+type Shard = ref object
+    analyzer: PatternAnalyzer
+    first_sent_idx: int # of the range in the corpus
+    reported_counts: seq[int] # per pattern, as of the last report
+    has_reported_bigrams: seq[bool]
+
+type Coordinator = ref object
+    analyzer: PatternAnalyzer
+    store: PatternStore # nil unless the patterns are stored in the database
+    file: File
+    telemetry: File
+    n_per_round: int
+    job_id: int
+    round_start: float
+    round_merges: seq[(ScoredPattern, int64)] # every merge of the round, with its pattern row
+    round_merged: OrderedSet[ScoredPattern] # the patterns merged for the first time in the round
+
+var shard: Shard # of a worker process
+var coordinator: Coordinator
+
+proc openStream(path: string, mode: FileMode): FileStream =
+    result = newFileStream(path, mode)
+    if result == nil:
+        raise newException(IOError, fmt"cannot open {path}")
+
+proc shardBounds(json_path: string, n_shards: int): seq[int] {.exportpy.} =
+    ## the first sentence of each of n_shards ranges of the corpus, then its number of sentences; the ranges are
+    ## loaded from the binary copy of json_path, which is written first if it is not up to date
+    var bin_path = json_path.changeFileExt("bin")
+    if not fileExists(bin_path) or getLastModificationTime(bin_path) < getLastModificationTime(json_path):
+        var temp_path = fmt"{bin_path}.{getCurrentProcessId()}"
+        loadJson(json_path).writeBinary(temp_path)
+        moveFile(temp_path, bin_path)
+    var n_sents = binarySentenceCount(bin_path)
+    for i in 0 .. n_shards:
+        result.add(n_sents * i div n_shards)
+
+proc openShard(json_path: string, config: JsonNode, first, last: int): int {.exportpy.} =
+    ## load the sentences first ..< last of the corpus into this worker; returns their number of tokens
+    var corpus = loadBinary(json_path.changeFileExt("bin"), first, last)
+    shard = Shard(analyzer: PatternAnalyzer(corpus: corpus), first_sent_idx: first)
+    shard.analyzer.init(config = config)
+    corpus.total_token_count
+
+proc storeShardTokens(db_path: string) {.exportpy.} =
+    ## store the sentences of this worker; workers store theirs in the order of their ranges
+    storeTokensInDatabase(shard.analyzer.corpus, db_path, id_offset = shard.first_sent_idx)
+
+proc indexShard(report_path: string) {.exportpy.} =
+    ## reindex the sentences affected by the last merges (all of them in the first round) and report the changes
+    var analyzer = shard.analyzer
+    var indexer = analyzer.indexer
+    # only the types set by this round are reported: the coordinator keeps the last one set in corpus order
+    for pattern in 0 ..< indexer.token_to_type.len:
+        indexer.token_to_type[pattern] = ttNil
+    var (candidates, dirty_patterns) = analyzer.reindexAffected()
+    shard.reported_counts.setLen(indexer.patterns.len)
+    shard.has_reported_bigrams.setLen(indexer.patterns.len)
+    var stream = openStream(report_path, fmWrite)
+    defer: stream.close()
+    stream.write(int64(analyzer.round_stats.n_affected_sents))
+    stream.write(analyzer.round_stats.reindex_time)
+    for pattern, value_ids in indexer.patterns:
+        var delta = indexer.count(pattern) - shard.reported_counts[pattern]
+        var has_new_bigrams = indexer.hasBigrams(pattern) and not shard.has_reported_bigrams[pattern]
+        var flags = 0
+        if pattern in candidates:
+            flags = flags or shard_candidate_flag
+        if pattern in dirty_patterns:
+            flags = flags or shard_dirty_flag
+        if delta == 0 and flags == 0 and not has_new_bigrams and indexer.token_to_type[pattern] == ttNil:
+            continue
+        stream.writeInts(value_ids)
+        stream.write(int64(delta))
+        stream.write(int64(ord(indexer.token_to_type[pattern])))
+        stream.write(int64(flags))
+        var bigram_value_ids: array[2, seq[int]]
+        if has_new_bigrams:
+            var (token1, token2) = indexer.pattern_to_bigrams[pattern]
+            bigram_value_ids = [indexer.patterns[token1], indexer.patterns[token2]]
+            shard.has_reported_bigrams[pattern] = true
+        stream.writeInts(bigram_value_ids[0])
+        stream.writeInts(bigram_value_ids[1])
+        shard.reported_counts[pattern] = indexer.count(pattern)
+
+proc mergeShard(merges_path: string, result_path: string) {.exportpy.} =
+    ## apply the merges chosen by the coordinator to the sentences of this worker, in their order
+    var analyzer = shard.analyzer
+    var indexer = analyzer.indexer
+    var merges = openStream(merges_path, fmRead)
+    defer: merges.close()
+    var stream = openStream(result_path, fmWrite)
+    defer: stream.close()
+    while not merges.atEnd():
+        var pattern = indexer.pattern_to_id.getOrDefault(merges.readInts(), NoPattern)
+        var labels = merges.readString().split("~")
+        var token_types = merges.readInts().mapIt(TokenType(it))
+        var count_fillers = merges.readInt64() != 0
+        var positions = if pattern != NoPattern: indexer.sortedPositions(pattern) else: newSeq[Position]()
+        analyzer.mergePositions(positions, token_types)
+        var label_to_texts: OrderedTable[string, CountTable[string]]
+        stream.write(int64(positions.len))
+        for pos in positions:
+            analyzer.affected_sent_idxes.incl(pos.sent_idx)
+            stream.write(int64(shard.first_sent_idx + pos.sent_idx))
+            stream.writeInts(pos.token_ids)
+            if count_fillers:
+                label_to_texts.countSlotFillers(labels, analyzer.corpus.vocab,
+                                                analyzer.corpus.sentences[pos.sent_idx], pos)
+        stream.write(int64(label_to_texts.len))
+        for label, texts in label_to_texts.pairs():
+            stream.writeString(label)
+            stream.write(int64(texts.len))
+            for text, count in texts.pairs():
+                stream.writeString(text)
+                stream.write(int64(count))
+
+proc countShardPositions(patterns_path: string, result_path: string) {.exportpy.} =
+    ## the positions of each pattern of patterns_path (value ids) in this worker, and the sentences they are in
+    var indexer = shard.analyzer.indexer
+    var patterns = openStream(patterns_path, fmRead)
+    defer: patterns.close()
+    var stream = openStream(result_path, fmWrite)
+    defer: stream.close()
+    while not patterns.atEnd():
+        var pattern = indexer.pattern_to_id.getOrDefault(patterns.readInts(), NoPattern)
+        var unique_sent_idxes: HashSet[int]
+        var count = 0
+        if pattern != NoPattern:
+            for pos in indexer.getPositions(pattern):
+                count += 1
+                unique_sent_idxes.incl(pos.sent_idx)
+        stream.write(int64(count))
+        stream.write(int64(unique_sent_idxes.len))
+
+proc closeShard() {.exportpy.} =
+    shard = nil
+
+proc applyReport(self: PatternAnalyzer, stream: Stream, candidates: var HashSet[PatternId],
+        dirty_patterns: var HashSet[PatternId]) =
+    # reports are applied in the order of their ranges, which is the order the sentences are indexed in
+    # by indexSentences(): first bigrams and last types win as they do there
+    var indexer = self.indexer
+    self.round_stats.n_affected_sents += int(stream.readInt64())
+    self.round_stats.reindex_time = max(self.round_stats.reindex_time, stream.readFloat64())
+    while not stream.atEnd():
+        var pattern = indexer.internPattern(stream.readInts())
+        indexer.pattern_counts[pattern] += int(stream.readInt64())
+        var token_type = TokenType(stream.readInt64())
+        if token_type != ttNil:
+            indexer.token_to_type[pattern] = token_type
+        var flags = int(stream.readInt64())
+        if (flags and shard_candidate_flag) != 0:
+            candidates.incl(pattern)
+        if (flags and shard_dirty_flag) != 0:
+            dirty_patterns.incl(pattern)
+        var token1_value_ids = stream.readInts()
+        var token2_value_ids = stream.readInts()
+        if token1_value_ids.len > 0 and not indexer.hasBigrams(pattern):
+            var token1 = indexer.internPattern(token1_value_ids)
+            var token2 = indexer.internPattern(token2_value_ids)
+            indexer.pattern_to_bigrams[pattern] = (token1, token2)
+            indexer.component_to_patterns[token1].add(pattern)
+            if token2 != token1:
+                indexer.component_to_patterns[token2].add(pattern)
+
+proc openCoordinator(json_path: string, output_folder: string, config: JsonNode, total_token_count: int,
+        store_in_database: bool = false, task_id: int = -1, job_id: int = -1) {.exportpy.} =
+    ## the coordinator of workers holding total_token_count tokens in all; it only loads the vocabulary
+    var corpus = loadBinary(json_path.changeFileExt("bin"), 0, 0)
+    corpus.total_token_count = total_token_count
+    var analyzer = PatternAnalyzer(corpus: corpus, task_id: task_id)
+    analyzer.init(config = config)
+    if analyzer.indexer.settings.is_target_mode:
+        # conflicts of target mode are decided on the positions of patterns, which only workers have
+        raise newException(ValueError, "target tokens are not supported by sharded mining")
+    coordinator = Coordinator(analyzer: analyzer, n_per_round: config{"n_per_round"}.getInt(10), job_id: job_id,
+                              round_start: epochTime())
+    if store_in_database:
+        coordinator.store = openPatternStore(joinPath(output_folder, "db.sqlite3"), task_id)
+    coordinator.file = open(joinPath(output_folder, "temp_output.txt"), fmWrite)
+    var telemetry_name = if task_id >= 0: fmt"telemetry_{task_id}.jsonl" else: "telemetry.jsonl"
+    coordinator.telemetry = open(config{"telemetry_path"}.getStr(joinPath(output_folder, telemetry_name)), fmWrite)
+    echo fmt"Total tokens: {total_token_count}; min_score_threshold: {analyzer.min_score_threshold}; min_pattern_freq: {analyzer.min_pattern_freq}"
+
+proc coordinateRound(report_paths: seq[string], merges_path: string): int {.exportpy.} =
+    ## choose the merges of a round from the reports of the workers; returns the number of new merged patterns
+    var self = coordinator
+    var analyzer = self.analyzer
+    analyzer.round_stats = RoundStats()
+    var candidates: HashSet[PatternId]
+    var dirty_patterns: HashSet[PatternId]
+    for path in report_paths:
+        var stream = openStream(path, fmRead)
+        analyzer.applyReport(stream, candidates, dirty_patterns)
+        stream.close()
+    var merges = openStream(merges_path, fmWrite)
+    defer: merges.close()
+    self.round_merges = @[]
+    var on_merge = proc (pa: PatternAnalyzer, sp: ScoredPattern) =
+        var pattern_id = -1'i64
+        var is_new = false
+        if self.store != nil:
+            (pattern_id, is_new) = self.store.storePattern(sp, pa.task_id)
+        self.round_merges.add((sp, pattern_id))
+        merges.writeInts(pa.indexer.patterns[sp.id])
+        merges.writeString(sp.pattern)
+        merges.writeInts(pa.mergeTokenTypes(sp.id).mapIt(ord(it)))
+        merges.write(int64(ord(is_new)))
+    if self.store != nil:
+        self.store.db.exec(sql"BEGIN TRANSACTION;")
+    self.round_merged = analyzer.chooseAndMerge(self.n_per_round, candidates, dirty_patterns, on_merge)
+    if self.store != nil:
+        self.store.db.exec(sql"COMMIT;")
+    self.round_merged.len
+
+proc finishRound(round: int, result_paths: seq[string]): bool {.exportpy.} =
+    ## store the positions the workers found for the merges of the round and record the round;
+    ## returns whether mining goes on: not once a round merges no new pattern or its job is being cancelled
+    var self = coordinator
+    var analyzer = self.analyzer
+    var start_time = epochTime()
+    var streams = result_paths.mapIt(openStream(it, fmRead))
+    defer:
+        for stream in streams:
+            stream.close()
+    if self.store != nil:
+        self.store.db.exec(sql"BEGIN TRANSACTION;")
+    var form_to_counts: Table[string, (int, int)]
+    for (sp, pattern_id) in self.round_merges:
+        var label_to_texts: OrderedTable[string, CountTable[string]]
+        var count2 = 0
+        var count3 = 0
+        for stream in streams:
+            var last_sent_idx = -1
+            for _ in 0 ..< int(stream.readInt64()):
+                var sent_idx = int(stream.readInt64())
+                var token_ids = stream.readInts()
+                if self.store != nil:
+                    self.store.insert_position.execBulk(pattern_id, sent_idx, token_ids.encodeTokenIds())
+                count2 += 1
+                if sent_idx != last_sent_idx: # positions come in corpus order
+                    count3 += 1
+                    last_sent_idx = sent_idx
+            for _ in 0 ..< int(stream.readInt64()):
+                var label = stream.readString()
+                for _ in 0 ..< int(stream.readInt64()):
+                    var text = stream.readString()
+                    label_to_texts.mgetOrPut(label, initCountTable[string]()).inc(text, int(stream.readInt64()))
+        if self.store != nil:
+            self.store.storeSlotFillers(pattern_id, label_to_texts)
+        form_to_counts[sp.pattern] = (count2, count3)
+    if self.store != nil:
+        self.store.db.exec(sql"COMMIT;")
+    analyzer.round_stats.db_time += epochTime() - start_time
+    for sp in self.round_merged:
+        var (count2, count3) = form_to_counts[sp.pattern]
+        self.file.writeResult(sp, count2, count3)
+    self.file.flushFile()
+    var now = epochTime()
+    var record = analyzer.roundRecord(round, now - self.round_start)
+    self.round_start = now
+    self.telemetry.writeLine($record)
+    self.telemetry.flushFile()
+    echo fmt"Merge round {round}: {analyzer.merged_patterns.len} merged; remaining tokens: {analyzer.total_token_count}"
+    if self.store != nil:
+        self.store.storeRound(analyzer.task_id, record)
+    if self.round_merged.len == 0:
+        return false
+    if self.store != nil and self.job_id >= 0 and not self.store.reportProgress(
+            self.job_id, round, analyzer.merged_patterns.len, analyzer.total_token_count):
+        echo fmt"Job {self.job_id} cancelled after round {round}"
+        return false
+    true
+
+proc writeMergedPatterns(patterns_path: string) {.exportpy.} =
+    ## the value ids of the merged patterns, for countShardPositions()
+    var stream = openStream(patterns_path, fmWrite)
+    defer: stream.close()
+    for sp in coordinator.analyzer.merged_patterns:
+        stream.writeInts(coordinator.analyzer.indexer.patterns[sp.id])
+
+proc abortCoordinator() {.exportpy.} =
+    ## release the files and database of the coordinator without writing output.txt, e.g. after a worker failed;
+    ## does nothing once it is closed
+    var self = coordinator
+    if self == nil:
+        return
+    coordinator = nil
+    if self.file != nil:
+        self.file.close()
+    if self.telemetry != nil:
+        self.telemetry.close()
+    if self.store != nil:
+        self.store.close()
+
+proc closeCoordinator(output_folder: string, count_paths: seq[string]) {.exportpy.} =
+    ## write output.txt with the position counts of the merged patterns summed from countShardPositions()
+    var self = coordinator
+    var streams = count_paths.mapIt(openStream(it, fmRead))
+    var file = open(joinPath(output_folder, "output.txt"), fmWrite)
+    for sp in self.analyzer.merged_patterns:
+        var count2 = 0
+        var count3 = 0
+        for stream in streams:
+            count2 += int(stream.readInt64())
+            count3 += int(stream.readInt64()) # the sentences of workers are disjoint
+        file.writeResult(sp, count2, count3)
+    file.close()
+    for stream in streams:
+        stream.close()
+    if self.store != nil:
+        self.store.db.storeComponentGraph(self.analyzer.task_id)
+    abortCoordinator() # releases the rest
 
 
 proc processCorpus*(json_path, config_str: string) =
@@ -521,8 +1851,83 @@ proc processCorpus*(json_path, config_str: string) =
     var input_folder = splitPath(json_path).head
     minePatterns(json_path, input_folder, config, store_in_database = false)
 
+proc writeBinaryCorpus(json_path: string, bin_path: string) {.exportpy.} =
+    loadJson(json_path).writeBinary(bin_path)
+
+proc storeCorpusTokens(json_path: string, db_path: string) {.exportpy.} =
+    ## store the sentences of the corpus that the database lacks: all of them for the first task of a project,
+    ## those appended by appendCorpus() later; the tables must exist
+    storeTokensInDatabase(loadCorpus(json_path), db_path)
+
+proc appendCorpus(json_path: string, new_json_path: string, bin_path: string): int {.exportpy.} =
+    ## write the corpus of json_path with the sentences of new_json_path appended to bin_path; returns their
+    ## number. They are stored in the database by storeCorpusTokens() once the corpus files are updated, and
+    ## tasks continued from their checkpoints then index just these sentences (see indexAppendedSentences())
+    var corpus = loadCorpus(json_path)
+    var first_sent_idx = corpus.sentences.len
+    corpus.appendSentences(loadJson(new_json_path))
+    corpus.writeBinary(bin_path)
+    corpus.sentences.len - first_sent_idx
+
+proc buildComponentGraph(db_path: string, task_id: int) {.exportpy.} =
+    ## the component graph of a task mined before it was stored when mining ends
+    var db = getDatabase(db_path)
+    defer: db.close()
+    db.storeComponentGraph(task_id)
+
+proc profileIndexing(json_path: string, config: JsonNode, repeats: int = 3): JsonNode {.exportpy.} =
+    ## a microbenchmark of the first round of indexing in one thread: the best of repeats passes collecting the
+    ## bigrams of every sentence (collect_time) and indexing them into a new indexer (index_time), with the heap
+    ## allocations of collecting; these are only counted when the module is compiled with -d:nimAllocStats.
+    ## threaded_index_time is the best pass of indexSentences() over the corpus with the n_threads of config
+    var corpus = loadCorpus(json_path)
+    var collect_time = Inf
+    var index_time = Inf
+    var threaded_index_time = Inf
+    var n_threads = 1
+    var n_bigrams = 0
+    var allocations = -1
+    for _ in 0 ..< repeats:
+        var indexer = PatternIndexer()
+        indexer.init(corpus, config)
+        when defined(nimAllocStats):
+            var stats = getAllocStats()
+        var start_time = epochTime()
+        n_bigrams = 0
+        for sentence in corpus.sentences:
+            n_bigrams += indexer.settings.collectSentence(sentence).bigrams.len
+        collect_time = min(collect_time, epochTime() - start_time)
+        when defined(nimAllocStats):
+            allocations = (getAllocStats() - stats).allocCount
+        start_time = epochTime()
+        for sentence in corpus.sentences:
+            indexer.indexSentence(sentence)
+        index_time = min(index_time, epochTime() - start_time)
+        var threaded_indexer = PatternIndexer()
+        threaded_indexer.init(corpus, config)
+        start_time = epochTime()
+        discard threaded_indexer.indexSentences(toSeq(0 ..< corpus.sentences.len))
+        threaded_index_time = min(threaded_index_time, epochTime() - start_time)
+        n_threads = threaded_indexer.n_threads
+    %*{"n_sents": corpus.sentences.len, "n_bigrams": n_bigrams, "collect_time": collect_time,
+       "index_time": index_time, "threaded_index_time": threaded_index_time, "n_threads": n_threads,
+       "allocations": allocations}
+
+proc scorePatterns(measure: string, counts, left_counts, right_counts,
+        total_token_counts: seq[int]): seq[float64] {.exportpy.} =
+    ## the scores of merged patterns under measure, from the counts stored with them (see the pattern table)
+    if measure notin ["pmi", "pmi2", "pmi3", "loglikelihood", "delta-p", "logdice"]:
+        raise newException(ValueError, fmt"unknown association measure {measure}")
+    if left_counts.len != counts.len or right_counts.len != counts.len or total_token_counts.len != counts.len:
+        raise newException(ValueError, "counts of different lengths")
+    var measure_type = measure.toMeasureType()
+    result = newSeq[float64](counts.len)
+    for i in 0 ..< counts.len:
+        result[i] = associationScore(measure_type, counts[i], left_counts[i], right_counts[i],
+                                     total_token_counts[i])
+
 proc extractPatternsByRules*(json_path: string, rule_path: string, config_str: string) =
-    var corpus = loadJson(json_path)
+    var corpus = loadCorpus(json_path)
     var analyzer = PatternAnalyzer(corpus: corpus)
     var config = parseJson(config_str)
     analyzer.init(config=config)
@@ -546,10 +1951,12 @@ proc extractPatternsByRules*(json_path: string, rule_path: string, config_str: s
                 analyzer.affected_sent_idxes.clear()
                 affected_patterns.clear()
                 break
-        try:
-            echo pattern, " ", pattern in analyzer.indexer.pattern_to_bigrams
-            analyzer.mergePattern(pattern)
-        except:
+        var pattern_id = analyzer.indexer.lookupPattern(pattern)
+        var has_bigrams = pattern_id != NoPattern and analyzer.indexer.hasBigrams(pattern_id)
+        echo pattern, " ", has_bigrams
+        if has_bigrams:
+            analyzer.mergePattern(pattern_id)
+        else:
             echo pattern, " not found"
         for p in rule:
             affected_patterns.incl(p)
@@ -1,5 +1,6 @@
 import hashes
 import tables
+import strutils
 
 template benchmark*(benchmarkName: string, code: untyped) =
   block:
@@ -9,6 +10,15 @@ template benchmark*(benchmarkName: string, code: untyped) =
     let elapsedStr = elapsed.formatFloat(format = ffDecimal, precision = 3)
     echo "CPU Time [", benchmarkName, "] ", elapsedStr, "s"
 
+proc peakRssMb*(): float =
+  ## peak resident set size of this process (VmHWM); 0 where /proc is unavailable
+  try:
+    for line in lines("/proc/self/status"):
+      if line.startsWith("VmHWM:"):
+        return parseFloat(line.splitWhitespace()[1]) / 1024
+  except IOError:
+    discard
+
 proc autohash*[T: tuple|object](o: T): Hash =
   var h: Hash = 0
   for f in o.fields: h = h !& f.hash
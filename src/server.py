@@ -1,5 +1,8 @@
 import os
+import json
+import time
 import streamlit as st
+import streamlit.components.v1 as components
 from streamlit_option_menu import option_menu
 from dataclasses import dataclass
 from streamlit_text_annotation import text_annotation
@@ -8,6 +11,10 @@ import pandas as pd
 import plotly.express as px
 import mining
 import db_manager
+import jobs
+import corpus_search
+import export
+import visualize
 
 
 @dataclass
@@ -29,7 +36,8 @@ def annotation_page():
     mode = option_menu(None, ["Existing Projects", "New Project"], orientation="horizontal")
     if mode == "New Project":
         title = st.text_input("Project Title")
-        uploaded_file = st.file_uploader("Upload an annotated file (JSON format)", type="json")
+        uploaded_file = st.file_uploader("Upload an annotated file (JSON or JSON Lines format)",
+                                         type=["json", "jsonl"])
         if st.button("Create project"):
             if not title or len(title.strip()) < 3:
                 st.error("Invalid project title")
@@ -43,8 +51,11 @@ def annotation_page():
             except FileExistsError:
                 st.error(f"Project {title} already exists")
                 return
-            with open(os.path.join(folder, "corpus.json"), "wb") as f:
+            json_path = os.path.join(folder, "corpus.json")
+            with open(json_path, "wb") as f:
                 f.write(uploaded_file.getvalue())
+            with st.spinner("Preparing corpus..."):
+                mining.write_binary_corpus(json_path, os.path.join(folder, "corpus.bin"))
             st.session_state.project = {'title': title, 'folder': folder}
             st.success("Project successfully created")
     else:
@@ -57,34 +68,156 @@ def annotation_page():
                     'folder': os.path.join(project_data_folder, folder_name)
                 }
                 st.success("Project opened")
+            if 'project' in st.session_state:
+                append_documents_panel()
         else:
             st.markdown("**No projects currently exist**")
 
+
+def append_documents_panel():
+    folder = st.session_state.project['folder']
+    with st.expander(f"Append documents to {st.session_state.project['title']}"):
+        uploaded_file = st.file_uploader("Upload an annotated file (JSON or JSON Lines format)",
+                                         type=["json", "jsonl"], key="append_file")
+        if st.button("Append") and uploaded_file:
+            new_path = os.path.join(folder, f"appended_{time.strftime('%Y%m%d_%H%M%S')}_{uploaded_file.name}")
+            with open(new_path, "wb") as f:
+                f.write(uploaded_file.getvalue())
+            with st.spinner("Appending..."):
+                n_sents = jobs.append_corpus(get_db_manager().db_path, new_path)
+            st.success(f"{n_sents} sentences appended")
+        # tasks with a checkpoint index only the new sentences when continued; the others have to be mined again
+        manager = get_db_manager()
+        tasks = [t for t in load_tasks(manager.db_path, db_version(manager))
+                 if os.path.exists(jobs.checkpoint_path(folder, t['id']))]
+        if tasks and st.button(f"Update {len(tasks)} task(s) with checkpoints to the appended documents"):
+            for task in tasks:
+                config = {**json.loads(task['config']), "resume_task_id": task['id']}
+                mine_patterns(task['name'], config)
+            st.success("Update jobs queued; see Mining for their progress")
+
 def get_db_manager():
     if "project" not in st.session_state:
         st.error("Please select a project first")
         return
-    if 'db_manager' in st.session_state.project:
-        manager = st.session_state.project['db_manager']
-    else:
-        manager = db_manager.DBManager(os.path.join(st.session_state.project['folder'], "db.sqlite3"))
-        st.session_state.project['db_manager'] = manager
-    return manager
+    return load_db_manager(os.path.join(st.session_state.project['folder'], "db.sqlite3"))
+
+
+# Caches shared by all sessions of this server process. Query results are keyed by the database path and
+# its version, so mining a new task (which writes to the database) invalidates them without explicit clearing.
+@st.cache_resource(max_entries=16)
+def load_db_manager(db_path):
+    return db_manager.DBManager(db_path)
+
+
+def db_version(manager):
+    # with WAL journaling, commits touch the -wal file before they reach the database file
+    paths = [manager.db_path, manager.db_path + "-wal"]
+    return max((os.stat(path).st_mtime_ns for path in paths if os.path.exists(path)), default=0)
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def load_tasks(db_path, version):
+    tasks = load_db_manager(db_path).get_all_tasks()
+    return [{k: v for k, v in task.items() if not k.startswith("_")} for task in tasks]
+
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def load_pattern_count(db_path, version, task_id, filters):
+    return load_db_manager(db_path).count_patterns(task_id, **dict(filters))
+
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def load_pattern_page(db_path, version, task_id, page, page_size, sort_by, descending, filters):
+    return load_db_manager(db_path).get_pattern_page(task_id, page=page, page_size=page_size, sort_by=sort_by,
+                                                     descending=descending, **dict(filters))
+
+
+@st.cache_resource(max_entries=4, show_spinner="Loading the search index...")
+def load_search_index(db_path, version):
+    return corpus_search.CorpusIndex.open(load_db_manager(db_path))
+
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def load_search_results(db_path, version, query, limit, context):
+    n_matches, matches = load_search_index(db_path, version).search(query, limit=limit)
+    return n_matches, corpus_search.concordance(load_db_manager(db_path), matches, context=context)
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def load_rescored_patterns(db_path, version, task_id, measure, filters):
+    return load_db_manager(db_path).rescore_patterns(task_id, measure, **dict(filters))
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def load_task_rounds(db_path, version, task_id):
+    return load_db_manager(db_path).get_task_rounds(task_id)
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def load_component_graph(db_path, version, task_id, node, depth, k, max_nodes):
+    manager = load_db_manager(db_path)
+    if not manager.has_component_graph(task_id):  # a task mined before the graph was stored
+        mining.build_component_graph(db_path, task_id)
+    return manager.get_component_graph(task_id, node, depth=depth, k=k, max_nodes=max_nodes)
+
+
+@st.cache_data(max_entries=512, show_spinner=False)
+def load_concordance(db_path, version, pattern, task_id, limit, offset, context):
+    return load_db_manager(db_path).query_pattern(pattern, limit=limit, task_id=task_id, offset=offset,
+                                                  context=context)
+
+
+@st.cache_data(max_entries=512, show_spinner=False)
+def load_token_stats(db_path, version, pattern, task_id):
+    return load_db_manager(db_path).query_token_stats(pattern, task_id=task_id)
+
+max_concurrent_jobs = 2
+
+
+@st.cache_resource
+def get_job_queue():
+    return jobs.JobQueue(max_workers=max_concurrent_jobs)
+
 
 def mine_patterns(name, config):
+    # mining runs in a worker process; see jobs_panel() for its progress
+    return get_job_queue().submit(get_db_manager(), name, config)
+
+
+def jobs_panel():
+    if "project" not in st.session_state:
+        return
     manager = get_db_manager()
-    manager.create_database(on_exist="ignore")
-    folder = st.session_state.project['folder']
-    json_path = os.path.join(folder, "corpus.json")
-    task_id = manager.new_task(name, config)
-    mining.mine_patterns(json_path, folder, config, store_in_database=True, task_id=task_id)
+    queue = get_job_queue()
+    queue.attach(manager)
+    job_list = manager.get_jobs()
+    if not job_list:
+        return
+    st.subheader("Mining Jobs")
+    for job in job_list:
+        left, mid, right = st.columns([3, 7, 2])
+        left.markdown(f"**{job['id']} ({job['name']})**: {job['status']}")
+        progress = 1.0 if job['status'] == "done" else min(job['round'] / max(job['n_rounds'], 1), 1.0)
+        mid.progress(progress, text=f"Round {job['round']}/{job['n_rounds']}; {job['n_merged']} merged; "
+                                    f"remaining tokens: {job['remaining_tokens']}")
+        if job['status'] in ("queued", "running") and right.button("Cancel", key=f"cancel_job{job['id']}"):
+            queue.cancel(manager, job['id'])
+            st.rerun()
+        if job['status'] == "failed" and job['error']:
+            with st.expander("Error"):
+                st.code(job['error'])
+    if any(job['status'] in jobs.active_statuses for job in job_list) and st.checkbox("Auto-refresh", value=True):
+        time.sleep(2)
+        st.rerun()
+
+association_measure_mapping = {'MI': "pmi", "MI2": "pmi2", "MI3": "pmi3",
+                               "Log-Likelihood": "loglikelihood", "Delta-P": "delta-p", "Log Dice": "logdice"}
+
 
 def extraction_page():
     token_type_mapping = {"coarse-grained POS": "upos", "fine-grained POS": "xpos"}
 
-    association_measure_mapping = {'MI': "pmi", "MI2": "pmi2", "MI3": "pmi3",
-                                "Log-Likelihood": "loglikelihood", "Delta-P": "delta-p", "Log Dice": "logdice"}
-
     annotated_layers = ["lemma", "coarse-grained POS", "fine-grained POS", "supersense"]
     mode = option_menu(None, ["General Mode", "Target Mode", ], orientation="horizontal")
     task_name = st.text_input("Task name", placeholder="Unnamed")
@@ -112,9 +245,25 @@ def extraction_page():
         for i, token_type in enumerate(token_types):
             if token_type in token_type_mapping:
                 token_types[i] = token_type_mapping[token_type]
-        left, right = st.columns(2)
+        left, mid, right = st.columns(3)
         n_total_rounds = left.number_input("Number of rounds", value=10, step=10)
-        n_per_round = right.number_input("Number of patterns to mine per round", value=10, step=10)
+        n_per_round = mid.number_input("Number of patterns to mine per round", value=10, step=10)
+        n_threads = right.number_input("Number of indexing threads", value=os.cpu_count() or 1, min_value=1, step=1)
+        left, right = st.columns([1, 2])
+        checkpoint_interval = left.number_input("Checkpoint every N rounds (0 = never)", value=10, min_value=0,
+                                                step=1)
+        resumable_tasks = []
+        if "project" in st.session_state:
+            folder = st.session_state.project['folder']
+            manager = get_db_manager()
+            if os.path.exists(manager.db_path):
+                resumable_tasks = [f"{t['id']} ({t['name']})" for t in load_tasks(manager.db_path, db_version(manager))
+                                   if os.path.exists(jobs.checkpoint_path(folder, t['id']))]
+        resume_task = right.selectbox("Continue a task from its last checkpoint (up to the number of rounds above)",
+                                      ["None"] + resumable_tasks,
+                                      help="A continued task keeps the other settings it was started with")
+        use_index_cache = st.checkbox("Reuse the first-round index of earlier tasks with the same token settings",
+                                      value=True)
 
     with st.expander("Special Values", expanded=False):
         if 'special_values' not in st.session_state:
@@ -137,7 +286,12 @@ def extraction_page():
             "token_types": token_types,
             "n_total_rounds": n_total_rounds,
             "n_per_round": n_per_round,
+            "n_threads": n_threads,
+            "checkpoint_interval": checkpoint_interval,
+            "use_index_cache": use_index_cache,
         }
+        if resume_task != "None":
+            config['resume_task_id'] = int(resume_task.split(" ")[0])
         if 'targets' in st.session_state:
             target_dict = {}
             for target in st.session_state.targets:
@@ -165,14 +319,23 @@ def extraction_page():
         config['allowed_values'] = allowed_values
         config['ignored_values'] = ignored_values
         print(config)
-        with st.spinner("Mining patterns..."):
-            mine_patterns(task_name, config)
-        st.success("Patterns mined successfully!")
+        job_id = mine_patterns(task_name, config)
+        st.success(f"Job {job_id} queued")
+    jobs_panel()
 
-def show_pattern_in_context(manager, pattern, max_n=None, show_stats=False, key=None):
-    results = manager.query_pattern(pattern, max_n)
+def show_pattern_in_context(manager, pattern, task_id=None, max_n=None, page=0, context=None,
+                            show_stats=False, key=None):
+    offset = page * max_n if max_n else 0
+    version = db_version(manager)
+    results = load_concordance(manager.db_path, version, pattern, task_id, max_n, offset, context)
+    if show_stats:
+        st.write(load_token_stats(manager.db_path, version, pattern, task_id))
+    show_concordance(results['data'], key=key)
+
+
+def show_concordance(lines, key=None):
     all_sent_data = []
-    for i, result in enumerate(results['data']):
+    for result in lines:
         tokens = []
         for t in result['tokens']:
             data = {'text': t[0]}
@@ -180,23 +343,107 @@ def show_pattern_in_context(manager, pattern, max_n=None, show_stats=False, key=
                 data['labels'] = [t[1]]
             tokens.append(data)
         all_sent_data.append({'tokens': tokens, "labelOrientation": "vertical"})
-        if max_n and i == max_n - 1:
-            break
-    if show_stats:
-        if 'token_stats' in results:
-            st.write(results['token_stats'])
     text_annotation(all_sent_data, key=key)
 
 
+def show_corpus_search(manager):
+    query = st.text_input("Search the corpus", placeholder="give _ to | give ... NOUN | NOUN >obj give",
+                          help=corpus_search.__doc__.split("Every term")[0])
+    if not query:
+        return
+    left, right = st.columns(2)
+    limit = left.number_input("Max lines", value=20, min_value=1, step=10, key="search_limit")
+    context = right.number_input("Context (tokens, 0 = whole sentence)", value=0, min_value=0, step=1,
+                                 key="search_context")
+    try:
+        n_matches, lines = load_search_results(manager.db_path, db_version(manager), query, limit, context or None)
+    except ValueError as e:
+        st.error(f"Invalid query: {e}")
+        return
+    st.write(f"{n_matches} matches")
+    show_concordance(lines, key="corpus_search")
+
+
+def show_component_graph(manager, task_id, selected_rows):
+    default = selected_rows[0]['pattern'] if selected_rows else ""
+    left, mid, mid_right, right = st.columns([4, 1, 1, 1])
+    node = left.text_input("Around", value=default, help="A lemma, tag or pattern, e.g. accuse or <noun> have; "
+                                                         "empty for the best scored patterns of the task")
+    depth = mid.number_input("Hops", value=2, min_value=1, max_value=4, step=1)
+    k = mid_right.number_input("Patterns per node", value=10, min_value=1, step=5)
+    max_nodes = right.number_input("Max nodes", value=300, min_value=10, step=50)
+    edges = load_component_graph(manager.db_path, db_version(manager), task_id, node.strip() or None, depth, k,
+                                 max_nodes)
+    if edges.empty:
+        st.info("No patterns around this node" if node.strip() else "No patterns in this task")
+        return
+    net = visualize.build_network(edges, center=node.strip() or None)
+    components.html(net.generate_html(), height=620)
+    st.caption(f"{len(edges)} edges; patterns are green and sized by their counts")
+
+
+def show_task_timeline(manager, task_id):
+    df = load_task_rounds(manager.db_path, db_version(manager), task_id)
+    if df.empty:
+        st.info("No telemetry was recorded for this task")
+        return
+    time_cols = ['reindex_time', 'scoring_time', 'sorting_time', 'merging_time', 'db_time']
+    fig = px.bar(df, x='round', y=time_cols, title="Time per round (s)")
+    st.plotly_chart(fig, use_container_width=True)
+    left, right = st.columns(2)
+    with left:
+        fig = px.line(df, x='round', y=['n_candidates', 'n_discarded', 'n_affected_sents'], title="Sizes")
+        st.plotly_chart(fig, use_container_width=True)
+    with right:
+        fig = px.line(df, x='round', y='peak_rss_mb', title="Peak RSS (MB)")
+        st.plotly_chart(fig, use_container_width=True)
+    st.dataframe(df)
+
+
 def explore_page():
     try:
         manager = get_db_manager()
-        tasks = manager.get_all_tasks()
+        version = db_version(manager)
+        tasks = load_tasks(manager.db_path, version)
         task_info = [f"{t['id']} ({t['name']})" for t in tasks]
         st.subheader("Extracted Constructions")
-        left, right = st.columns([1, 3])
-        task_id = left.selectbox("Task", task_info)
-        df = manager.get_pattern_df(task_id=int(task_id.split(" ")[0]))
+        left, mid, right = st.columns([1, 1, 2])
+        task_id = int(left.selectbox("Task", task_info).split(" ")[0])
+        measure = mid.selectbox("Score by", ["As mined"] + list(association_measure_mapping.keys()),
+                                help="Rescore the patterns of the task under another association measure")
+        form_filter = right.text_input("Filter forms", value="", help="e.g. <noun> have")
+        sort_col, order_col, size_col, score_col, count_col = st.columns([2, 2, 2, 3, 3])
+        sort_by = sort_col.selectbox("Sort by", ["score", "count", "form"])
+        descending = order_col.selectbox("Order", ["Descending", "Ascending"]) == "Descending"
+        page_size = size_col.selectbox("Rows per page", [50, 100, 200, 500], index=1)
+        min_score, max_score = score_col.columns(2)
+        min_score = min_score.number_input("Min score", value=None, format="%f")
+        max_score = max_score.number_input("Max score", value=None, format="%f")
+        min_count, max_count = count_col.columns(2)
+        min_count = min_count.number_input("Min count", value=None, min_value=0, step=1)
+        max_count = max_count.number_input("Max count", value=None, min_value=0, step=1)
+        filters = (("form_filter", form_filter), ("min_score", min_score), ("max_score", max_score),
+                   ("min_count", min_count), ("max_count", max_count))
+        if measure == "As mined":
+            n_total = load_pattern_count(manager.db_path, version, task_id, filters)
+        else:
+            # rescored in one batch; sorting and paging happen on the cached result
+            df_all = load_rescored_patterns(manager.db_path, version, task_id,
+                                            association_measure_mapping[measure], filters)
+            n_total = len(df_all)
+            if n_total == 0:
+                st.info("No patterns to rescore: none match the filters, or the task was mined before patterns "
+                        "were stored with their counts.")
+        n_pages = max((n_total + page_size - 1) // page_size, 1)
+        page = st.number_input(f"Page (of {n_pages}, {n_total} patterns)", value=1, min_value=1,
+                               max_value=n_pages, step=1) - 1
+        if measure == "As mined":
+            df = load_pattern_page(manager.db_path, version, task_id, page, page_size, sort_by, descending,
+                                   filters)
+        else:
+            keys = [sort_by] if sort_by == "form" else [sort_by, 'form']
+            df = df_all.sort_values(keys, ascending=[not descending, True][:len(keys)], kind="stable")
+            df = df.iloc[page * page_size:(page + 1) * page_size]
     except Exception as e:
         st.error(f"Error: {e}")
         return
@@ -208,7 +455,18 @@ def explore_page():
     selected_rows = response['selected_rows']
     df_selected = pd.DataFrame(selected_rows)
     # df_selected = df_selected.melt(id_vars=['form'], value_vars=['count', 'score'], var_name="type")
-    mode = option_menu(None, ["Visulization", "Context"],icons=['file-bar-graph', 'body-text'], orientation="horizontal")
+    mode = option_menu(None, ["Visulization", "Context", "Network", "Timeline", "Search"],
+                       icons=['file-bar-graph', 'body-text', 'diagram-3', 'clock-history', 'search'],
+                       orientation="horizontal")
+    if mode == "Network":
+        show_component_graph(manager, task_id, selected_rows)
+        return
+    if mode == "Timeline":
+        show_task_timeline(manager, task_id)
+        return
+    if mode == "Search":
+        show_corpus_search(manager)
+        return
     df_selected['size'] = 10
     if mode == "Visulization":
         if not selected_rows:
@@ -227,20 +485,65 @@ def explore_page():
     else:
         for i, row in enumerate(selected_rows):
             with st.expander(f"{row['form']} ({row['count']})", expanded=True):
-                left, mid, right = st.columns([3, 3, 4])
+                form = row['pattern']
+                n_lines = row['count']
+                left, mid_left, mid_right, right = st.columns([3, 3, 3, 3])
                 with left:
-                    max_lines = st.number_input("Max lines", value=3, step=1, key=f"max_lines{i}")
-                with mid:
+                    max_lines = st.number_input("Max lines", value=3, min_value=1,
+                                                max_value=db_manager.max_concordance_lines, step=1,
+                                                key=f"max_lines{i}")
+                with mid_left:
+                    n_pages = max((n_lines + max_lines - 1) // max_lines, 1)
+                    page = st.number_input("Page", value=1, min_value=1, max_value=n_pages, step=1,
+                                           key=f"page{i}") - 1
+                with mid_right:
+                    context = st.number_input("Context (tokens, 0 = whole sentence)", value=0, min_value=0,
+                                              step=1, key=f"context_size{i}")
+                with right:
                     show_stats = st.selectbox("Show stats", ["No", "Yes"], key=f"show_stats{i}") == "Yes"
-                show_pattern_in_context(manager, row['form'], max_n=max_lines, 
-                show_stats=show_stats, key=f'context{i}')
+                show_pattern_in_context(manager, form, task_id=task_id, max_n=max_lines, page=page,
+                                        context=context or None, show_stats=show_stats, key=f'context{i}')
+
+
+# exports larger than this are left in the project folder rather than read into the server to be downloaded
+max_download_bytes = 50 * 1024 * 1024
 
 
 def output_page():
     manager = get_db_manager()
-    df = manager.get_pattern_df()
-    st.header("Click the button below to download the patterns for the current project")
-    st.download_button("Download", file_name="patterns.csv", data=df.to_csv(index=False))
+    if manager is None:
+        return
+    tasks = load_tasks(manager.db_path, db_version(manager))
+    if not tasks:
+        st.info("No tasks to export yet")
+        return
+    st.header("Export the patterns of a task")
+    left, mid, right = st.columns(3)
+    task_id = int(left.selectbox("Task", [f"{t['id']} ({t['name']})" for t in tasks]).split(" ")[0])
+    extension = mid.selectbox("Format", list(export.formats))
+    what = right.radio("Rows", ["Patterns", "Positions with concordance lines", "Positions"])
+    left, mid, right = st.columns(3)
+    form_filter = left.text_input("Filter forms", value="", help="e.g. <noun> have")
+    min_score = mid.number_input("Min score", value=None, format="%f")
+    context = right.number_input("Context tokens of concordance lines (0 = whole sentence)", value=0, min_value=0)
+    if st.button("Export"):
+        # written to the project folder in chunks; large exports can be picked up there instead of downloaded
+        folder = os.path.join(os.path.dirname(manager.db_path), "exports")
+        os.makedirs(folder, exist_ok=True)
+        positions = what != "Patterns"
+        path = os.path.join(folder, f"task{task_id}_{'positions' if positions else 'patterns'}{extension}")
+        status = st.empty()
+        n_rows = export.export_task(manager, task_id, path, positions=positions, context=context or None,
+                                    lines=what == "Positions with concordance lines",
+                                    progress=lambda n: status.text(f"{n} rows written"),
+                                    form_filter=form_filter, min_score=min_score)
+        status.text(f"{n_rows} rows written to {path}")
+        size = os.path.getsize(path)
+        if size > max_download_bytes:
+            st.info(f"The export ({size / 2 ** 20:.0f} MB) is too large to download here; it is at {path}")
+        else:
+            with open(path, "rb") as f:
+                st.download_button("Download", file_name=os.path.basename(path), data=f)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,120 @@
+"""Mines the patterns of a corpus split into ranges of sentences, each held by a worker process.
+
+    python sharded.py <json_path> <output_folder> <n_workers> [config.json]
+
+Workers index their ranges and report what changed in each round; this process coordinates them: it sums their
+counts, chooses the merges of the round as mining.mine_patterns() would on the whole corpus, and has the workers
+apply them (see "Sharded mining" in mining.nim). A worker only loads its range of the binary corpus, so the
+memory of each process grows with its share of the corpus. Target tokens and checkpoints are not supported.
+"""
+import os
+import sys
+import json
+import shutil
+import tempfile
+import traceback
+import multiprocessing
+
+
+def run_worker(conn, json_path, config, first, last):
+    # the body of a worker process: holds the sentences first..last and runs the commands sent to it
+    import mining
+    try:
+        conn.send(("ok", mining.open_shard(json_path, config, first, last)))
+    except Exception:
+        conn.send(("error", traceback.format_exc()))
+        return
+    while True:
+        command, args = conn.recv()
+        if command is None:
+            break
+        try:
+            conn.send(("ok", getattr(mining, command)(*args)))
+        except Exception:
+            conn.send(("error", traceback.format_exc()))
+    mining.close_shard()
+
+
+class Worker:
+    def __init__(self, context, json_path, config, first, last):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=run_worker, args=(child_conn, json_path, config, first, last),
+                                       daemon=True)
+        self.process.start()
+
+    def send(self, command, *args):
+        self.conn.send((command, args))
+
+    def receive(self):
+        status, result = self.conn.recv()
+        if status == "error":
+            raise RuntimeError(f"worker {self.process.pid} failed:\n{result}")
+        return result
+
+    def close(self):
+        if self.process.is_alive():
+            try:
+                self.send(None)
+            except OSError:
+                pass
+            self.process.join(timeout=10)
+            if self.process.is_alive():
+                self.process.terminate()
+        self.conn.close()
+
+
+def call_all(workers, command, args_list):
+    # the workers run the command at the same time; returns their results in order
+    for worker, args in zip(workers, args_list):
+        worker.send(command, *args)
+    return [worker.receive() for worker in workers]
+
+
+def mine_patterns(json_path, output_folder, config, n_workers, store_in_database=False, task_id=-1, job_id=-1):
+    """Mines the patterns of json_path with n_workers worker processes; takes the arguments of
+    mining.mine_patterns() and writes the same outputs."""
+    import mining
+    if config.get("target_tokens"):
+        raise ValueError("target tokens are not supported by sharded mining")
+    bounds = mining.shard_bounds(json_path, n_workers)
+    # spawned rather than forked, as the jobs of the server are
+    context = multiprocessing.get_context("spawn")
+    work_folder = tempfile.mkdtemp(prefix="shards_", dir=output_folder)
+    workers = []
+    try:
+        for first, last in zip(bounds, bounds[1:]):
+            workers.append(Worker(context, json_path, config, first, last))
+        total_token_count = sum(worker.receive() for worker in workers)
+        db_path = os.path.join(output_folder, "db.sqlite3")
+        if store_in_database:
+            for worker in workers:  # in the order of their ranges
+                worker.send("store_shard_tokens", db_path)
+                worker.receive()
+        mining.open_coordinator(json_path, output_folder, config, total_token_count, store_in_database, task_id,
+                                job_id)
+        report_paths = [os.path.join(work_folder, f"report_{i}.bin") for i in range(len(workers))]
+        merges_path = os.path.join(work_folder, "merges.bin")
+        result_paths = [os.path.join(work_folder, f"merged_{i}.bin") for i in range(len(workers))]
+        for round in range(1, config.get("n_total_rounds", 100) + 1):
+            call_all(workers, "index_shard", [(path,) for path in report_paths])
+            mining.coordinate_round(report_paths, merges_path)
+            call_all(workers, "merge_shard", [(merges_path, path) for path in result_paths])
+            if not mining.finish_round(round, result_paths):
+                break
+        patterns_path = os.path.join(work_folder, "patterns.bin")
+        mining.write_merged_patterns(patterns_path)
+        call_all(workers, "count_shard_positions", [(patterns_path, path) for path in result_paths])
+        mining.close_coordinator(output_folder, result_paths)
+    finally:
+        mining.abort_coordinator()  # after a failure; closed already otherwise
+        for worker in workers:
+            worker.close()
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    config = {}
+    if len(sys.argv) > 4:
+        with open(sys.argv[4]) as f:
+            config = json.load(f)
+    mine_patterns(sys.argv[1], sys.argv[2], config, int(sys.argv[3]))
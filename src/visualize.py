@@ -1,31 +1,57 @@
-# %%
-from pyvis.network import Network
-import networkx as nx
-import csv
-from config import output_folder
-import os
-output_fn = os.path.join(output_folder, "output.txt")
-from scipy.stats import zscore
-# G = nx.Graph()
-# %%
-net = Network(height="100%", width="60%", notebook=True)
-rows = csv.reader(open(output_fn))
-target_word = "accuse"
-for items in rows:
-    bigram, gram1, gram2, score, freq = [i.strip() for i in items]
-    for gram in [gram1, gram2]:
-        if gram not in net.nodes:
-            if gram == target_word:
-                val = 20
-                net.add_node(gram, label=gram, shape='box', value=val, scaling={"label": {"enabled": True, "min": val}}, color="red")
-            else:
-                net.add_node(gram, label=gram, shape='box')
-    net.add_node(bigram, color="#00ff00", shape='box', value=freq)
-    smooth_settings = {"enabled":True, "roundedness": 0.05}
-    net.add_edge(gram1, bigram, weight=freq, arrows="to", smooth=smooth_settings)
-    net.add_edge(gram2, bigram, weight=freq, arrows="to", smooth=smooth_settings)
-# pos = nx.spring_layout(net, k=3)
-# nx.draw(net, pos=pos, with_labels=True, font_size=8)
-net.show_buttons()
-net.show("/Users/yan/Downloads/patterns/output.html")
-# %%
+"""Draws subgraphs of the component graph of a task: merged patterns and the components they were merged from.
+
+    python visualize.py <db_path> <task_id> [node] [--depth 2] [--k 10] [--output graph.html]
+
+Only a bounded subgraph is drawn (see DBManager.get_component_graph()): around a node, or the best scored
+patterns of the task without one. The Explore page draws the same networks.
+"""
+import argparse
+import db_manager
+
+
+def build_network(edges, center=None, height="600px"):
+    """A pyvis network of the edges of a component graph; patterns are sized by their counts and center, the
+    node queried, is highlighted."""
+    from pyvis.network import Network  # only needed to draw
+    net = Network(height=height, width="100%", directed=True, notebook=False)
+    center = db_manager.parse_pattern_form(center) if center else None
+    pattern_counts = dict(zip(edges['target'], edges['count']))
+    for form in dict.fromkeys([*edges['source'], *edges['target']]):
+        label = db_manager.transform_pattern_form(form)
+        if form == center:
+            net.add_node(form, label=label, shape="box", color="red")
+        elif form in pattern_counts:
+            net.add_node(form, label=label, shape="box", color="#00cc66", value=int(pattern_counts[form]),
+                         title=f"count {pattern_counts[form]}")
+        else:
+            net.add_node(form, label=label, shape="box")
+    for edge in edges.itertuples():
+        net.add_edge(edge.source, edge.target, value=int(edge.count), arrows="to",
+                     title=f"{'left' if edge.side == 0 else 'right'}, score {edge.score:.2f}",
+                     smooth={"enabled": True, "roundedness": 0.05})
+    return net
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("db_path")
+    parser.add_argument("task_id", type=int)
+    parser.add_argument("node", nargs="?", help="a lemma, tag or pattern, e.g. 'accuse' or '<noun> have'")
+    parser.add_argument("--depth", type=int, default=2)
+    parser.add_argument("--k", type=int, default=10, help="patterns followed from each node per hop")
+    parser.add_argument("--max-nodes", type=int, default=300)
+    parser.add_argument("--output", default="graph.html")
+    args = parser.parse_args(argv)
+
+    manager = db_manager.DBManager(args.db_path)
+    if not manager.has_component_graph(args.task_id):
+        import mining
+        mining.build_component_graph(args.db_path, args.task_id)
+    edges = manager.get_component_graph(args.task_id, args.node, depth=args.depth, k=args.k,
+                                        max_nodes=args.max_nodes)
+    build_network(edges, center=args.node).write_html(args.output)
+    print(f"{len(edges)} edges drawn to {args.output}")
+
+
+if __name__ == "__main__":
+    main()